@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Asynchronous (ASGI) version of the search server, with the same /search,
+/suggest, /explore and /metrics contract as the Flask server of index.py. Elasticsearch is queried
+through an asyncio client with a bounded connection pool and timeouts, and
+identical searches in flight at the same time share a single request.
+Explorations run in the background in the crawl scheduler (scheduler.py).
+Run with any ASGI server, for example : uvicorn async_index:app --workers 4
+"""
+
+import os
+import json
+import time
+import asyncio
+import contextlib
+import logging
+import query
+import search_cache
+import suggest
+import search as searcher
+import scheduler
+import metrics
+from redis import Redis
+import backend
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+from starlette.middleware import Middleware
+
+host = os.getenv("HOST")
+user = os.getenv("USERNAME")
+pwd  = os.getenv("PASSWORD")
+port = os.getenv("PORT")
+
+#Max number of connections to Elasticsearch and timeout of a request (seconds)
+ES_POOL_SIZE = int(os.getenv("ES_POOL_SIZE", "20"))
+ES_TIMEOUT = float(os.getenv("ES_TIMEOUT", "10"))
+
+REDIS_URL = os.getenv("RQ_REDIS_URL", "redis://localhost:6379/0")
+
+es = None
+redis = None
+cache = None
+suggester = None
+
+class Coalescer(object):
+    """
+    Share the result of identical requests in flight at the same time.
+    """
+
+    def __init__(self) :
+        self.inflight = {}
+
+    async def run(self, key, factory) :
+        task = self.inflight.get(key)
+        if task is None :
+            task = asyncio.ensure_future(factory())
+            self.inflight[key] = task
+            task.add_done_callback(lambda _ : self.inflight.pop(key, None))
+        # a client going away must not cancel the request of the others
+        return await asyncio.shield(task)
+
+coalescer = Coalescer()
+
+class TimingMiddleware(object):
+    """
+    Record the duration of the requests (and of the searches by mode) as
+    the after_request hook of index.py.
+    """
+
+    def __init__(self, app) :
+        self.app = app
+
+    async def __call__(self, scope, receive, send) :
+        if scope["type"] != "http" :
+            return await self.app(scope, receive, send)
+        begin = time.perf_counter()
+        status = [500]
+        async def send_status(message) :
+            if message["type"] == "http.response.start" :
+                status[0] = message["status"]
+            await send(message)
+        try :
+            await self.app(scope, receive, send_status)
+        finally :
+            elapsed = time.perf_counter() - begin
+            endpoint = scope.get("endpoint")
+            searcher.REQUEST_SECONDS.observe(elapsed, endpoint=getattr(endpoint, "__name__", "unknown"),
+                method=scope["method"], status=status[0])
+            mode = scope.get("state", {}).get("search_mode")
+            if mode is not None :
+                searcher.SEARCH_SECONDS.observe(elapsed, mode=mode)
+
+async def es_search(body) :
+    key = json.dumps(body, sort_keys=True)
+    return await coalescer.run(key, lambda : es.search(index="web-en", body=body))
+
+async def blocking(function, *args) :
+    return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+@contextlib.asynccontextmanager
+async def lifespan(app) :
+    """
+    Create the clients in the event loop of the server, close them on exit.
+    """
+    global es, redis, cache, suggester
+    es = backend.create_async_client(hosts="http://%s:%s@%s:%s/"%(user, pwd, host, port),
+        maxsize=ES_POOL_SIZE, timeout=ES_TIMEOUT)
+    redis = Redis.from_url(REDIS_URL)
+    cache = search_cache.SearchCache(redis if os.getenv("SEARCH_CACHE_REDIS", "1") == "1" else None,
+        index="web-en")
+    # suggestions loaded and updated in a thread, with a blocking client
+    suggester = suggest.Suggester().start(lambda : backend.create_client(
+        hosts="http://%s:%s@%s:%s/"%(user, pwd, host, port), timeout=ES_TIMEOUT), redis, "web-en")
+    # comma separated list of the language models loaded before the first
+    # request, e.g. WARM_UP=laser,bert (Elasticsearch is checked with es)
+    for resource in [r.strip() for r in os.getenv("WARM_UP", "").split(",") if r.strip()] :
+        if resource == "es" :
+            logging.info(await es.info())
+        else :
+            import embeddings, vector_index
+            await blocking(embeddings.warmUp, [resource+"_vector"])
+            await blocking(vector_index.get_index, resource+"_vector")
+    yield
+    await es.close()
+
+async def timed_leg(coroutine, timeout) :
+    """
+    Result of a leg of an hybrid search and its latency and status.
+    """
+    begin = time.perf_counter()
+    try :
+        result, status = await asyncio.wait_for(coroutine, timeout), "ok"
+    except asyncio.TimeoutError :
+        result, status = None, "timeout"
+    except searcher.InvalidQuery :
+        raise
+    except Exception as e :
+        logging.warning("hybrid search leg failed : %s", e)
+        result, status = None, "error"
+    return result, {"ms":(time.perf_counter() - begin) * 1000, "status":status}
+
+async def hybrid_search(expression, vector_type, size, fusion, vector_weight) :
+    """
+    Same as search.hybrid_search, the legs run in the event loop.
+    """
+    depth = max(size, searcher.HYBRID_DEPTH)
+    (lexical, lexical_status), (ranking, vector_status) = await asyncio.gather(
+        timed_leg(es.search(index="web-en", body=query.lexical_query(expression, depth)),
+            searcher.LEXICAL_TIMEOUT),
+        timed_leg(blocking(searcher.vector_hits, expression, vector_type, depth),
+            searcher.VECTOR_TIMEOUT))
+    ids, known = searcher.hybrid_merge(lexical, ranking, fusion, vector_weight, size)
+    missing = [doc_id for doc_id in ids if doc_id not in known]
+    response = await es.mget(index="web-en", body={"ids":missing},
+        _source_includes=query.RESULT_FIELDS) if missing else None
+    return searcher.hybrid_results(ids, known, response), {"lexical":lexical_status,
+        "vector":vector_status}
+
+async def cached(function, *args) :
+    """
+    Call a method of the Redis tier of the cache, through a thread.
+    """
+    if cache.redis is None :
+        return function(*args)
+    return await blocking(function, *args)
+
+async def search(request) :
+    """
+    URL : /search
+    Method : HTTP POST
+    Same POST data and responses as /search of index.py.
+    """
+    form = await request.form()
+    data = dict((key, form.get(key)) for key in form.keys())
+    logging.debug("search request data : %s", data)
+    try :
+        expression, start, hits = searcher.parse_request(data)
+        request.state.search_mode = searcher.search_mode(data)
+        # popular queries are suggested (first pages only)
+        if start == 0 and not data.get("cursor") :
+            suggester.record_query(expression)
+
+        if "cursor" in data :
+            pages = searcher.cursor_pages(expression, data["cursor"], hits)
+            try :
+                body = next(pages)
+                while True :
+                    body = pages.send(await es_search(body))
+            except StopIteration as e :
+                total, results, cursor = e.value
+            return JSONResponse({"total":total, "results":results, "cursor":cursor})
+
+        if data.get("vector") :
+            ids = await blocking(searcher.vector_ids, expression, data["vector"]+"_vector", start+hits)
+            results = searcher.found_results(await es.mget(index="web-en", body={"ids":ids},
+                _source_includes=query.RESULT_FIELDS)) if ids else []
+            return JSONResponse({"total":len(results), "results":results[start:start+hits]})
+
+        if data.get("hybrid") :
+            vector_type, fusion, vector_weight = searcher.parse_hybrid(data)
+            results, legs = await hybrid_search(expression, vector_type, start+hits, fusion, vector_weight)
+            return JSONResponse({"total":len(results), "results":results[start:start+hits], "legs":legs})
+    except searcher.InvalidQuery as e :
+        return JSONResponse({"message":e.message}, status_code=e.status_code)
+
+    # the local tier is read and written on the event loop, only the Redis
+    # requests (generation, shared results) go through the threads
+    cache_key = await cached(cache.key, expression)
+    results = cache.get_local(cache_key)
+    if results is None :
+        results = await cached(cache.get_shared, cache_key)
+    if results is None :
+        response = await es_search(query.expression_query(expression))
+        results = searcher.sort_results(response)
+        cache.set_local(cache_key, results)
+        await cached(cache.set_shared, cache_key, results)
+
+    return JSONResponse({"total":len(results), "results":results[start:start+hits]})
+
+async def suggestions(request) :
+    """
+    URL : /suggest
+    Method : HTTP GET
+    Same parameters and responses as /suggest of index.py.
+    """
+    try :
+        prefix, hits = suggest.parse_request(request.query_params)
+    except searcher.InvalidQuery as e :
+        return JSONResponse({"message":e.message}, status_code=e.status_code)
+    return JSONResponse({"suggestions":suggester.complete(prefix, hits)})
+
+async def explore(request) :
+    """
+    URL : /explore
+    Method : HTTP POST
+    POST Data : url - url of the website to explore
+                profile - (optional) 1 : profile the crawl (see index.py)
+    Queue an exploration job for the crawl scheduler, return its id.
+    """
+    form = await request.form()
+    if "url" not in form :
+        return JSONResponse({"message":'No url specified in POST data'}, status_code=400)
+    logging.info("launch exploration job")
+    job_id = await blocking(lambda : scheduler.get_scheduler().submit(form["url"],
+        profile=form.get("profile") == "1"))
+    return JSONResponse({"message":"Exploration started", "job":job_id})
+
+async def explore_status(request) :
+    """
+    URL : /explore/<job_id>
+    Method : HTTP GET
+    State of an exploration job.
+    """
+    job = await blocking(lambda : scheduler.get_scheduler().status(request.path_params["job_id"]))
+    if job is None :
+        return JSONResponse({"message":'Unknown exploration job'}, status_code=404)
+    return JSONResponse(job)
+
+async def metrics_endpoint(request) :
+    """
+    URL : /metrics
+    Method : HTTP GET
+    Same response as /metrics of index.py.
+    """
+    snapshots = [({}, metrics.registry.snapshot())]
+    snapshots.extend(await blocking(metrics.published, redis))
+    return Response(metrics.render(snapshots), media_type="text/plain; version=0.0.4")
+
+app = Starlette(routes=[
+    Route("/search", search, methods=["POST"]),
+    Route("/suggest", suggestions, methods=["GET"]),
+    Route("/explore", explore, methods=["POST"]),
+    Route("/explore/{job_id}", explore_status, methods=["GET"]),
+    Route("/metrics", metrics_endpoint, methods=["GET"]),
+], lifespan=lifespan, middleware=[Middleware(TimingMiddleware)])
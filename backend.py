@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Storage and search backend of the search engine, chosen with the
+SEARCH_BACKEND environment variable :
+elasticsearch : an Elasticsearch cluster (default)
+local         : the embedded indexes of local_index.py, stored in the
+                LOCAL_INDEX_DIR directory, in the process itself
+Both are used through the same interface, the part of the Elasticsearch
+client API the project needs : info, search (with scroll and point in
+time), msearch, mget, count, bulk, index and indices.create, delete,
+refresh, get_mapping and put_mapping. Vector similarity scripts (script_score) are
+only available with Elasticsearch, vector searches on the local backend
+go through the local vector indexes (vector_index.py).
+The duration of every request to Elasticsearch is recorded (metrics.py).
+"""
+
+import os
+import time
+import asyncio
+import metrics
+
+BACKEND = os.getenv("SEARCH_BACKEND", "elasticsearch")
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", ".local_index")
+
+ES_SECONDS = metrics.histogram("es_request_seconds", "Duration of the requests to Elasticsearch.",
+    ["operation"])
+ES_ERRORS = metrics.counter("es_request_errors_total", "Failed requests to Elasticsearch.", ["operation"])
+
+def operation(method, path) :
+    """
+    Name of an Elasticsearch request : its API endpoint (_search, _bulk,
+    _search/scroll...) without the index names and ids.
+    """
+    path = path.split("?")[0].rstrip("/")
+    parts = [part for part in path.split("/") if part.startswith("_")]
+    if not parts :
+        # cluster information (/) or index management (/<index>)
+        return "%s %s"%(method, "index" if path else "/")
+    return parts[0] + ("/scroll" if path.endswith("/scroll") else "")
+
+def record(name, begin, error) :
+    ES_SECONDS.observe(time.perf_counter() - begin, operation=name)
+    if error :
+        ES_ERRORS.inc(operation=name)
+
+transports = {}
+
+def timed_transport() :
+    """
+    Transport of the Elasticsearch client recording the requests.
+    """
+    if "sync" not in transports :
+        from elasticsearch import Transport
+        class TimedTransport(Transport):
+            def perform_request(self, method, url, *args, **kwargs) :
+                begin, error = time.perf_counter(), True
+                try :
+                    result = Transport.perform_request(self, method, url, *args, **kwargs)
+                    error = False
+                    return result
+                finally :
+                    record(operation(method, url), begin, error)
+        transports["sync"] = TimedTransport
+    return transports["sync"]
+
+def timed_async_transport() :
+    """
+    Transport of the asynchronous Elasticsearch client recording the requests.
+    """
+    if "async" not in transports :
+        from elasticsearch import AsyncTransport
+        class TimedAsyncTransport(AsyncTransport):
+            async def perform_request(self, method, url, *args, **kwargs) :
+                begin, error = time.perf_counter(), True
+                try :
+                    result = await AsyncTransport.perform_request(self, method, url, *args, **kwargs)
+                    error = False
+                    return result
+                finally :
+                    record(operation(method, url), begin, error)
+        transports["async"] = TimedAsyncTransport
+    return transports["async"]
+
+def create_client(hosts=None, **options) :
+    """
+    Client of the backend, options are those of the Elasticsearch client.
+    """
+    if BACKEND == "local" :
+        import local_index
+        return local_index.get_client(LOCAL_INDEX_DIR)
+    from elasticsearch import Elasticsearch
+    return Elasticsearch(hosts=hosts, transport_class=timed_transport(), **options)
+
+class AsyncLocalClient(object):
+    """
+    Asynchronous interface of the local backend : the calls run in the
+    default executor of the event loop.
+    """
+
+    def __init__(self, client) :
+        self.client = client
+
+    def __getattr__(self, name) :
+        method = getattr(self.client, name)
+        async def call(*args, **kwargs) :
+            return await asyncio.get_running_loop().run_in_executor(None,
+                lambda : method(*args, **kwargs))
+        return call
+
+    async def close(self) :
+        pass
+
+def create_async_client(hosts=None, **options) :
+    """
+    Asynchronous client of the backend (for async_index.py).
+    """
+    if BACKEND == "local" :
+        return AsyncLocalClient(create_client())
+    from elasticsearch import AsyncElasticsearch
+    return AsyncElasticsearch(hosts=hosts, transport_class=timed_async_transport(), **options)
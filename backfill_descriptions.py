@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Store the fallback description (see document.fallback_description) of the
+pages indexed before it was computed by the crawler. Searches no longer
+fetch the bodies of the pages : without it, pages lacking a meta
+description are shown with an empty description.
+Usage : python backfill_descriptions.py [index pattern, default web-*]
+"""
+
+import os
+import sys
+from elasticsearch.helpers import scan
+import url
+import backend
+import document
+from bulk import BulkIndexer
+
+def backfill(es, index="web-*") :
+    """
+    Add the missing fallback descriptions, return the number of updated pages.
+    """
+    indexer = BulkIndexer(es)
+    updated = 0
+    for hit in scan(es, index=index, query={"query":{"match_all":{}}},
+            _source=["body", "fallback_description"]) :
+        if "fallback_description" in hit["_source"] :
+            continue
+        description = document.fallback_description(url.create_description(hit["_source"].get("body") or ""))
+        updated += 1
+        if indexer.add(hit["_index"], hit["_id"], {"fallback_description":description}, op_type="update") :
+            indexer.flush(hit["_index"])
+    indexer.flush_all()
+    return updated
+
+def main() :
+    index = sys.argv[1] if len(sys.argv) > 1 else "web-*"
+    host, user, pwd, port = (os.getenv(name) for name in ("HOST", "USERNAME", "PASSWORD", "PORT"))
+    es = backend.create_client(hosts="http://%s:%s@%s:%s/"%(user, pwd, host, port))
+    print("%d pages updated"%backfill(es, index))
+
+if __name__ == "__main__" :
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of page indexing : one index request per page (former
+crawler.pipeline behaviour) versus the buffered bulk path used by
+pipelines.BulkIndexPipeline, against a local stub Elasticsearch.
+Usage : python bench_bulk_index.py [pages] [latency_ms]
+"""
+
+import sys
+import time
+from bulk import BulkIndexer
+from stub_es import StubElasticsearch
+from elasticsearch import Elasticsearch
+
+def make_pages(count) :
+    """
+    Synthetic pages with the shape of crawler.pipeline documents.
+    """
+    body = "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 40
+    return [("http://example.com/page/%d"%i, {
+        "url":"http://example.com/page/%d"%i,
+        "domain":"example.com",
+        "title":"Page %d"%i,
+        "description":"Description of page %d"%i,
+        "body":body,
+        "weight":3
+    }) for i in range(count)]
+
+def per_document(es, pages) :
+    for doc_id, source in pages :
+        es.index(index="web-en", id=doc_id, body=source)
+
+def bulk(es, pages) :
+    indexer = BulkIndexer(es, max_docs=500, retry_backoff=0.01)
+    for doc_id, source in pages :
+        if indexer.add("web-en", doc_id, source) :
+            indexer.flush("web-en")
+    indexer.flush_all()
+    return indexer.stats
+
+def run(name, function, pages, **stub_options) :
+    stub = StubElasticsearch(**stub_options).start()
+    es = Elasticsearch(hosts=stub.url)
+    es.info()
+    begin = time.perf_counter()
+    stats = function(es, pages)
+    elapsed = time.perf_counter() - begin
+    stub.stop()
+    assert len(stub.docs) == len(pages), "%d documents stored"%len(stub.docs)
+    print("%-28s %8.0f pages/sec  %5d requests  %s"%(name, len(pages)/elapsed,
+        stub.requests - 1, stats or ""))
+
+def main() :
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.005
+    pages = make_pages(count)
+    print("%d pages, %.1f ms per request, 0.02 ms per bulk item"%(count, latency * 1000))
+    run("per document", per_document, pages, latency=latency, doc_cost=0.00002)
+    run("bulk", bulk, pages, latency=latency, doc_cost=0.00002)
+    run("bulk, 10% rejected", bulk, pages, latency=latency, doc_cost=0.00002, reject=0.1)
+
+if __name__ == "__main__" :
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Crawl throughput of a local fixture site (synthetic pages served by a stub
+HTTP server with a fixed latency), with the pages analyzed in the reactor
+as before ("inline") or in pools of 1, 2, 4... processes by
+pipelines.ContentExtractionPipeline. Pages are analyzed but not indexed.
+Usage : python bench_crawl.py [pages] [latency_ms] [max_workers]
+"""
+
+import os
+import sys
+import time
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from scrapy.spiders import CrawlSpider, Rule
+from scrapy.linkextractors import LinkExtractor
+from scrapy.crawler import CrawlerRunner
+from twisted.internet import reactor, defer
+import document
+import pipelines as content
+
+WORDS = ("the of and to in is was for on that with as by at from it this are be have an has were "
+    "which news world president government people said would new year city report market").split()
+
+def fixture_site(pages, latency) :
+    """
+    Stub HTTP server of pages /0 to /<pages-1>, each linking to 10 others.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        disable_nagle_algorithm = True
+
+        def do_GET(self) :
+            time.sleep(latency)
+            number = int(self.path.strip("/") or 0)
+            rand = random.Random(number)
+            words = lambda n : " ".join(rand.choice(WORDS) for _ in range(n))
+            links = "".join('<li><a href="/%d">%s</a></li>'%((number * 10 + i) % pages, words(3))
+                for i in range(1, 11))
+            paragraphs = "".join("<p>%s.</p>"%words(rand.randint(20, 80)) for _ in range(30))
+            body = ('<html><head><title>%s</title><meta name="description" content="%s">'
+                '<script>%s</script></head><body><ul>%s</ul><article>%s</article></body></html>'%(
+                words(8), words(20), "var a=1;"*300, links, paragraphs)).encode("utf8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args) :
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class FixtureSpider(CrawlSpider):
+    """
+    Same rules and page items as crawler.Crawler.
+    """
+
+    name = "fixture"
+    rules = (Rule(LinkExtractor(), callback='parse_items', follow=True),)
+
+    def parse_items(self, response) :
+        if self.inline :
+            yield document.analyze(response.url, response.body, response.encoding)[1]
+        else :
+            yield {"url":response.url, "html":response.body, "encoding":response.encoding,
+                "content_language":None}
+
+class CountPipeline(object):
+
+    def process_item(self, item, spider) :
+        spider.crawler.stats.inc_value("bench/pages")
+        return item
+
+@defer.inlineCallbacks
+def run(pages, latency, max_workers) :
+    server = fixture_site(pages, latency)
+    start = "http://127.0.0.1:%d/0"%server.server_address[1]
+    configurations = [("inline", 0)]
+    workers = 1
+    while workers <= max_workers :
+        configurations.append(("pool", workers))
+        workers *= 2
+    print("%d pages, %d ms latency, %d cores"%(pages, latency * 1000, os.cpu_count()))
+    for mode, workers in configurations :
+        pipelines = {"bench_crawl.CountPipeline":300}
+        if mode == "pool" :
+            pipelines["pipelines.ContentExtractionPipeline"] = 200
+        runner = CrawlerRunner({"ITEM_PIPELINES":pipelines, "CONTENT_WORKERS":workers,
+            "CONCURRENT_REQUESTS":64, "CONCURRENT_REQUESTS_PER_DOMAIN":64, "DOWNLOAD_DELAY":0,
+            "ROBOTSTXT_OBEY":False, "CLOSESPIDER_ITEMCOUNT":pages, "LOG_LEVEL":"WARNING",
+            "TELNETCONSOLE_ENABLED":False})
+        if mode == "pool" :
+            # start the pool processes before timing
+            executor, _ = content.get_executor(workers, 64)
+            list(executor.map(document.analyze, [start] * workers, [b"<html><p>warm up</p></html>"] * workers))
+        crawler = runner.create_crawler(FixtureSpider)
+        begin = time.perf_counter()
+        yield runner.crawl(crawler, start_urls=[start], inline=mode == "inline")
+        elapsed = time.perf_counter() - begin
+        count = crawler.stats.get_value("bench/pages", 0)
+        print("%-6s %2s workers  %6d pages  %7.1f pages/s"%(mode, workers or "-", count, count / elapsed))
+    server.shutdown()
+    reactor.stop()
+
+def main() :
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.02
+    max_workers = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count()
+    reactor.callWhenRunning(run, pages, latency, max_workers)
+    reactor.run()
+
+if __name__ == "__main__" :
+    main()
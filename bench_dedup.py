@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Near-duplicate ratio of the pages of the demo URL lists of resources/ and
+cost per page of the SimHash signature and of the LSH index lookup
+(dedup.py). Pages are downloaded once in a cache directory (see bench_parse.py).
+Usage : python bench_dedup.py [pages_per_list] [cache_directory] [distance]
+"""
+
+import sys
+import time
+import dedup
+import document
+from bench_parse import LISTS, load_pages
+
+def main() :
+    limit = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    directory = sys.argv[2] if len(sys.argv) > 2 else ".bench_pages"
+    distance = int(sys.argv[3]) if len(sys.argv) > 3 else dedup.DISTANCE
+    for lang, path in LISTS.items() :
+        bodies = []
+        for i, html in enumerate(load_pages(path, limit, directory)) :
+            item = document.analyze("page-%d"%i, html)[1]
+            bodies.append((item["id"], item["source"]["body"]))
+        if not bodies :
+            print("%s : no page available"%lang)
+            continue
+        index = dedup.SimHashIndex(distance)
+        signature_time = lookup_time = 0
+        duplicates = unsigned = 0
+        body_bytes = duplicate_bytes = 0
+        for key, body in bodies :
+            begin = time.perf_counter()
+            signature = dedup.simhash(body)
+            signature_time += time.perf_counter() - begin
+            size = len(body.encode("utf8"))
+            body_bytes += size
+            if signature is None :
+                unsigned += 1
+                continue
+            begin = time.perf_counter()
+            canonical = index.find(signature)
+            if canonical is None :
+                index.add(signature, key)
+            lookup_time += time.perf_counter() - begin
+            if canonical is not None :
+                duplicates += 1
+                duplicate_bytes += size
+        print("%s : %d pages, %d too short, %d near-duplicates (%.1f%%), %.1f%% of body bytes"%(lang,
+            len(bodies), unsigned, duplicates, duplicates * 100 / len(bodies),
+            duplicate_bytes * 100 / max(1, body_bytes)))
+        print("  signature %.3f ms / page, LSH lookup %.1f us / page"%(signature_time / len(bodies) * 1000,
+            lookup_time / len(bodies) * 10**6))
+
+if __name__ == "__main__" :
+    main()
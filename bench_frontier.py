@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Memory and false positive rate of the scalable Bloom filter of frontier.py.
+Adds N synthetic canonical URLs to an in-memory filter, then looks up N
+URLs never added. With a Redis URL, the same measure is done on the Redis
+backed filter of a Frontier, whose memory is read from Redis itself.
+Usage : python bench_frontier.py [urls] [capacity] [error_rate] [redis_url]
+"""
+
+import sys
+import time
+from frontier import ScalableBloomFilter, MemoryBits, Frontier
+
+def urls(count, prefix) :
+    return ("http://www.%s%d.com/section/%d/article-%d.html"%(prefix, i % 1000, i // 1000, i)
+        for i in range(count))
+
+def measure(name, bloom, count, nbytes) :
+    begin = time.perf_counter()
+    for link in urls(count, "seen") :
+        bloom.add(link)
+    add_time = time.perf_counter() - begin
+    begin = time.perf_counter()
+    false_positives = sum(1 for link in urls(count, "unseen") if link in bloom)
+    lookup_time = time.perf_counter() - begin
+    size = nbytes()
+    print("%-8s %8d urls  %3d layers  %8.2f MB  %7.2f MB / 1M urls  fp rate %.5f  "
+        "add %.1f us  lookup %.1f us"%(name, count, len(bloom.layers), size / 2**20,
+        size / 2**20 * 10**6 / count, false_positives / count, add_time / count * 10**6,
+        lookup_time / count * 10**6))
+
+def main() :
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    capacity = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+    error_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 0.001
+    print("capacity of the first layer %d, target error rate %s"%(capacity, error_rate))
+
+    bloom = ScalableBloomFilter(lambda layer, size : MemoryBits(size), capacity=capacity,
+        error_rate=error_rate)
+    measure("memory", bloom, count, lambda : bloom.nbytes)
+
+    if len(sys.argv) > 4 :
+        from redis import Redis
+        redis = Redis.from_url(sys.argv[4])
+        frontier = Frontier(redis, "bench-frontier", capacity=capacity, error_rate=error_rate)
+        keys = lambda : redis.keys(frontier.seen_key + ":*")
+        redis.delete(*keys() or ["none"])
+        measure("redis", frontier.seen, count,
+            lambda : sum(redis.memory_usage(key) or 0 for key in keys()))
+        redis.delete(*keys())
+
+if __name__ == "__main__" :
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Speed and accuracy of language identification on the pages of the demo URL
+lists of resources/ (the expected language is the one of the list) :
+- langdetect : former url.detect_language, langdetect on the whole html2text output
+- sampled : language_id on a bounded sample of the text, lang attribute ignored
+- declared : language_id with the lang attribute of the page
+Pages are parsed beforehand : only identification is timed.
+Usage : python bench_language.py [pages_per_list] [cache_directory]
+"""
+
+import sys
+import time
+import html2text
+import langdetect
+import language_id
+from parsel import Selector
+from document import Document
+from bench_parse import LISTS, load_pages
+
+EXPECTED = {"english":"en", "french":"fr"}
+
+def run(name, detect, inputs) :
+    correct = 0
+    begin = time.perf_counter()
+    for value, expected in inputs :
+        correct += detect(value) == expected
+    elapsed = time.perf_counter() - begin
+    print("%-12s %8.0f pages/s   accuracy %.3f"%(name, len(inputs) / elapsed, correct / len(inputs)))
+
+def langdetect_full(text) :
+    try :
+        return langdetect.detect(text)
+    except langdetect.lang_detect_exception.LangDetectException :
+        return None
+
+def main() :
+    limit = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    directory = sys.argv[2] if len(sys.argv) > 2 else ".bench_pages"
+    texts = []
+    documents = []
+    for lang, path in LISTS.items() :
+        for html in load_pages(path, limit, directory) :
+            texts.append((html2text.HTML2Text().handle(html.decode("utf8", "replace")), EXPECTED[lang]))
+            document = Document(Selector(html.decode("utf8", "replace")).root)
+            document.paragraphs
+            documents.append((document, EXPECTED[lang]))
+    if not texts :
+        print("no page available")
+        return
+    print("%d pages, at most %d characters sampled"%(len(texts), language_id.MAX_TEXT_LENGTH))
+    language_id.get_factory() # profiles loading is not timed
+    run("langdetect", langdetect_full, texts)
+    run("sampled", lambda document : language_id.detect(document.language_sample(), document.title)[0],
+        documents)
+    run("declared", lambda document : document.detect_language()[0], documents)
+
+if __name__ == "__main__" :
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Indexing throughput and search latency of the embedded backend
+(local_index.py) on a synthetic corpus : pages of words drawn from a Zipf
+distribution over a large vocabulary, spread over many domains, indexed
+with the bulk writer of the crawler. The searches are those of the
+servers : per domain results (query.expression_query), cursor pages and
+the lexical leg of hybrid searches. With --es, the same corpus and
+searches run on an Elasticsearch cluster too, for comparison.
+Usage : python bench_local_index.py [--docs 20000] [--queries 200]
+        [--es http://localhost:9200/]
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import query
+import search as searcher
+import local_index
+from bulk import BulkIndexer
+
+INDEX = "bench-local"
+
+def corpus(count, domains=500, vocabulary=50000, seed=0) :
+    """
+    Synthetic pages : title, description and body words of a Zipf law.
+    """
+    rand = np.random.default_rng(seed)
+    words = ["w%x"%i for i in range(vocabulary)]
+    cumulative = np.cumsum(1.0 / np.arange(1, vocabulary + 1))
+    cumulative /= cumulative[-1]
+    text = lambda n : " ".join(words[i] for i in np.searchsorted(cumulative, rand.random(n)))
+    for i in range(count) :
+        domain = "site%d.com"%(i % domains)
+        yield "http://%s/page/%d"%(domain, i), {"url":"http://%s/page/%d"%(domain, i), "domain":domain,
+            "title":text(8), "description":text(25), "body":text(int(rand.integers(100, 600))),
+            "weight":int(rand.integers(1, 5))}
+
+def queries(count, seed=1) :
+    """
+    Queries of 1 to 3 words, from frequent to rare ones.
+    """
+    rand = np.random.default_rng(seed)
+    return [" ".join("w%x"%int(rand.integers(0, 10 ** int(rand.integers(1, 5))))
+        for _ in range(int(rand.integers(1, 4)))) for _ in range(count)]
+
+def index_corpus(es, docs) :
+    indexer = BulkIndexer(es, max_docs=500)
+    begin = time.perf_counter()
+    for doc_id, source in corpus(docs) :
+        if indexer.add(INDEX, doc_id, source) :
+            indexer.flush(INDEX)
+    indexer.flush_all()
+    es.indices.refresh(index=INDEX)
+    return time.perf_counter() - begin
+
+def latencies(search, expressions) :
+    times = []
+    for expression in expressions :
+        begin = time.perf_counter()
+        search(expression)
+        times.append(time.perf_counter() - begin)
+    times = np.asarray(times) * 1000
+    return np.percentile(times, 50), np.percentile(times, 99)
+
+def searches(es) :
+    return [
+        ("per domain", lambda e : searcher.sort_results(es.search(index=INDEX, body=query.expression_query(e)))),
+        ("cursor", lambda e : searcher.cursor_search(lambda body : es.search(index=INDEX, body=body), e, "", 10)),
+        ("lexical 100", lambda e : es.search(index=INDEX, body=query.lexical_query(e, 100))),
+    ]
+
+def top_ids(es, expression) :
+    return [hit["_id"] for hit in es.search(index=INDEX, body=query.lexical_query(expression, 10))["hits"]["hits"]]
+
+def main() :
+    parser = argparse.ArgumentParser(description="Benchmark of the embedded search backend.")
+    parser.add_argument("--docs", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--es", help="URL of an Elasticsearch cluster to compare with")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="local_index_")
+    backends = [("local", local_index.LocalClient(directory))]
+    if args.es :
+        from elasticsearch import Elasticsearch
+        es = Elasticsearch(args.es, timeout=60)
+        es.indices.delete(index=INDEX, ignore=[404])
+        es.indices.create(index=INDEX, body={"mappings":{"properties":{"domain":{"type":"keyword"},
+            "url":{"type":"keyword"}, "weight":{"type":"float"}}}})
+        backends.append(("elasticsearch", es))
+    expressions = queries(args.queries)
+
+    print("%d documents, %d queries"%(args.docs, args.queries))
+    for name, es in backends :
+        elapsed = index_corpus(es, args.docs)
+        print("%-14s indexing %8.0f docs/s"%(name, args.docs / elapsed))
+        if name == "local" :
+            target = es.index_of(INDEX)
+            while target.merging.is_set() :
+                time.sleep(0.1)
+            size = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(directory) for f in files)
+            print("%-14s %d segments, %.1f MB on disk"%("", len(target.segments), size / 2**20))
+        latencies(searches(es)[0][1], expressions[:10]) # warm up
+        for search_name, search in searches(es) :
+            p50, p99 = latencies(search, expressions)
+            print("%-14s %-12s p50 %7.2f ms  p99 %7.2f ms"%(name, search_name, p50, p99))
+    if len(backends) > 1 :
+        overlap = np.mean([len(set(top_ids(backends[0][1], e)) & set(top_ids(backends[1][1], e))) / 10.0
+            for e in expressions])
+        print("top 10 overlap with Elasticsearch : %.2f"%overlap)
+        backends[1][1].indices.delete(index=INDEX)
+    shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == "__main__" :
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Overhead of the metrics (metrics.py) : cost of recording a value in a
+histogram and a counter, of rendering /metrics with the series of several
+crawl workers, and slowdown of a CPU bound loop while the sampling
+profiler runs.
+Usage : python bench_metrics.py [--observations 1000000] [--workers 4]
+"""
+
+import time
+import argparse
+import metrics
+
+def busy(count) :
+    total = 0
+    for i in range(count) :
+        total += i * i % 7
+    return total
+
+def main() :
+    parser = argparse.ArgumentParser(description="Benchmark of the metrics.")
+    parser.add_argument("--observations", type=int, default=1000000)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    histogram = metrics.histogram("bench_seconds", "Benchmark histogram.", ["stage"])
+    counter = metrics.counter("bench_total", "Benchmark counter.", ["result"])
+    stages = ["parse", "language", "boilerplate", "description", "simhash"]
+    begin = time.perf_counter()
+    for i in range(args.observations) :
+        histogram.observe(i % 1000 * 1e-4, stage=stages[i % 5])
+    elapsed = time.perf_counter() - begin
+    print("histogram observe   %6.2f us"%(elapsed / args.observations * 1e6))
+    begin = time.perf_counter()
+    for i in range(args.observations) :
+        counter.inc(result="local")
+    elapsed = time.perf_counter() - begin
+    print("counter inc         %6.2f us"%(elapsed / args.observations * 1e6))
+    begin = time.perf_counter()
+    for i in range(args.observations // 10) :
+        with metrics.timed(histogram, stage="timed") :
+            pass
+    elapsed = time.perf_counter() - begin
+    print("timed block         %6.2f us"%(elapsed / (args.observations // 10) * 1e6))
+
+    snapshot = metrics.registry.snapshot()
+    snapshots = [({}, snapshot)] + [({"worker":str(n)}, snapshot) for n in range(args.workers)]
+    begin = time.perf_counter()
+    text = metrics.render(snapshots)
+    elapsed = time.perf_counter() - begin
+    print("render /metrics     %6.2f ms (%d lines, %d bytes)"%(elapsed * 1000, text.count("\n"), len(text)))
+
+    count = 5000000
+    begin = time.perf_counter()
+    busy(count)
+    alone = time.perf_counter() - begin
+    profiler = metrics.SamplingProfiler().start()
+    begin = time.perf_counter()
+    busy(count)
+    profiled = time.perf_counter() - begin
+    profiler.stop()
+    print("profiled loop       %.2f s instead of %.2f s (%+.1f%%), %d samples"%(profiled, alone,
+        (profiled / alone - 1) * 100, profiler.samples))
+
+if __name__ == "__main__" :
+    main()
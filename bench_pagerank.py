@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Cost of the static rank : time of the PageRank power iteration on
+synthetic web graphs (links mostly inside their website, to pages of a
+Zipf popularity), then the whole offline job on an index of pages with
+links (loading the graph, computing and writing the scores) and the
+latency of the per domain searches. On Elasticsearch (--es), the searches
+with the PageRank rank feature and the native weight rescore are compared
+with the previous Painless script rescore, on the embedded backend with
+the same queries without the rank feature.
+Usage : python bench_pagerank.py [--pages 1000000] [--docs 5000] [--es <url>]
+"""
+
+import copy
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import query
+import pagerank
+import search as searcher
+import local_index
+from bulk import BulkIndexer
+from bench_local_index import corpus, queries, latencies
+
+INDEX = "bench-pagerank"
+
+def graph(pages, links=15, domains=None, local=0.8, seed=0) :
+    """
+    Source and target page numbers of pages * links links : a share local
+    of them inside the website (page number modulo domains), the rest to
+    any page, targets drawn from a Zipf popularity.
+    """
+    rand = np.random.default_rng(seed)
+    domains = domains or max(pages // 100, 1)
+    popularity = np.cumsum(1.0 / np.arange(1, pages + 1))
+    popularity /= popularity[-1]
+    permutation = rand.permutation(pages) # popular pages spread over the websites
+    sources = np.repeat(np.arange(pages), links)
+    targets = permutation[np.searchsorted(popularity, rand.random(len(sources)))]
+    inside = rand.random(len(sources)) < local
+    # page of about the same popularity inside the website of the source
+    targets[inside] = (targets[inside] // domains) * domains + sources[inside] % domains
+    targets[targets >= pages] -= domains
+    return sources, targets
+
+def script_rescore(body) :
+    """
+    Per domain query as before the rank feature : weight applied by a script.
+    """
+    body = copy.deepcopy(body)
+    body["query"] = body["query"]["bool"]["must"]
+    body["rescore"][-1]["query"]["rescore_query"] = {"function_score":{"script_score":{"script":{
+        "inline":"_score*doc.weight.value"}}}}
+    return body
+
+def without_rank_feature(body) :
+    body = copy.deepcopy(body)
+    del body["query"]["bool"]["should"]
+    return body
+
+def main() :
+    parser = argparse.ArgumentParser(description="Benchmark of the PageRank static rank.")
+    parser.add_argument("--pages", type=int, default=1000000)
+    parser.add_argument("--docs", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--es", help="URL of an Elasticsearch cluster (default : embedded backend)")
+    args = parser.parse_args()
+
+    for pages in sorted(set([args.pages // 10, args.pages])) :
+        sources, targets = graph(pages)
+        begin = time.perf_counter()
+        ranks, iterations = pagerank.pagerank(sources, targets, pages)
+        elapsed = time.perf_counter() - begin
+        print("power iteration %9d pages %10d links : %6.2f s, %d iterations, max score %.1f"%(
+            pages, len(sources), elapsed, iterations, ranks.max() * pages))
+
+    directory = tempfile.mkdtemp(prefix="local_index_")
+    if args.es :
+        from elasticsearch import Elasticsearch
+        es = Elasticsearch(args.es, timeout=60)
+    else :
+        es = local_index.LocalClient(directory)
+    es.indices.delete(index=INDEX, ignore=[404])
+    es.indices.create(index=INDEX, body={"mappings":{"properties":{"domain":{"type":"keyword"},
+        "url":{"type":"keyword"}, "weight":{"type":"long"}, "links":{"type":"keyword", "index":False}}}})
+    sources, targets = graph(args.docs, domains=500)
+    ids = ["http://site%d.com/page/%d"%(number % 500, number) for number in range(args.docs)]
+    targets = targets.reshape(args.docs, -1)
+    indexer = BulkIndexer(es)
+    for number, (doc_id, source) in enumerate(corpus(args.docs, domains=500)) :
+        source["links"] = [ids[target] for target in targets[number]]
+        if indexer.add(INDEX, doc_id, source) :
+            indexer.flush(INDEX)
+    indexer.flush_all()
+    es.indices.refresh(index=INDEX)
+
+    begin = time.perf_counter()
+    pages, link_sources, link_targets = pagerank.load_graph(es, INDEX)
+    loaded = time.perf_counter()
+    ranks, _ = pagerank.pagerank(link_sources, link_targets, len(pages))
+    computed = time.perf_counter()
+    updated = pagerank.write_ranks(es, pages, ranks)
+    es.indices.refresh(index=INDEX)
+    written = time.perf_counter()
+    print("offline job %d pages %d links : load %.2f s, compute %.2f s, write %.2f s (%d updated)"%(
+        len(pages), len(link_sources), loaded - begin, computed - loaded, written - computed, updated))
+    pages_after, _, _ = pagerank.load_graph(es, INDEX)
+    print("second run : %d pages to update"%sum(1 for page, score in zip(pages_after, ranks * len(ranks))
+        if not page[2] or abs(score - page[2]) > pagerank.MIN_CHANGE * page[2]))
+
+    expressions = queries(args.queries)
+    variants = [("rank feature", lambda body : body),
+        ("script rescore", script_rescore) if args.es else ("no rank feature", without_rank_feature)]
+    for name, variant in variants :
+        search = lambda e : searcher.sort_results(es.search(index=INDEX, body=variant(query.expression_query(e))))
+        latencies(search, expressions[:10]) # warm up
+        p50, p99 = latencies(search, expressions)
+        print("per domain %-16s p50 %7.2f ms  p99 %7.2f ms"%(name, p50, p99))
+    es.indices.delete(index=INDEX, ignore=[404])
+    shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == "__main__" :
+    main()
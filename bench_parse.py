@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Per stage CPU profile of the page analysis of the crawler, before (CSS
+selectors, url.detect_language with html2text, url.extract_content with
+jusText, each parsing the page again) and after (document.Document on the
+tree of the selector). The selector tree is built in both cases since the
+link extractor of the spider needs it.
+Pages of the demo URL lists of resources/ are downloaded once and kept in
+a cache directory.
+Usage : python bench_parse.py [pages_per_list] [cache_directory]
+"""
+
+import os
+import sys
+import time
+import hashlib
+import html2text
+import langdetect
+from collections import OrderedDict
+from parsel import Selector
+import url
+from document import Document
+
+LISTS = {
+    "english":"resources/demo_list_urls_english.txt",
+    "french":"resources/demo_list_urls_french.txt",
+}
+
+def load_pages(path, limit, directory) :
+    """
+    HTML pages of an URL list, from the cache directory or downloaded.
+    """
+    os.makedirs(directory, exist_ok=True)
+    pages = []
+    with open(path) as f :
+        links = [line.strip() for line in f if line.strip()][:limit]
+    for link in links :
+        filename = os.path.join(directory, hashlib.sha1(link.encode("utf8")).hexdigest()+".html")
+        if not os.path.exists(filename) :
+            r = url.crawl(link)
+            if r is None or r.status_code != 200 or "html" not in r.headers.get("Content-Type", "") :
+                continue
+            with open(filename, "wb") as f :
+                f.write(r.content)
+        with open(filename, "rb") as f :
+            pages.append(f.read())
+    return pages
+
+class Profile(object):
+    """
+    CPU time per stage.
+    """
+
+    def __init__(self) :
+        self.stages = OrderedDict()
+
+    def run(self, stage, function, *args) :
+        begin = time.process_time()
+        result = function(*args)
+        self.stages[stage] = self.stages.get(stage, 0) + time.process_time() - begin
+        return result
+
+def html2text_handle(html) :
+    # text part of url.detect_language
+    return html2text.HTML2Text().handle(html.decode("utf8", "replace"))
+
+def before(profile, html, lang) :
+    selector = profile.run("selector parse", Selector, html.decode("utf8", "replace"))
+    profile.run("title & description", lambda : (selector.css('title::text').extract_first(),
+        selector.css("meta[name=description]::attr(content)").extract_first()))
+    text = profile.run("visible text", lambda : html2text_handle(html))
+    profile.run("language detection", langdetect.detect, text)
+    return profile.run("content extraction", url.extract_content, html, lang)
+
+def after(profile, html, lang) :
+    selector = profile.run("selector parse", Selector, html.decode("utf8", "replace"))
+    document = Document(selector.root)
+    profile.run("title & description", lambda : (document.title, document.description))
+    text = profile.run("visible text", lambda : document.text)
+    profile.run("language detection", langdetect.detect, text)
+    return profile.run("content extraction", document.extract_content)
+
+def main() :
+    limit = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    directory = sys.argv[2] if len(sys.argv) > 2 else ".bench_pages"
+    langdetect.DetectorFactory.seed = 0
+    for lang, path in LISTS.items() :
+        pages = load_pages(path, limit, directory)
+        if not pages :
+            print("%s : no page available"%lang)
+            continue
+        print("%s : %d pages, CPU ms per page"%(lang, len(pages)))
+        profiles = (("before", before, Profile()), ("after", after, Profile()))
+        for html in pages :
+            for name, analyze, profile in profiles :
+                try :
+                    analyze(profile, html, lang)
+                except langdetect.lang_detect_exception.LangDetectException :
+                    pass # no text
+        print("  %-22s %10s %10s"%("stage", "before", "after"))
+        for stage in profiles[0][2].stages :
+            print("  %-22s %10.2f %10.2f"%(stage, *(profile.stages.get(stage, 0) / len(pages) * 1000
+                for _, _, profile in profiles)))
+        totals = [sum(profile.stages.values()) / len(pages) * 1000 for _, _, profile in profiles]
+        parse = [sum(value for stage, value in profile.stages.items() if stage != "language detection")
+            / len(pages) * 1000 for _, _, profile in profiles]
+        print("  %-22s %10.2f %10.2f"%("total", *totals))
+        print("  %-22s %10.2f %10.2f"%("total w/o langdetect", *parse))
+
+if __name__ == "__main__" :
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Recall versus memory report of vector_index.ExactIndex storage types.
+Runs on the local vector store of a vector type if it was built with
+vector_index.py, otherwise on a synthetic clustered corpus.
+Usage : python bench_quantization.py <vector_type> [vectors] [queries]
+Vector type : 'LASER' or 'BERT'
+"""
+
+import sys
+import time
+import shutil
+import tempfile
+import numpy as np
+import vector_index
+
+def synthetic_store(directory, dim, count, seed=0) :
+    """
+    Vector store of count noisy vectors around 100 random centers.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(100, dim))
+    store = vector_index.VectorStore(directory, dim)
+    for start in range(0, count, 10000) :
+        size = min(10000, count - start)
+        vectors = centers[rng.integers(0, 100, size)] + 0.7 * rng.normal(size=(size, dim))
+        matrix, ids, first = store.append(["doc-%d"%i for i in range(start, start+size)], vectors)
+        store.commit(ids)
+    return store
+
+def main() :
+    if len(sys.argv) < 2 or sys.argv[1].lower() not in ("laser", "bert") :
+        sys.exit(__doc__)
+    vector_type = sys.argv[1].lower() + "_vector"
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    nqueries = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    dim = vector_index.DIMS[vector_type]
+
+    directory = None
+    store = vector_index.get_index(vector_type).store
+    if not len(store) :
+        directory = tempfile.mkdtemp()
+        store = synthetic_store(directory, dim, count)
+    print("%d vectors of %d dimensions, %d queries, top 10"%(len(store), dim, nqueries))
+
+    rng = np.random.default_rng(1)
+    matrix = np.asarray(store.matrix)
+    queries = matrix[rng.integers(0, len(store), nqueries)] + 0.05 * rng.normal(size=(nqueries, dim))
+    truth = [set(np.argsort(-scores)[:10]) for scores in vector_index.normalize(queries) @ matrix.T]
+
+    print("%-16s %10s %14s %10s %12s"%("storage", "MB", "MB / 1M docs", "recall@10", "ms / query"))
+    for dtype, rerank in (("float32", 0), ("float16", 0), ("int8", 0), ("int8", 100)) :
+        index = vector_index.ExactIndex(store, dtype, rerank=rerank)
+        begin = time.perf_counter()
+        results = index.search(queries, 10)
+        elapsed = time.perf_counter() - begin
+        recall = np.mean([len(set(store.rows[doc_id] for doc_id, _ in result) & expected) / 10
+            for result, expected in zip(results, truth)])
+        name = dtype + (" + rerank" if rerank else "")
+        print("%-16s %10.1f %14.0f %10.3f %12.3f"%(name, index.nbytes / 2**20,
+            index.nbytes / len(store) * 10**6 / 2**20, recall, elapsed * 1000 / nqueries))
+
+    if directory :
+        shutil.rmtree(directory)
+
+if __name__ == "__main__" :
+    main()
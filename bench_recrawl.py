@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Bytes downloaded and Elasticsearch writes of a second exploration of a
+fixture site, with the incremental re-crawl of recrawl.py.
+The fixture site answers conditional requests on its pages with an ETag
+(one page out of three has no validator, only its body fingerprint can be
+compared). Between the two crawls, one page out of ten changes.
+Pages are analyzed and indexed in a stub Elasticsearch (stub_es.py).
+Usage : python bench_recrawl.py [pages] [changed_ratio]
+"""
+
+import sys
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from elasticsearch import Elasticsearch
+from scrapy import Request
+from scrapy.http import HtmlResponse
+from scrapy.spiders import CrawlSpider, Rule
+from scrapy.linkextractors import LinkExtractor
+from scrapy.crawler import CrawlerRunner
+from twisted.internet import reactor, defer
+import recrawl
+from stub_es import StubElasticsearch
+from bench_crawl import WORDS
+
+class FixtureSite(object):
+    """
+    Pages /0 to /<pages-1>, each linking to 10 others. Pages whose number
+    is in changed have a new version.
+    """
+
+    def __init__(self, pages) :
+        self.pages = pages
+        self.changed = set()
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            disable_nagle_algorithm = True
+
+            def do_GET(self) :
+                number = int(self.path.strip("/") or 0)
+                version = 1 if number in site.changed else 0
+                etag = '"%d-%d"'%(number, version) if number % 3 else None
+                if etag and self.headers.get("If-None-Match") == etag :
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                body = site.page(number, version)
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                if etag :
+                    self.send_header("ETag", etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args) :
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def page(self, number, version) :
+        rand = random.Random(number * 7 + version)
+        words = lambda n : " ".join(rand.choice(WORDS) for _ in range(n))
+        links = "".join('<li><a href="/%d">%s</a></li>'%((number * 10 + i) % self.pages, words(3))
+            for i in range(1, 11))
+        paragraphs = "".join("<p>%s.</p>"%words(rand.randint(20, 80)) for _ in range(30))
+        return ('<html lang="en"><head><title>%s</title><meta name="description" content="%s">'
+            '</head><body><ul>%s</ul><article>%s</article></body></html>'%(
+            words(8), words(20), links, paragraphs)).encode("utf8")
+
+class FixtureSpider(CrawlSpider):
+    """
+    Same rules, page items and re-crawl logic as crawler.Crawler.
+    """
+
+    name = "fixture"
+    handle_httpstatus_list = [304]
+    rules = (Rule(LinkExtractor(), callback='parse_items', follow=True),)
+
+    def parse_page(self, response) :
+        yield from self.parse_items(response)
+        if isinstance(response, HtmlResponse) :
+            for link in self.rules[0].link_extractor.extract_links(response) :
+                yield self.follow(link.url)
+
+    def follow(self, url) :
+        return Request(url, callback=self.parse_page)
+
+    def parse_items(self, response) :
+        validators = response.meta.get("validators") or {}
+        if response.status == 304 :
+            for link in validators.get("links", []) :
+                yield self.follow(link)
+            return
+        if not isinstance(response, HtmlResponse) :
+            return
+        fingerprint = recrawl.fingerprint(response.body)
+        if validators.get("fingerprint") == fingerprint :
+            self.crawler.stats.inc_value("recrawl/unchanged", spider=self)
+            return
+        etag = response.headers.get("ETag")
+        yield {"url":response.url, "html":response.body, "encoding":response.encoding,
+            "content_language":None, "etag":etag.decode("latin1") if etag else None,
+            "last_modified":None, "fingerprint":fingerprint}
+
+@defer.inlineCallbacks
+def run(pages, changed) :
+    site = FixtureSite(pages)
+    stub = StubElasticsearch(latency=0.001).start()
+    es = Elasticsearch(stub.url)
+    start = "http://127.0.0.1:%d/0"%site.server.server_address[1]
+    runner = CrawlerRunner({
+        "ITEM_PIPELINES":{"pipelines.ContentExtractionPipeline":200, "pipelines.BulkIndexPipeline":300},
+        "SPIDER_MIDDLEWARES":{"recrawl.LinkRecorderMiddleware":100},
+        "DOWNLOADER_MIDDLEWARES":{"recrawl.ConditionalRequestMiddleware":600},
+        "CONTENT_WORKERS":1, "CONCURRENT_REQUESTS":32, "DOWNLOAD_DELAY":0, "ROBOTSTXT_OBEY":False,
+        "LOG_LEVEL":"WARNING", "TELNETCONSOLE_ENABLED":False})
+    print("%d pages, %d%% changed before the second crawl"%(pages, changed * 100))
+    print("%-8s %8s %12s %6s %10s %10s"%("crawl", "pages", "bytes", "304", "unchanged", "ES writes"))
+    for name in ("first", "second") :
+        if name == "second" :
+            site.changed = set(random.Random(0).sample(range(pages), int(pages * changed)))
+        crawler = runner.create_crawler(FixtureSpider)
+        yield runner.crawl(crawler, start_urls=[start], es_client=es, redis_conn=None)
+        stats = crawler.stats.get_stats()
+        print("%-8s %8d %12d %6d %10d %10d"%(name, stats.get("response_received_count", 0),
+            stats.get("downloader/response_bytes", 0), stats.get("recrawl/not_modified", 0),
+            stats.get("recrawl/unchanged", 0), stats.get("bulk_index/docs", 0)))
+    site.server.shutdown()
+    stub.stop()
+    reactor.stop()
+
+def main() :
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    changed = float(sys.argv[2]) if len(sys.argv) > 2 else 0.1
+    reactor.callWhenRunning(run, pages, changed)
+    reactor.run()
+
+if __name__ == "__main__" :
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Bytes per response and latency of /search before and after the stored
+fallback descriptions : the same synthetic pages (a third of them without
+meta description, bodies of a few hundred to a few thousand words) are
+indexed twice, without fallback description and searched with the full
+_source as before, and as indexed by the crawler now, searched with the
+fields of the results only (query.RESULT_FIELDS). Searches are the per
+domain searches of /search and the cursor pages, with the results
+formatted by search.py. Runs on the embedded backend (local_index.py),
+or on an Elasticsearch cluster with --es.
+Usage : python bench_search_payload.py [--docs 10000] [--queries 200] [--es <url>]
+"""
+
+import copy
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import url
+import query
+import document
+import search as searcher
+import local_index
+from bulk import BulkIndexer
+from bench_local_index import queries
+
+def pages(count, domains=300, vocabulary=20000, seed=0) :
+    """
+    Synthetic pages, bodies made of sentences of Zipf distributed words.
+    """
+    rand = np.random.default_rng(seed)
+    words = ["w%x"%i for i in range(vocabulary)]
+    cumulative = np.cumsum(1.0 / np.arange(1, vocabulary + 1))
+    cumulative /= cumulative[-1]
+    text = lambda n : " ".join(words[i] for i in np.searchsorted(cumulative, rand.random(n)))
+    for i in range(count) :
+        domain = "site%d.com"%(i % domains)
+        body = ". ".join(text(int(rand.integers(5, 30))) for _ in range(int(rand.integers(20, 200)))) + "."
+        yield "http://%s/page/%d"%(domain, i), {"url":"http://%s/page/%d"%(domain, i), "domain":domain,
+            "title":text(8), "description":text(25) if i % 3 else "", "body":body,
+            "weight":int(rand.integers(1, 4))}
+
+def without_source_filter(body) :
+    """
+    Request body as sent before : no _source filtering.
+    """
+    body = copy.deepcopy(body)
+    def strip(node) :
+        if isinstance(node, dict) :
+            node.pop("_source", None)
+            for value in node.values() :
+                strip(value)
+    strip(body)
+    return body
+
+def measure(es, index, expressions, before) :
+    """
+    p50 and p99 of the response bytes, the search time and the formatting
+    time of the per domain searches and the cursor pages.
+    """
+    results = {}
+    build = without_source_filter if before else (lambda body : body)
+    for name in ("per domain", "cursor") :
+        sizes, search_times, format_times = [], [], []
+        for expression in expressions :
+            body = build(query.expression_query(expression) if name == "per domain"
+                else query.cursor_expression_query(expression, 20))
+            begin = time.perf_counter()
+            response = es.search(index=index, body=body)
+            searched = time.perf_counter()
+            if name == "per domain" :
+                searcher.sort_results(response)
+            else :
+                [searcher.format_result(hit["_source"], hit.get("highlight")) for hit in response["hits"]["hits"]]
+            formatted = time.perf_counter()
+            sizes.append(len(json.dumps(response)))
+            search_times.append((searched - begin) * 1000)
+            format_times.append((formatted - searched) * 1000)
+        results[name] = [(np.percentile(values, 50), np.percentile(values, 99))
+            for values in (sizes, search_times, format_times)]
+    return results
+
+def main() :
+    parser = argparse.ArgumentParser(description="Response size and latency of /search searches.")
+    parser.add_argument("--docs", type=int, default=10000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--es", help="URL of an Elasticsearch cluster (default : embedded backend)")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="local_index_")
+    if args.es :
+        from elasticsearch import Elasticsearch
+        es = Elasticsearch(args.es, timeout=60)
+    else :
+        es = local_index.LocalClient(directory)
+    mapping = {"mappings":{"properties":{"domain":{"type":"keyword"}, "url":{"type":"keyword"},
+        "weight":{"type":"long"}, "fallback_description":{"type":"text", "index":False}}}}
+    indexer = BulkIndexer(es)
+    for index in ("bench-before", "bench-after") :
+        es.indices.delete(index=index, ignore=[404])
+        es.indices.create(index=index, body=mapping)
+    for doc_id, source in pages(args.docs) :
+        indexer.add("bench-before", doc_id, source)
+        source = dict(source, fallback_description=document.fallback_description(
+            url.create_description(source["body"])))
+        if indexer.add("bench-after", doc_id, source) :
+            indexer.flush_all()
+    indexer.flush_all()
+    es.indices.refresh(index="bench-*")
+
+    expressions = queries(args.queries)
+    print("%d pages, %d queries, %s"%(args.docs, args.queries, "Elasticsearch" if args.es else "embedded backend"))
+    print("%-10s %-7s %21s %21s %21s"%("search", "", "bytes p50 / p99", "search ms p50 / p99", "format ms p50 / p99"))
+    for name, index, before in (("before", "bench-before", True), ("after", "bench-after", False)) :
+        measure(es, index, expressions[:10], before) # warm up
+        for search, rows in measure(es, index, expressions, before).items() :
+            print("%-10s %-7s %10.0f / %8.0f %10.2f / %8.2f %10.2f / %8.2f"%(search, name,
+                rows[0][0], rows[0][1], rows[1][0], rows[1][1], rows[2][0], rows[2][1]))
+    for index in ("bench-before", "bench-after") :
+        es.indices.delete(index=index, ignore=[404])
+    shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == "__main__" :
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Load test of the Flask (index.py) and asynchronous (async_index.py) search
+servers against a local stub Elasticsearch (stub_es.py). Each server runs in
+its own process and receives POST /search requests from concurrent clients.
+Reports p50/p99 latency and requests per second.
+Usage : python bench_search_server.py [requests] [concurrency] [distinct_queries]
+With distinct_queries = 0 (default) every query is different (no cache hit).
+"""
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import subprocess
+import aiohttp
+
+def free_port() :
+    with socket.socket() as s :
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_port(port, timeout=30) :
+    limit = time.time() + timeout
+    while time.time() < limit :
+        try :
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError :
+            time.sleep(0.1)
+    raise RuntimeError("server on port %d did not start"%port)
+
+def start(command, port, env) :
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_port(port)
+    return process
+
+async def load(port, count, concurrency, distinct, prefix="query") :
+    """
+    Send count requests with concurrency clients, return sorted latencies and elapsed time.
+    """
+    latencies = []
+    queue = asyncio.Queue()
+    for i in range(count) :
+        queue.put_nowait("%s %d"%(prefix, i % distinct if distinct else i))
+
+    async def client(session) :
+        while not queue.empty() :
+            expression = queue.get_nowait()
+            begin = time.perf_counter()
+            async with session.post("http://127.0.0.1:%d/search"%port,
+                    data={"query":expression, "hits":"10"}) as response :
+                await response.read()
+                assert response.status == 200, response.status
+            latencies.append(time.perf_counter() - begin)
+
+    begin = time.perf_counter()
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session :
+        await asyncio.gather(*[client(session) for _ in range(concurrency)])
+    return sorted(latencies), time.perf_counter() - begin
+
+def report(name, latencies, elapsed) :
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print("%-8s p50 %7.1f ms   p99 %7.1f ms   %7.0f req/s"%(name, p50 * 1000, p99 * 1000,
+        len(latencies) / elapsed))
+
+def main() :
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    distinct = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+
+    es_port = free_port()
+    env = dict(os.environ, HOST="127.0.0.1", PORT=str(es_port), USERNAME="bench", PASSWORD="bench",
+        SEARCH_CACHE_REDIS="0")
+    processes = [start([sys.executable, "stub_es.py", str(es_port), "5"], es_port, env)]
+    try :
+        flask_port, async_port = free_port(), free_port()
+        processes.append(start([sys.executable, "-c",
+            "import index; index.app.run(host='127.0.0.1', port=%d, threaded=True)"%flask_port],
+            flask_port, env))
+        processes.append(start([sys.executable, "-m", "uvicorn", "async_index:app",
+            "--port", str(async_port), "--log-level", "warning"], async_port, env))
+
+        print("%d requests, %d clients, %s queries, 5 ms Elasticsearch latency"%(count, concurrency,
+            distinct or "distinct"))
+        for name, port in (("flask", flask_port), ("async", async_port)) :
+            asyncio.run(load(port, min(count, 100), concurrency, 0, "warm up"))
+            report(name, *asyncio.run(load(port, count, concurrency, distinct)))
+    finally :
+        for process in processes :
+            process.terminate()
+
+if __name__ == "__main__" :
+    main()
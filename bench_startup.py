@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Startup time of the modules of the search engine : each module is imported
+in a fresh interpreter, several times, and the median wall time is printed
+with the outcome of the import (a module whose dependencies or services are
+missing fails, the time until the failure is still shown). With --models,
+the time of the first embedding of each language model is measured too,
+the cost moved from the import to the first vector search (or to the
+warm-up of a server, WARM_UP=laser,bert).
+Usage : python bench_startup.py [runs] [--models]
+"""
+
+import os
+import sys
+import time
+import tempfile
+import statistics
+import subprocess
+
+MODULES = ["embeddings", "run_tests", "vectorize", "document", "pipelines", "crawler",
+    "scheduler", "async_index", "index"]
+
+def import_time(statement, env=None) :
+    """
+    Wall time of statement in a fresh interpreter, and its error if it failed.
+    """
+    begin = time.perf_counter()
+    process = subprocess.run([sys.executable, "-c", statement], capture_output=True,
+        text=True, env=env)
+    elapsed = time.perf_counter() - begin
+    error = None
+    if process.returncode != 0 :
+        lines = process.stderr.strip().splitlines()
+        error = lines[-1] if lines else "exit code %d"%process.returncode
+    return elapsed, error
+
+def measure(name, statement, runs, env=None) :
+    times, error = [], None
+    for _ in range(runs) :
+        elapsed, error = import_time(statement, env)
+        times.append(elapsed)
+    print("%-28s %8.1f ms  %s"%(name, statistics.median(times) * 1000, error or "ok"))
+
+def main() :
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else 5
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    print("median of %d runs, python %s"%(runs, sys.version.split()[0]))
+    measure("(interpreter)", "pass", runs)
+    for module in MODULES :
+        measure("import " + module, "import " + module, runs)
+    if "--models" in sys.argv :
+        # empty embedding cache : the model itself computes the vector
+        env = dict(os.environ, EMBEDDING_CACHE_DIR=tempfile.mkdtemp(prefix="embedding_cache_"))
+        for vector_type in ("laser_vector", "bert_vector") :
+            measure("first embed " + vector_type.split("_")[0],
+                "import embeddings; embeddings.embed(['startup'], '%s')"%vector_type, 1, env)
+
+if __name__ == "__main__" :
+    main()
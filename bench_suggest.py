@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Latency and memory of the type-ahead suggestions (suggest.py) on synthetic
+titles and queries : words of random letters (English letter frequencies)
+drawn from a Zipf law, titles of 2 to 8 words with Zipf distributed
+weights. Measured : the build of the suggestions, their memory, the
+completions of every prefix typed while entering popular suggestions
+(alone, then during a rebuild of the large level) and the updates of the
+small level by batches of new titles.
+Usage : python bench_suggest.py [--titles 500000] [--queries 50000] [--prefixes 20000]
+"""
+
+import time
+import argparse
+import threading
+import tracemalloc
+import numpy as np
+import suggest
+
+LETTERS = "etaoinshrdlcumwfgypbvkjxqz"
+FREQUENCIES = [12.7, 9.1, 8.2, 7.5, 7.0, 6.7, 6.3, 6.1, 6.0, 4.3, 4.0, 2.8, 2.8, 2.4, 2.4, 2.2,
+    2.0, 2.0, 1.9, 1.5, 1.0, 0.8, 0.15, 0.15, 0.1, 0.07]
+
+def texts(count, vocabulary=50000, low=2, high=9, seed=0) :
+    rand = np.random.default_rng(seed)
+    frequencies = np.asarray(FREQUENCIES) / sum(FREQUENCIES)
+    words = ["".join(rand.choice(list(LETTERS), size=int(rand.integers(2, 10)), p=frequencies))
+        for _ in range(vocabulary)]
+    cumulative = np.cumsum(1.0 / np.arange(1, vocabulary + 1))
+    cumulative /= cumulative[-1]
+    return [" ".join(words[i] for i in np.searchsorted(cumulative, rand.random(int(rand.integers(low, high)))))
+        for _ in range(count)]
+
+def typed_prefixes(suggester, count, seed=2) :
+    """
+    Every prefix of suggestions drawn by score, as typed by the users.
+    """
+    rand = np.random.default_rng(seed)
+    main = suggester.levels[0]
+    probabilities = np.asarray(main.scores, dtype=np.float64)
+    probabilities /= probabilities.sum()
+    prefixes = []
+    while len(prefixes) < count :
+        key = main.keys[int(rand.choice(len(main.keys), p=probabilities))]
+        prefixes.extend(key[:length] for length in range(1, len(key) + 1))
+    return prefixes[:count]
+
+def latencies(suggester, prefixes) :
+    times = np.empty(len(prefixes))
+    for i, prefix in enumerate(prefixes) :
+        begin = time.perf_counter()
+        suggester.complete(prefix)
+        times[i] = time.perf_counter() - begin
+    times *= 1e6
+    return np.percentile(times, 50), np.percentile(times, 99), times.max()
+
+def main() :
+    parser = argparse.ArgumentParser(description="Benchmark of the type-ahead suggestions.")
+    parser.add_argument("--titles", type=int, default=500000)
+    parser.add_argument("--queries", type=int, default=50000)
+    parser.add_argument("--prefixes", type=int, default=20000)
+    args = parser.parse_args()
+
+    # memory of the suggestions and their strings, without the inputs
+    tracemalloc.start()
+    rand = np.random.default_rng(1)
+    titles = [(title, float(score)) for title, score in
+        zip(texts(args.titles), rand.zipf(2.0, args.titles).clip(max=100))]
+    queries = [(query, int(count)) for query, count in
+        zip(texts(args.queries, low=1, high=4, seed=3), rand.zipf(1.5, args.queries).clip(max=10000))]
+
+    suggester = suggest.Suggester(max_entries=suggest.MAX_ENTRIES)
+    begin = time.perf_counter()
+    with suggester.lock :
+        suggester.titles.update(titles)
+        suggester.queries.update(queries)
+    suggester.merging.set()
+    suggester.merge()
+    elapsed = time.perf_counter() - begin
+    del titles, queries
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    main_level = suggester.levels[0]
+    print("%d suggestions (%d precomputed prefixes) built in %.2f s, %.1f MB"%(len(main_level),
+        len(main_level.tops), elapsed, memory / 2**20))
+
+    prefixes = typed_prefixes(suggester, args.prefixes)
+    latencies(suggester, prefixes[:1000]) # warm up
+    print("completion                p50 %6.1f us  p99 %6.1f us  max %7.1f us"%latencies(suggester, prefixes))
+
+    # new titles while the crawler writes, by batches of a bulk request
+    new_titles = texts(20 * 100, seed=4)
+    times = []
+    for batch in range(20) :
+        begin = time.perf_counter()
+        suggester.update([(title, 5.0) for title in new_titles[batch*100:(batch+1)*100]])
+        times.append(time.perf_counter() - begin)
+    times = np.asarray(times) * 1000
+    print("update of 100 titles      p50 %6.2f ms  max %6.2f ms (%d in the small level)"%(
+        np.percentile(times, 50), times.max(), len(suggester.levels[2])))
+    print("completion with updates   p50 %6.1f us  p99 %6.1f us  max %7.1f us"%latencies(suggester, prefixes))
+
+    # completions while the large level is rebuilt in another thread
+    suggester.merging.set()
+    rebuild = threading.Thread(target=suggester.merge)
+    rebuild.start()
+    during = latencies(suggester, prefixes[:5000])
+    rebuild.join()
+    print("completion during merge   p50 %6.1f us  p99 %6.1f us  max %7.1f us"%during)
+
+if __name__ == "__main__" :
+    main()
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Search quality and latency benchmark of the search types of run_tests.py.
+The corpus is a snapshot of the web-en index (mapping and documents with
+their vectors, gzipped ndjson) restored in Elasticsearch before a run, so
+every run searches the same documents. Each query is embedded then searched
+separately and timed, the results are scored against a relevance file and
+everything is written as JSON, so two runs can be compared.
+Usage :
+python benchmark.py snapshot <file> [--index web-en]
+python benchmark.py restore <file> [--index web-en]
+python benchmark.py run [--queries Recipes.csv] [--relevance <csv>] [--types term,bert-hybrid,...]
+                        [--k 10] [--cold] [--snapshot <file>] [--output <json>]
+python benchmark.py compare <old json> <new json> [--tolerance 0.1]
+The relevance file is a CSV with columns query, id (document url) and grade
+(0 : not relevant to 3 : perfect).
+"""
+
+import os
+import sys
+import gzip
+import json
+import math
+import time
+import hashlib
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+from elasticsearch import helpers
+
+__author__ = "Bijin Benny"
+__email__ = "bijin@ualberta.ca"
+__license__ = "MIT"
+__version__ = "1.0"
+
+"""
+snapshot function writes the mapping and every document of an index to a
+gzipped ndjson file : first line the mapping, then one {"_id", "_source"}
+per line, sorted by id. Returns the number of documents and the checksum
+of the corpus.
+Arguments :
+es       : Elasticsearch client
+filename : Snapshot file
+index    : Index name
+"""
+def snapshot(es,filename,index="web-en"):
+    mapping = es.indices.get_mapping(index=index)[index]["mappings"]
+    docs = sorted(((hit["_id"], hit["_source"]) for hit in helpers.scan(es,index=index,
+        query={"query":{"match_all":{}}})), key=lambda doc: doc[0])
+    checksum = hashlib.sha1()
+    with gzip.open(filename,"wt",encoding="utf8") as f:
+        f.write(json.dumps({"index":index,"mappings":mapping})+"\n")
+        for doc_id, source in docs:
+            line = json.dumps({"_id":doc_id,"_source":source},sort_keys=True)
+            checksum.update(line.encode("utf8"))
+            f.write(line+"\n")
+    return len(docs), checksum.hexdigest()
+
+"""
+restore function replaces an index by the content of a snapshot file and
+returns the number of documents and the checksum of the corpus. The local
+vector indexes must be rebuilt afterwards (python vector_index.py build <type>).
+Arguments :
+es       : Elasticsearch client
+filename : Snapshot file
+index    : Index name
+"""
+def restore(es,filename,index="web-en"):
+    from bulk import BulkIndexer
+    indexer = BulkIndexer(es)
+    checksum = hashlib.sha1()
+    count = 0
+    with gzip.open(filename,"rt",encoding="utf8") as f:
+        header = json.loads(f.readline())
+        es.indices.delete(index=index,ignore=[404])
+        es.indices.create(index=index,body={"settings":{"number_of_shards":1,
+            "number_of_replicas":0},"mappings":header["mappings"]})
+        for line in f:
+            checksum.update(line.rstrip("\n").encode("utf8"))
+            doc = json.loads(line)
+            count += 1
+            if indexer.add(index,doc["_id"],doc["_source"]):
+                failed = indexer.flush(index)
+                if failed:
+                    sys.exit("Restore failed : "+str(failed[0][1]))
+        failed = indexer.flush_all()
+        if failed:
+            sys.exit("Restore failed : "+str(failed[0][1]))
+    es.indices.refresh(index=index)
+    return count, checksum.hexdigest()
+
+"""
+corpusInfo function returns the description of the corpus of a run : number
+of documents of the index, and checksum of the snapshot file if any.
+"""
+def corpusInfo(es,index="web-en",filename=None):
+    info = {"index":index,"docs":es.count(index=index)["count"]}
+    if filename:
+        checksum = hashlib.sha1()
+        with gzip.open(filename,"rt",encoding="utf8") as f:
+            f.readline()
+            for line in f:
+                checksum.update(line.rstrip("\n").encode("utf8"))
+        info.update(snapshot=os.path.basename(filename),checksum=checksum.hexdigest())
+    return info
+
+"""
+loadRelevance function reads a relevance file into a dictionary
+query -> {document id : grade}.
+"""
+def loadRelevance(filename):
+    judgments = {}
+    for row in pd.read_csv(filename).itertuples(index=False):
+        judgments.setdefault(row.query,{})[row.id] = int(row.grade)
+    return judgments
+
+"""
+recallAt function returns the ratio of the relevant documents (grade > 0)
+of a query found in its top k results.
+"""
+def recallAt(ranked_ids,grades,k):
+    relevant = set(doc_id for doc_id, grade in grades.items() if grade > 0)
+    if(len(relevant) == 0):
+        return None
+    return len(relevant.intersection(ranked_ids[:k]))/len(relevant)
+
+"""
+ndcgAt function returns the normalized discounted cumulative gain of the top
+k results of a query (gain 2^grade - 1).
+"""
+def ndcgAt(ranked_ids,grades,k):
+    dcg = lambda gains: sum((2**g-1)/math.log2(i+2) for i, g in enumerate(gains))
+    ideal = dcg(sorted(grades.values(),reverse=True)[:k])
+    if(ideal == 0):
+        return None
+    return dcg([grades.get(doc_id,0) for doc_id in ranked_ids[:k]])/ideal
+
+"""
+percentiles function summarizes a list of durations in milliseconds.
+"""
+def percentiles(durations):
+    values = np.asarray(durations)*1000
+    return {"mean":float(values.mean()),"p50":float(np.percentile(values,50)),
+        "p90":float(np.percentile(values,90)),"p99":float(np.percentile(values,99)),
+        "max":float(values.max())}
+
+"""
+runType function runs every query with a search type, one at a time, and
+returns its timings, metrics and ranked results.
+Arguments :
+search_type : Type of search technique (see run_tests.SEARCH_TYPES)
+queries     : List of queries
+judgments   : Relevance judgments (see loadRelevance), may be empty
+k           : Number of results per query
+"""
+def runType(search_type,queries,judgments,k):
+    import run_tests
+    embed_times, search_times, total_times = [], [], []
+    recalls, ndcgs, per_query = [], [], []
+    leg_start = dict((name, len(times)) for name, times in run_tests.LEG_TIMES.items())
+    for query in queries:
+        begin = time.perf_counter()
+        query_vectors = run_tests.embedQueries([query],search_type)
+        embedded = time.perf_counter()
+        hits = run_tests.searchQueries([query],query_vectors,search_type,k)[0]
+        end = time.perf_counter()
+        embed_times.append(embedded-begin)
+        search_times.append(end-embedded)
+        total_times.append(end-begin)
+
+        ranked_ids = [hit['_id'] for hit in hits]
+        result = {"query":query,"ids":ranked_ids,"embed_ms":(embedded-begin)*1000,
+            "search_ms":(end-embedded)*1000}
+        if query in judgments:
+            result["recall"] = recallAt(ranked_ids,judgments[query],k)
+            result["ndcg"] = ndcgAt(ranked_ids,judgments[query],k)
+            if result["recall"] is not None:
+                recalls.append(result["recall"])
+            if result["ndcg"] is not None:
+                ndcgs.append(result["ndcg"])
+        per_query.append(result)
+
+    #Latency of each leg of the hybrid searches, one query per batch here
+    legs = dict((name+"_ms", percentiles(np.asarray(times[leg_start[name]:])/1000))
+        for name, times in run_tests.LEG_TIMES.items() if len(times) > leg_start[name])
+    return {
+        "queries":len(queries),
+        "embed_ms":percentiles(embed_times),
+        "search_ms":percentiles(search_times),
+        "total_ms":percentiles(total_times),
+        "recall@%d"%k:float(np.mean(recalls)) if recalls else None,
+        "ndcg@%d"%k:float(np.mean(ndcgs)) if ndcgs else None,
+        "judged":len(recalls),
+        "legs":legs,
+        "per_query":per_query
+    }
+
+"""
+compareRuns function prints the differences between two result files and
+returns the list of regressions : latency p50/p90 higher by more than
+tolerance (ratio), recall or nDCG lower by more than tolerance/10.
+"""
+def compareRuns(old,new,tolerance=0.1):
+    regressions = []
+    print("%-14s %-22s %12s %12s %9s"%("type","measure","old","new","change"))
+    for search_type in sorted(set(old["types"]).intersection(new["types"])):
+        before, after = old["types"][search_type], new["types"][search_type]
+        measures = [(timing+" "+p, before[timing][p], after[timing][p], True)
+            for timing in ("embed_ms","search_ms","total_ms") for p in ("p50","p90","p99")]
+        measures += [(metric, before.get(metric), after.get(metric), False)
+            for metric in before if metric.startswith(("recall@","ndcg@"))]
+        for name, a, b, is_latency in measures:
+            if a is None or b is None:
+                continue
+            change = (b-a)/a if a else 0.0
+            if is_latency:
+                regressed = name.split()[1] != "p99" and a > 0.01 and change > tolerance
+            else:
+                regressed = a-b > tolerance/10
+            if regressed:
+                regressions.append((search_type,name))
+            print("%-14s %-22s %12.3f %12.3f %+8.1f%%%s"%(search_type,name,a,b,change*100,
+                "  <- regression" if regressed else ""))
+    return regressions
+
+def main():
+    import run_tests
+    parser = argparse.ArgumentParser(description="Search quality and latency benchmark.")
+    commands = parser.add_subparsers(dest="command")
+    for name in ("snapshot","restore"):
+        command = commands.add_parser(name)
+        command.add_argument("filename")
+        command.add_argument("--index",default="web-en")
+    run = commands.add_parser("run")
+    run.add_argument("--queries",default="Recipes.csv",help="CSV file with a Recipe column")
+    run.add_argument("--relevance",help="CSV file with query, id and grade columns")
+    run.add_argument("--types",default="term,laser,bert",help="comma separated search types")
+    run.add_argument("--k",type=int,default=10)
+    run.add_argument("--cold",action="store_true",help="empty embedding cache : time the models")
+    run.add_argument("--snapshot",help="snapshot file restored for this run (recorded in the results)")
+    run.add_argument("--output",default="benchmark_%s.json"%time.strftime("%Y%m%d_%H%M%S"))
+    compare = commands.add_parser("compare")
+    compare.add_argument("old")
+    compare.add_argument("new")
+    compare.add_argument("--tolerance",type=float,default=0.1)
+    args = parser.parse_args()
+
+    if(args.command == "snapshot"):
+        count, checksum = snapshot(run_tests.client,args.filename,args.index)
+        print("%d documents written to %s (sha1 %s)"%(count,args.filename,checksum))
+    elif(args.command == "restore"):
+        count, checksum = restore(run_tests.client,args.filename,args.index)
+        print("%d documents restored in %s (sha1 %s)"%(count,args.index,checksum))
+        print("Rebuild the local vector indexes : python vector_index.py build <type>")
+    elif(args.command == "run"):
+        types = [t.strip().lower() for t in args.types.split(",")]
+        for search_type in types:
+            if(search_type not in run_tests.SEARCH_TYPES):
+                sys.exit("Unknown search type "+search_type+", valid : "+", ".join(run_tests.SEARCH_TYPES))
+        queries = list(pd.read_csv(args.queries)["Recipe"])
+        judgments = loadRelevance(args.relevance) if args.relevance else {}
+        results = {"date":time.strftime("%Y-%m-%dT%H:%M:%S"),"k":args.k,"cold":args.cold,
+            "corpus":corpusInfo(run_tests.client,filename=args.snapshot),"types":{}}
+        for search_type in types:
+            results["types"][search_type] = runType(search_type,queries,judgments,args.k)
+            summary = results["types"][search_type]
+            print("%-12s embed p50 %7.2f ms  search p50 %7.2f ms p99 %7.2f ms  recall@%d %s  ndcg@%d %s"%(
+                search_type,summary["embed_ms"]["p50"],summary["search_ms"]["p50"],
+                summary["search_ms"]["p99"],args.k,summary["recall@%d"%args.k],args.k,
+                summary["ndcg@%d"%args.k]))
+            for leg, timings in summary["legs"].items():
+                print("%-12s %s p50 %7.2f ms p99 %7.2f ms"%("",leg.replace("_ms"," leg"),
+                    timings["p50"],timings["p99"]))
+        with open(args.output,"w") as f:
+            json.dump(results,f,indent=1)
+        print("Results written to "+args.output)
+    elif(args.command == "compare"):
+        with open(args.old) as f:
+            old = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        if(old["corpus"] != new["corpus"]):
+            print("Warning : the runs did not search the same corpus")
+        regressions = compareRuns(old,new,args.tolerance)
+        sys.exit(1 if regressions else 0)
+    else:
+        parser.print_help()
+
+if __name__ == "__main__":
+    if(len(sys.argv) > 1 and sys.argv[1] == "run" and "--cold" in sys.argv):
+        #Fresh embedding cache, set before embeddings.py is imported
+        os.environ["EMBEDDING_CACHE_DIR"] = tempfile.mkdtemp(prefix="embedding_cache_")
+    main()
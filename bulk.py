@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Buffered bulk writer for Elasticsearch.
+Documents are collected per index and sent with the bulk API once a
+size, byte or time threshold is reached. Items rejected by Elasticsearch
+with a transient status (overload, unavailable) are retried with backoff.
+"""
+
+import json
+import time
+import logging
+from elasticsearch import TransportError
+
+# statuses worth retrying : queue full / node temporarily unavailable
+RETRY_STATUSES = (429, 502, 503, 504)
+
+class BulkIndexer(object):
+    """
+    Collect documents per index and flush them through the bulk API.
+    """
+
+    def __init__(self, es, max_docs=500, max_bytes=5*1024*1024, max_interval=5.0,
+            max_retries=3, retry_backoff=0.5) :
+        self.es = es
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.max_interval = max_interval
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.buffers = {}  # index -> list of (action line, source line)
+        self.sizes = {}    # index -> buffered bytes
+        self.started = {}  # index -> time of the first buffered document
+        self.stats = {"docs":0, "requests":0, "retries":0, "failed":0}
+
+    def add(self, index, doc_id, source, op_type="index") :
+        """
+        Buffer one document.
+        Return True if the buffer of this index reached a threshold and must be flushed.
+        """
+        action = json.dumps({op_type:{"_index":index, "_id":doc_id}})
+        if op_type == "update" :
+            source = {"doc":source}
+        source = json.dumps(source)
+        if index not in self.buffers :
+            self.buffers[index] = []
+            self.sizes[index] = 0
+            self.started[index] = time.time()
+        self.buffers[index].append((action, source))
+        self.sizes[index] += len(action) + len(source) + 2
+        return len(self.buffers[index]) >= self.max_docs or self.sizes[index] >= self.max_bytes
+
+    def expired(self) :
+        """
+        List of indices whose oldest buffered document waited longer than max_interval.
+        """
+        now = time.time()
+        return [index for index, started in self.started.items()
+            if now - started >= self.max_interval]
+
+    def take(self, index) :
+        """
+        Remove and return the buffered actions of an index.
+        """
+        self.sizes.pop(index, None)
+        self.started.pop(index, None)
+        return self.buffers.pop(index, [])
+
+    def flush(self, index) :
+        """
+        Send the buffered documents of one index.
+        """
+        return self.send(self.take(index))
+
+    def flush_all(self) :
+        """
+        Send the buffered documents of every index.
+        """
+        failed = []
+        for index in list(self.buffers) :
+            failed.extend(self.flush(index))
+        return failed
+
+    def send(self, actions) :
+        """
+        Send a list of actions with the bulk API, retrying transient failures.
+        Return the list of (action, error) that could not be written.
+        """
+        failed = []
+        attempt = 0
+        while actions :
+            body = "\n".join(line for pair in actions for line in pair) + "\n"
+            retry = []
+            try :
+                self.stats["requests"] += 1
+                response = self.es.bulk(body=body)
+            except TransportError as e :
+                # connection errors have no HTTP status, they are retried
+                status = getattr(e, "status_code", None)
+                if isinstance(status, int) and status not in RETRY_STATUSES :
+                    failed.extend((pair, str(e)) for pair in actions)
+                    break
+                retry = [(pair, str(e)) for pair in actions]
+            else :
+                for pair, item in zip(actions, response["items"]) :
+                    result = next(iter(item.values()))
+                    status = result.get("status", 500)
+                    if status < 300 :
+                        self.stats["docs"] += 1
+                    elif status in RETRY_STATUSES :
+                        retry.append((pair, result.get("error")))
+                    else :
+                        failed.append((pair, result.get("error")))
+            if not retry :
+                break
+            attempt += 1
+            if attempt > self.max_retries :
+                failed.extend(retry)
+                break
+            self.stats["retries"] += len(retry)
+            time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+            actions = [pair for pair, _ in retry]
+
+        self.stats["failed"] += len(failed)
+        for pair, error in failed :
+            logging.error("bulk indexing failed for %s : %s"%(pair[0], error))
+        return failed
@@ -9,18 +9,73 @@ import base64
 import io
 from scrapy.spiders import CrawlSpider, Rule
 from scrapy.linkextractors import LinkExtractor
-from scrapy.http import Request
+from scrapy.http import Request, HtmlResponse
+import recrawl
 from language import languages
 from collections import Counter
 from rq.decorators import job
 from rq import Queue
-from elasticsearch import Elasticsearch
+import threading
+import backend
 
 host = os.getenv("HOST")
 user = os.getenv("USERNAME")
 pwd  = os.getenv("PASSWORD")
 port = os.getenv("PORT")
-client = Elasticsearch(hosts="http://"+user+":"+pwd+"@"+host+":"+port+"/")
+client = None
+client_lock = threading.Lock()
+
+def get_client() :
+    """
+    Elasticsearch client of the explorations, created on first use.
+    """
+    global client
+    with client_lock :
+        if client is None :
+            client = backend.create_client(hosts="http://"+user+":"+pwd+"@"+host+":"+port+"/")
+    return client
+
+# Scrapy settings of an exploration
+SETTINGS = {
+    'USER_AGENT': "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 \
+    (KHTML, like Gecko) Chrome/55.0.2883.75 Safari/537.36",
+    'DOWNLOAD_TIMEOUT':100,
+    'DOWNLOAD_DELAY':0.25,
+    'ROBOTSTXT_OBEY':True,
+    'HTTPCACHE_ENABLED':False,
+    'REDIRECT_ENABLED':False,
+    'SPIDER_MIDDLEWARES' : {
+    'scrapy.downloadermiddlewares.robotstxt.RobotsTxtMiddleware':True,
+    'scrapy.spidermiddlewares.httperror.HttpErrorMiddleware':True,
+    'scrapy.downloadermiddlewares.httpcache.HttpCacheMiddleware':True,
+    'scrapy.extensions.closespider.CloseSpider':True,
+    # before the offsite filter (500) : links to other websites are recorded
+    'recrawl.LinkRecorderMiddleware':600
+    },
+    # pages already indexed are fetched with conditional requests (recrawl.py)
+    'DOWNLOADER_MIDDLEWARES' : {
+    'recrawl.ConditionalRequestMiddleware':600
+    },
+    'ITEM_PIPELINES' : {
+    'pipelines.ContentExtractionPipeline':200,
+    'pipelines.NearDuplicatePipeline':250,
+    'pipelines.BulkIndexPipeline':300
+    },
+    'NEAR_DUPLICATE_ACTION':'drop',
+    'NEAR_DUPLICATE_DISTANCE':3,
+    'CONTENT_WORKERS':0, # default : number of cores
+    'CONTENT_MAX_PENDING':64,
+    'BULK_INDEX_MAX_DOCS':500,
+    'BULK_INDEX_MAX_BYTES':5*1024*1024,
+    'BULK_INDEX_MAX_INTERVAL':5.0,
+    'BULK_INDEX_MAX_RETRIES':3,
+    # persistent frontier in Redis, see frontier.py
+    'SCHEDULER':'frontier.FrontierScheduler',
+    'FRONTIER_RECRAWL_AFTER':86400,
+    'FRONTIER_BLOOM_CAPACITY':1000000,
+    'FRONTIER_BLOOM_ERROR_RATE':0.001,
+    'CLOSESPIDER_PAGECOUNT':500 #only for debug
+}
 
 
 class Crawler(scrapy.spiders.CrawlSpider):
@@ -29,7 +84,8 @@ class Crawler(scrapy.spiders.CrawlSpider):
     """
 
     name = 'crawler'
-    handle_httpstatus_list = [301, 302, 303] # redirection allowed
+    languages = languages # supported languages, see pipelines.ContentExtractionPipeline
+    handle_httpstatus_list = [301, 302, 303, 304] # redirection and not modified allowed
     rules = (
         # Extract all inner domain links with state "follow"
         Rule(LinkExtractor(), callback='parse_items', follow=True, process_links='links_processor'),
@@ -49,63 +105,73 @@ class Crawler(scrapy.spiders.CrawlSpider):
                     ret_links.append(link)
         return ret_links
 
+    def parse_page(self, response):
+        """
+        Callback of the requests built out of the rule (see follow) : the
+        same processing, the page items then the links to follow.
+        """
+        yield from self.parse_items(response)
+        if isinstance(response, HtmlResponse):
+            for link in self.links_processor(self.rules[0].link_extractor.extract_links(response)):
+                yield self.follow(link.url)
+
+    def follow(self, url):
+        """
+        Request of a link followed outside of the rule (stored with a page not modified).
+        """
+        return Request(url, callback=self.parse_page)
+
     def parse_items(self, response):
         """
         Parse and analyze one url of website.
         """
-        yield pipeline(response, self)
+        yield from pipeline(response, self)
+
+def header(response, name) :
+    value = response.headers.get(name)
+    return value.decode("latin1") if value else None
 
 def pipeline(response, spider) :
     """
-    Index a page.
+    Yield the downloaded page (analyzed out of the reactor by
+    pipelines.ContentExtractionPipeline, then written in bulk by
+    pipelines.BulkIndexPipeline), then the redirection request if any.
     """
+    # not modified since the last exploration : follow the links stored with the page
+    validators = response.meta.get("validators") or {}
+    if response.status == 304 :
+        for link in validators.get("links", []) :
+            yield spider.follow(link)
+        return
+
     # skip rss or atom urls
-    if not response.css("html").extract_first() :
+    if not isinstance(response, HtmlResponse) :
         return
 
-    # get domain
-    domain = url.domain(response.url)
-
-    # extract title
-    title = response.css('title::text').extract_first()
-    title = title.strip() if title else ""
-
-    # extract description
-    description = response.css("meta[name=description]::attr(content)").extract_first()
-    description = description.strip() if description else ""
-
-    # get main language of page, and main content of page
-    lang = url.detect_language(response.body)
-    if lang not in languages :
-        raise InvalidUsage('Language not supported')
-    body, boilerplate = url.extract_content(response.body, languages.get(lang))
-
-    # weight of page
-    weight = 3
-    if not title and not description :
-        weight = 0
-    elif not title :
-        weight = 1
-    elif not description :
-        weight = 2
-    if body.count(" ") < boilerplate.count(" ") or not url.create_description(body) :
-        # probably bad content quality
-        weight -= 1
-
-    res = spider.es_client.index(index="web-%s"%lang, id=response.url, body={
-        "url":response.url,
-        "domain":domain,
-        "title":title,
-        "description":description,
-        "body":body,
-        "weight":weight
-    })
+    # same content as the indexed page : nothing to analyze (links are followed by the rules)
+    page_fingerprint = recrawl.fingerprint(response.body)
+    if validators.get("fingerprint") == page_fingerprint :
+        spider.crawler.stats.inc_value("recrawl/unchanged", spider=spider)
+        return
 
+    page = {
+        "url":response.url,
+        "html":response.body,
+        "encoding":response.encoding,
+        "content_language":response.headers.get("Content-Language"),
+        "etag":header(response, "ETag"),
+        "last_modified":header(response, "Last-Modified"),
+        "fingerprint":page_fingerprint
+    }
+    # static rank of the page until pagerank.py runs again
+    if validators.get("pagerank") :
+        page["pagerank"] = validators["pagerank"]
+    yield page
 
     if response.status in spider.handle_httpstatus_list and 'Location' in response.headers:
         newurl = response.headers['Location']
         meta = {'dont_redirect': True, "handle_httpstatus_list" : spider.handle_httpstatus_list}
         meta.update(response.request.meta)
-        return Request(url = newurl.decode("utf8"), meta = meta, callback=spider.parse)
+        yield Request(url = newurl.decode("utf8"), meta = meta, callback=spider.parse)
 
 
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Near-duplicate detection of pages.
+The main content of a page gets a 64 bits SimHash signature : pages whose
+signatures differ by at most a few bits share most of their text. The
+signatures of the pages of a crawl are kept in an LSH index (banding) so
+a lookup only compares a page to the few pages sharing a band with it.
+Signatures are indexed with the pages (hexadecimal, see encode) : the LSH
+index of the next crawl of a website starts with them.
+"""
+
+import re
+import hashlib
+import numpy as np
+
+BITS = 64
+# max number of different bits between near-duplicates
+DISTANCE = 3
+# min number of shingles of a text to get a meaningful signature
+MIN_SHINGLES = 20
+
+def shingles(text, size=3) :
+    words = re.findall(r"\w+", text.lower())
+    return [" ".join(words[i:i+size]) for i in range(max(0, len(words) - size + 1))]
+
+def simhash(text) :
+    """
+    SimHash of the word 3-grams of a text, None if the text is too short.
+    """
+    features = shingles(text)
+    if len(features) < MIN_SHINGLES :
+        return None
+    digests = b"".join(hashlib.blake2b(feature.encode("utf8"), digest_size=8).digest()
+        for feature in features)
+    # bit i of the signature is set when most features have their bit i set
+    bits = np.unpackbits(np.frombuffer(digests, dtype=np.uint8).reshape(-1, BITS // 8), axis=1,
+        bitorder="little")
+    majority = bits.sum(axis=0) * 2 > len(features)
+    return int.from_bytes(np.packbits(majority, bitorder="little").tobytes(), "little")
+
+def encode(signature) :
+    """
+    Signature as stored in the index (64 bits do not fit a signed long).
+    """
+    return "%016x"%signature
+
+def decode(value) :
+    return int(value, 16)
+
+def distance(a, b) :
+    return bin(a ^ b).count("1")
+
+class SimHashIndex(object):
+    """
+    LSH index of SimHash signatures : with distance + 1 bands, two
+    signatures at most distance bits apart share at least one band.
+    """
+
+    def __init__(self, distance=DISTANCE) :
+        self.distance = distance
+        self.bands = distance + 1
+        self.width = BITS // self.bands
+        self.buckets = [{} for _ in range(self.bands)]
+        self.size = 0
+
+    def _bands(self, signature) :
+        mask = (1 << self.width) - 1
+        return [(signature >> (band * self.width)) & mask for band in range(self.bands)]
+
+    def find(self, signature, ignore=None) :
+        """
+        Key of an indexed near-duplicate of signature, None if there is none
+        (the signatures added with the key ignore are skipped).
+        """
+        for band, value in enumerate(self._bands(signature)) :
+            for other, key in self.buckets[band].get(value, ()) :
+                if key != ignore and distance(signature, other) <= self.distance :
+                    return key
+        return None
+
+    def add(self, signature, key) :
+        for band, value in enumerate(self._bands(signature)) :
+            self.buckets[band].setdefault(value, []).append((signature, key))
+        self.size += 1
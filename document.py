@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Analysis of a page from a single lxml tree.
+The title, the meta description, the visible text used for language
+detection and the jusText paragraphs are all derived from one parsed
+document, instead of parsing the HTML again at each step.
+"""
+
+import lxml.html
+import url
+import dedup
+import metrics
+import language_id
+from justext.core import preprocessor, ParagraphMaker
+
+# max length of the description stored for pages without meta description
+FALLBACK_DESCRIPTION_LENGTH = 300
+
+class Document(object):
+    """
+    One page, parsed once.
+    root : lxml tree of the page (for a Scrapy response, response.selector.root,
+    the tree also used by the link extractor)
+    """
+
+    def __init__(self, root) :
+        self.root = root
+        self._paragraphs = None
+
+    @classmethod
+    def parse(cls, html, encoding="utf8") :
+        """
+        Document of an HTML page (bytes or text).
+        """
+        if isinstance(html, str) :
+            html = html.encode(encoding, "replace")
+        try :
+            root = lxml.html.document_fromstring(html,
+                parser=lxml.html.HTMLParser(encoding=encoding, recover=True))
+        except lxml.etree.ParserError :
+            root = None # empty document
+        return cls(root)
+
+    def _first(self, path) :
+        if self.root is None :
+            return ""
+        values = self.root.xpath(path)
+        return values[0].strip() if values else ""
+
+    @property
+    def title(self) :
+        return self._first("//title/text()")
+
+    @property
+    def description(self) :
+        return self._first("//meta[@name='description']/@content")
+
+    @property
+    def paragraphs(self) :
+        """
+        jusText paragraphs of the page, not classified yet.
+        """
+        if self._paragraphs is None :
+            self._paragraphs = []
+            if self.root is not None :
+                body = self.root.find("body")
+                # preprocessor cleans a copy : the tree stays usable by the link extractor
+                self._paragraphs = ParagraphMaker.make_paragraphs(
+                    preprocessor(body if body is not None else self.root))
+        return self._paragraphs
+
+    @property
+    def text(self) :
+        """
+        Visible text of the page (scripts, styles and forms removed).
+        """
+        return "\n".join(p.text for p in self.paragraphs)
+
+    def language_sample(self, length=language_id.MAX_TEXT_LENGTH) :
+        """
+        First characters of the main text of the page, paragraphs of at least
+        6 words (not navigation links) first.
+        """
+        sample = []
+        size = 0
+        for long_paragraphs in (True, False) :
+            for p in self.paragraphs :
+                if (p.text.count(" ") >= 5) == long_paragraphs :
+                    sample.append(p.text)
+                    size += len(p.text) + 1
+                    if size >= length :
+                        return "\n".join(sample)[:length]
+        return "\n".join(sample)
+
+    def detect_language(self, content_language=None) :
+        """
+        Main language of the page and confidence, from its lang attribute,
+        the Content-Language header or a sample of its text (see language_id).
+        """
+        declared = (self.root.get("lang") if self.root is not None else None, content_language)
+        return language_id.detect(self.language_sample, self.title, declared)
+
+    def extract_content(self) :
+        """
+        Main text content and boilerplate of the page, same split as
+        url.extract_content : paragraphs of at least 6 words are content.
+        """
+        body = []
+        boilerplate = []
+        for p in self.paragraphs :
+            if p.text.count(" ") >= 5 :
+                body.append(p.text)
+            else :
+                boilerplate.append(p.text)
+        return ". ".join(body), ". ".join(boilerplate)
+
+def fallback_description(sentence) :
+    """
+    Description shown for pages without meta description : the sentence of
+    url.create_description, cut at a word boundary.
+    """
+    sentence = (sentence or "").strip()
+    if len(sentence) > FALLBACK_DESCRIPTION_LENGTH :
+        sentence = sentence[:FALLBACK_DESCRIPTION_LENGTH].rsplit(" ", 1)[0]
+    return sentence
+
+def analyze(link, html, encoding="utf8", content_language=None) :
+    """
+    Analyze a downloaded page (CPU bound, run in the worker processes of
+    pipelines.ContentExtractionPipeline).
+    Return the language of the page and the document to index, with the
+    SimHash signature of its main content (see dedup.py) and the duration
+    of each step (recorded by the crawler, see metrics.py).
+    """
+    clock = metrics.Stopwatch()
+    document = Document.parse(html, encoding)
+    title = document.title
+    description = document.description
+    clock.lap("parse")
+
+    # get main language of page, and main content of page
+    lang = document.detect_language(content_language)[0]
+    clock.lap("language")
+    body, boilerplate = document.extract_content()
+    clock.lap("boilerplate")
+    fallback = url.create_description(body)
+    clock.lap("description")
+    signature = dedup.simhash(body)
+    clock.lap("simhash")
+
+    # weight of page
+    weight = 3
+    if not title and not description :
+        weight = 0
+    elif not title :
+        weight = 1
+    elif not description :
+        weight = 2
+    if body.count(" ") < boilerplate.count(" ") or not fallback :
+        # probably bad content quality
+        weight -= 1
+
+    return lang, {
+        "index":"web-%s"%lang,
+        "id":link,
+        "simhash":signature,
+        "timings":clock.laps,
+        "source":{
+            "url":link,
+            "domain":url.domain(link),
+            "title":title,
+            "description":description,
+            "fallback_description":fallback_description(fallback),
+            "body":body,
+            "weight":weight
+        }
+    }
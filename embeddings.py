@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Sentence embeddings shared by vectorize.py and run_tests.py.
+LASER vectors (1024 dimensions) are computed locally, BERT vectors (768
+dimensions) by the local bert-as-service server. Every embedding is kept
+in a persistent on-disk cache keyed by a hash of the text, so a text is
+only sent to a model once, whatever the number of runs.
+"""
+
+import os
+import fcntl
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+
+LASER = 'laser_vector'
+BERT  = 'bert_vector'
+DIMS  = {LASER : 1024, BERT : 768}
+MODELS = {LASER : 'laser', BERT : 'bert'}
+
+#Root directory of the embedding caches
+CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", ".embedding_cache")
+
+#Instance of the LASER language model and client connection to the local BERT
+#server, created on first use (see getModel) : importing this module loads nothing
+models = {}
+models_lock = threading.Lock()
+
+KEY_SIZE = 16
+
+class EmbeddingCache(object):
+    """
+    Persistent cache of embeddings for one model and vector type.
+    Vectors are stored in a memory-mapped float32 file, one row per text, and
+    the text hashes in an append-only file whose record order gives the row.
+    A bounded LRU dictionary keeps the most recently used vectors in memory.
+    Several processes may share a cache directory : appends are done under
+    an exclusive file lock. Threads share an instance : its state is
+    guarded by a lock, the texts are encoded out of it.
+    """
+
+    def __init__(self, model, vector_type, dim, directory=CACHE_DIR, lru_size=10000) :
+        self.dim = dim
+        self.directory = os.path.join(directory, model, vector_type)
+        os.makedirs(self.directory, exist_ok=True)
+        self.vectors_path = os.path.join(self.directory, "vectors.f32")
+        self.keys_path = os.path.join(self.directory, "keys.bin")
+        self.lock_path = os.path.join(self.directory, "lock")
+        self.rows = {}
+        self.loaded = 0 # bytes of the keys file already loaded
+        self.vectors = None
+        self.lru = OrderedDict()
+        self.lru_size = lru_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+        self._refresh()
+
+    @staticmethod
+    def key(text) :
+        return hashlib.blake2b(text.encode("utf8"), digest_size=KEY_SIZE).digest()
+
+    def _refresh(self) :
+        """
+        Load the keys appended since the last call (possibly by another process)
+        and remap the vectors file.
+        """
+        if not os.path.exists(self.keys_path) :
+            return
+        with open(self.keys_path, "rb") as f :
+            f.seek(self.loaded)
+            data = f.read()
+        count = len(data) // KEY_SIZE
+        first = self.loaded // KEY_SIZE
+        for i in range(count) :
+            self.rows[data[i*KEY_SIZE:(i+1)*KEY_SIZE]] = first + i
+        self.loaded += count * KEY_SIZE
+        if self.rows :
+            self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r",
+                shape=(len(self.rows), self.dim))
+
+    def _remember(self, key, vector) :
+        self.lru[key] = vector
+        self.lru.move_to_end(key)
+        if len(self.lru) > self.lru_size :
+            self.lru.popitem(last=False)
+
+    def get(self, text) :
+        """
+        Cached vector of a text, or None.
+        """
+        key = self.key(text)
+        with self.lock :
+            vector = self.lru.get(key)
+            if vector is not None :
+                self.lru.move_to_end(key)
+                return vector
+            row = self.rows.get(key)
+            if row is None or row >= len(self.vectors) :
+                return None
+            vector = np.array(self.vectors[row])
+            self._remember(key, vector)
+            return vector
+
+    def put_many(self, texts, vectors) :
+        """
+        Append the vectors of new texts to the cache.
+        """
+        with self.lock, open(self.lock_path, "w") as lock :
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._refresh()
+            new = OrderedDict()
+            for text, vector in zip(texts, vectors) :
+                key = self.key(text)
+                if key not in self.rows :
+                    new[key] = np.asarray(vector, dtype=np.float32)
+            if new :
+                # vectors first, then keys : a crash never leaves a key without its vector
+                with open(self.vectors_path, "r+b" if os.path.exists(self.vectors_path) else "wb") as f :
+                    f.seek(len(self.rows) * self.dim * 4)
+                    f.write(np.stack(list(new.values())).tobytes())
+                with open(self.keys_path, "ab") as f :
+                    f.write(b"".join(new.keys()))
+                self._refresh()
+            for text, vector in zip(texts, vectors) :
+                self._remember(self.key(text), np.asarray(vector, dtype=np.float32))
+
+    def embed(self, texts, encode) :
+        """
+        Vectors of a list of texts as a (len(texts), dim) float32 matrix.
+        Only the texts missing from the cache are passed to encode, in one call.
+        """
+        result = np.empty((len(texts), self.dim), dtype=np.float32)
+        missing = OrderedDict()
+        for i, text in enumerate(texts) :
+            vector = self.get(text)
+            if vector is None :
+                missing.setdefault(text, []).append(i)
+            else :
+                result[i] = vector
+        if missing and len(self.rows) > 0 :
+            # another process may have embedded them in the meantime
+            with self.lock :
+                self._refresh()
+            for text in list(missing) :
+                vector = self.get(text)
+                if vector is not None :
+                    result[missing.pop(text)] = vector
+        with self.lock :
+            self.hits += len(texts) - sum(len(rows) for rows in missing.values())
+            self.misses += sum(len(rows) for rows in missing.values())
+        if missing :
+            new_texts = list(missing)
+            vectors = np.asarray(encode(new_texts), dtype=np.float32)
+            self.put_many(new_texts, vectors)
+            for text, vector in zip(new_texts, vectors) :
+                result[missing[text]] = vector
+        return result
+
+caches = {}
+caches_lock = threading.Lock()
+
+"""
+getCache() returns the embedding cache of a vector type, opened on first use.
+Argument : vector_type (String) --> bert_vector or laser_vector
+"""
+def getCache(vector_type):
+    with caches_lock:
+        if(vector_type not in caches):
+            caches[vector_type] = EmbeddingCache(MODELS[vector_type],vector_type,DIMS[vector_type])
+    return caches[vector_type]
+
+"""
+getModel() returns the encoder of a vector type, loaded on first use : the
+LASER model or the client of the local BERT server.
+Argument : vector_type (String) --> bert_vector or laser_vector
+"""
+def getModel(vector_type):
+    with models_lock:
+        if(vector_type not in models):
+            if(vector_type == LASER):
+                from laserembeddings import Laser
+                models[vector_type] = Laser()
+            else:
+                from bert_serving.client import BertClient
+                models[vector_type] = BertClient(ip='localhost', output_fmt='list')
+    return models[vector_type]
+
+"""
+warmUp() loads the encoders and opens the caches of vector types ahead of the
+first request, for servers.
+Argument : vector_types (list of String) --> bert_vector and/or laser_vector
+"""
+def warmUp(vector_types):
+    for vector_type in vector_types:
+        getModel(vector_type)
+        getCache(vector_type)
+
+"""
+embed() maps a list of texts into the vector space of LASER or BERT and returns
+a float32 matrix with one row per text. Texts already embedded by a previous
+call or run are read from the cache, the others are encoded in a single call.
+Argument : texts (list of String)
+           vector_type (String) --> bert_vector or laser_vector
+"""
+def embed(texts,vector_type):
+    #The model is only loaded when a text is missing from the cache
+    if(vector_type == LASER):
+        encode = lambda batch : getModel(LASER).embed_sentences(batch,lang='en')
+    else:
+        encode = lambda batch : getModel(BERT).encode(batch)
+    return getCache(vector_type).embed(list(texts),encode)
@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Persistent crawl frontier shared by all crawl workers.
+Pending requests live in a Redis sorted set (priority queue) instead of
+Scrapy's in-memory scheduler, so an exploration resumes after a crash or a
+restart. Canonical URLs already queued are remembered in a scalable Bloom
+filter, and the last crawl time of each URL is kept (for recrawl_after
+seconds) so that a new exploration of a website skips the pages fetched
+recently. The requests produced by a response are queued together, in a
+couple of Redis round trips.
+Enable with the Scrapy setting SCHEDULER = 'frontier.FrontierScheduler'.
+"""
+
+import os
+import math
+import time
+import pickle
+import hashlib
+import logging
+from scrapy import signals
+from scrapy.utils.request import request_from_dict
+from w3lib.url import canonicalize_url
+
+# max number of requests buffered by the scheduler before they are queued
+ENQUEUE_BATCH = 100
+
+class MemoryBits(object):
+    """
+    Bit array in process memory.
+    """
+
+    def __init__(self, size) :
+        self.bits = bytearray((size + 7) // 8)
+
+    @property
+    def nbytes(self) :
+        return len(self.bits)
+
+    def get(self, positions) :
+        return [bool(self.bits[p >> 3] & (1 << (p & 7))) for p in positions]
+
+    def set(self, positions) :
+        for p in positions :
+            self.bits[p >> 3] |= 1 << (p & 7)
+
+class RedisBits(object):
+    """
+    Bit array stored in a Redis string (GETBIT / SETBIT).
+    """
+
+    def __init__(self, redis, key, size, ttl=None) :
+        self.redis = redis
+        self.key = key
+        self.size = size
+        self.ttl = ttl
+
+    @property
+    def nbytes(self) :
+        return (self.size + 7) // 8
+
+    def get(self, positions) :
+        pipe = self.redis.pipeline(transaction=False)
+        for p in positions :
+            pipe.getbit(self.key, p)
+        return [bool(bit) for bit in pipe.execute()]
+
+    def set(self, positions) :
+        pipe = self.redis.pipeline(transaction=False)
+        for p in positions :
+            pipe.setbit(self.key, p, 1)
+        if self.ttl :
+            pipe.expire(self.key, self.ttl)
+        pipe.execute()
+
+class BloomFilter(object):
+    """
+    Bloom filter sized for capacity items at the given false positive rate.
+    Positions use double hashing of a single 128 bits digest.
+    """
+
+    def __init__(self, capacity, error_rate, storage) :
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = storage(self.size)
+
+    def positions(self, digest) :
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def contains(self, digest) :
+        return all(self.bits.get(self.positions(digest)))
+
+    def add(self, digest) :
+        self.bits.set(self.positions(digest))
+
+class ScalableBloomFilter(object):
+    """
+    Sequence of Bloom filters of growing capacity and tightening error rate
+    (Almeida et al.), so the overall false positive rate stays under
+    error_rate whatever the number of items.
+    storage    : factory (layer, size) -> bit array
+    counts     : number of items per layer (MemoryCounts or RedisCounts)
+    """
+
+    def __init__(self, storage, counts=None, capacity=1000000, error_rate=0.001,
+            growth=2, tightening=0.5) :
+        self.storage = storage
+        self.counts = counts if counts is not None else MemoryCounts()
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.growth = growth
+        self.tightening = tightening
+        self.layers = []
+        for layer in range(max(1, len(self.counts))) :
+            self._add_layer(layer)
+
+    def _add_layer(self, layer) :
+        self.layers.append(BloomFilter(self.capacity * self.growth ** layer,
+            self.error_rate * (1 - self.tightening) * self.tightening ** layer,
+            lambda size : self.storage(layer, size)))
+
+    @property
+    def nbytes(self) :
+        return sum(layer.bits.nbytes for layer in self.layers)
+
+    @staticmethod
+    def digest(key) :
+        return hashlib.blake2b(key.encode("utf8"), digest_size=16).digest()
+
+    def _sync(self) :
+        # layers added by another process sharing the filter
+        while len(self.counts) > len(self.layers) :
+            self._add_layer(len(self.layers))
+
+    def __contains__(self, key) :
+        self._sync()
+        digest = self.digest(key)
+        return any(layer.contains(digest) for layer in self.layers)
+
+    def add(self, key) :
+        """
+        Add a key, return False if it was (probably) already present.
+        """
+        self._sync()
+        digest = self.digest(key)
+        if any(layer.contains(digest) for layer in self.layers) :
+            return False
+        layer = len(self.layers) - 1
+        if self.counts.get(layer, 0) >= self.layers[layer].capacity :
+            layer += 1
+            self._add_layer(layer)
+        self.layers[layer].add(digest)
+        self.counts.increment(layer)
+        return True
+
+class MemoryCounts(dict):
+    """
+    Layer counts of a scalable Bloom filter kept in process memory.
+    """
+
+    def increment(self, layer) :
+        self[layer] = self.get(layer, 0) + 1
+
+class RedisCounts(object):
+    """
+    Layer counts of a scalable Bloom filter kept in a Redis hash.
+    """
+
+    def __init__(self, redis, key) :
+        self.redis = redis
+        self.key = key
+
+    def __len__(self) :
+        return self.redis.hlen(self.key)
+
+    def get(self, layer, default=0) :
+        value = self.redis.hget(self.key, layer)
+        return default if value is None else int(value)
+
+    def increment(self, layer) :
+        # atomic when several workers share the filter
+        self.redis.hincrby(self.key, layer, 1)
+
+class Frontier(object):
+    """
+    Redis backed frontier of one website.
+    recrawl_after : seconds after which a crawled page may be fetched again
+    The crawl times are a sorted set of URLs by time, the URLs crawled more
+    than recrawl_after seconds ago are removed when a page is crawled.
+    """
+
+    def __init__(self, redis, name, recrawl_after=86400, capacity=1000000, error_rate=0.001) :
+        self.redis = redis
+        self.name = name
+        self.recrawl_after = recrawl_after
+        self.queue_key = "frontier:%s:queue"%name
+        self.sequence_key = "frontier:%s:sequence"%name
+        self.crawled_key = "frontier:%s:crawled"%name
+        # one filter per re-crawl period : URLs seen in a previous period can be queued again
+        epoch = int(time.time() // recrawl_after)
+        self.seen_key = "frontier:%s:seen:%d"%(name, epoch)
+        self.seen = ScalableBloomFilter(
+            lambda layer, size : RedisBits(redis, "%s:%d"%(self.seen_key, layer), size, 2 * recrawl_after),
+            RedisCounts(redis, self.seen_key + ":counts"), capacity, error_rate)
+
+    @staticmethod
+    def canonical(url) :
+        return canonicalize_url(url)
+
+    def recently_crawled(self, url) :
+        crawled = self.redis.zscore(self.crawled_key, self.canonical(url))
+        return crawled is not None and time.time() - crawled < self.recrawl_after
+
+    def mark_crawled(self, url) :
+        now = time.time()
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zadd(self.crawled_key, {self.canonical(url) : now})
+        pipe.zremrangebyscore(self.crawled_key, "-inf", now - self.recrawl_after)
+        pipe.expire(self.crawled_key, int(2 * self.recrawl_after))
+        pipe.execute()
+
+    def push(self, payload, url, priority=0, force=False) :
+        """
+        Queue a request payload unless its URL was already seen or crawled
+        recently (force bypasses both checks). Return True if queued.
+        """
+        return self.push_many([(payload, url, priority, force)])[0]
+
+    def push_many(self, requests) :
+        """
+        Queue (payload, url, priority, force) requests as push : the checks
+        of all the URLs in one round trip, the writes in one transaction.
+        Return the list of queued flags.
+        """
+        if not requests :
+            return []
+        seen = self.seen
+        seen._sync()
+        keys = [self.canonical(url) for _, url, _, _ in requests]
+        digests = [seen.digest(key) for key in keys]
+        pipe = self.redis.pipeline(transaction=False)
+        for key, digest in zip(keys, digests) :
+            pipe.zscore(self.crawled_key, key)
+            for layer in seen.layers :
+                for position in layer.positions(digest) :
+                    pipe.getbit(layer.bits.key, position)
+        last = len(seen.layers) - 1
+        pipe.hget(seen.counts.key, last)
+        # sequence numbers reserved for all the requests, some are unused
+        pipe.incrby(self.sequence_key, len(requests))
+        replies = iter(pipe.execute())
+        now = time.time()
+        known = []
+        for _ in requests :
+            crawled = next(replies)
+            present = [all([next(replies) for _ in range(layer.hashes)]) for layer in seen.layers]
+            known.append(any(present) or (crawled is not None and now - crawled < self.recrawl_after))
+        count = int(next(replies) or 0)
+        sequence = next(replies) - len(requests)
+
+        pipe = self.redis.pipeline(transaction=True)
+        queued, added, scores = [], set(), {}
+        for (payload, url, priority, force), key, digest, skip in zip(requests, keys, digests, known) :
+            if not force :
+                if skip or key in added :
+                    queued.append(False)
+                    continue
+                added.add(key)
+                if count >= seen.layers[last].capacity :
+                    last += 1
+                    seen._add_layer(last)
+                    count = 0
+                for position in seen.layers[last].positions(digest) :
+                    pipe.setbit(seen.layers[last].bits.key, position, 1)
+                pipe.hincrby(seen.counts.key, last, 1)
+                count += 1
+            # higher priority first, FIFO for equal priorities
+            sequence += 1
+            scores[payload] = -priority * 2 ** 40 + sequence
+            queued.append(True)
+        if scores :
+            pipe.zadd(self.queue_key, scores)
+        ttl = int(2 * self.recrawl_after)
+        for key in [layer.bits.key for layer in seen.layers] + [seen.counts.key, self.sequence_key] :
+            pipe.expire(key, ttl)
+        pipe.execute()
+        return queued
+
+    def pop(self) :
+        item = self.redis.zpopmin(self.queue_key)
+        return item[0][0] if item else None
+
+    def __len__(self) :
+        return self.redis.zcard(self.queue_key)
+
+class FrontierScheduler(object):
+    """
+    Scrapy scheduler storing its requests in a Frontier.
+    Requests are buffered and queued together when a request is needed (or
+    ENQUEUE_BATCH are waiting) : enqueue_request cannot tell which ones are
+    filtered, counted in the frontier/filtered stat. The number of pending
+    requests is counted locally, Redis is asked when it drops to 0.
+    Settings : FRONTIER_REDIS_URL, FRONTIER_RECRAWL_AFTER, FRONTIER_BLOOM_CAPACITY,
+    FRONTIER_BLOOM_ERROR_RATE
+    """
+
+    def __init__(self, crawler) :
+        self.crawler = crawler
+        self.settings = crawler.settings
+        self.stats = crawler.stats
+        self.spider = None
+        self.frontier = None
+        self.buffer = []
+        self.pending = 0
+
+    @classmethod
+    def from_crawler(cls, crawler) :
+        scheduler = cls(crawler)
+        crawler.signals.connect(scheduler.response_received, signal=signals.response_received)
+        return scheduler
+
+    def open(self, spider) :
+        from redis import Redis
+        self.spider = spider
+        redis = Redis.from_url(self.settings.get("FRONTIER_REDIS_URL")
+            or os.getenv("RQ_REDIS_URL", "redis://localhost:6379/0"))
+        name = (getattr(spider, "allowed_domains", None) or [spider.name])[0]
+        self.frontier = Frontier(redis, name,
+            recrawl_after=self.settings.getfloat("FRONTIER_RECRAWL_AFTER", 86400),
+            capacity=self.settings.getint("FRONTIER_BLOOM_CAPACITY", 1000000),
+            error_rate=self.settings.getfloat("FRONTIER_BLOOM_ERROR_RATE", 0.001))
+        self.pending = len(self.frontier)
+        if self.pending :
+            logging.info("resuming frontier of %s with %d pending requests"%(name, self.pending))
+
+    def close(self, reason) :
+        self.flush()
+
+    def has_pending_requests(self) :
+        self.flush()
+        if self.pending <= 0 :
+            # requests queued by another process
+            self.pending = len(self.frontier)
+        return self.pending > 0
+
+    def enqueue_request(self, request) :
+        self.buffer.append(request)
+        if len(self.buffer) >= ENQUEUE_BATCH :
+            self.flush()
+        return True
+
+    def flush(self) :
+        """
+        Queue the buffered requests.
+        """
+        requests, self.buffer = self.buffer, []
+        if not requests :
+            return
+        queued = self.frontier.push_many([(pickle.dumps(request.to_dict(spider=self.spider), protocol=4),
+            request.url, request.priority, request.dont_filter) for request in requests])
+        count = sum(queued)
+        self.pending += count
+        self.stats.inc_value("frontier/enqueued", count, spider=self.spider)
+        self.stats.inc_value("frontier/filtered", len(queued) - count, spider=self.spider)
+
+    def next_request(self) :
+        self.flush()
+        payload = self.frontier.pop()
+        if payload is None :
+            self.pending = 0
+            return None
+        self.pending -= 1
+        self.stats.inc_value("frontier/dequeued", spider=self.spider)
+        return request_from_dict(pickle.loads(payload), spider=self.spider)
+
+    def response_received(self, response, request, spider) :
+        self.frontier.mark_crawled(request.url)
+
+    def __len__(self) :
+        return len(self.frontier) + len(self.buffer)
@@ -20,7 +20,15 @@ import crawler
 import requests
 import json
 import query
-from flask import Flask, request, jsonify
+import vector_index
+import search_cache
+import suggest
+import search as searcher
+import scheduler
+import time
+import metrics
+import threading
+from flask import Flask, request, jsonify, g
 from language import languages
 from redis import Redis
 from rq import Queue
@@ -31,7 +39,7 @@ from rq.decorators import job
 from scrapy.crawler import CrawlerRunner
 from urllib.parse import urlparse
 from datetime import datetime
-from elasticsearch import Elasticsearch
+import backend
 from flask_rq2 import RQ
 import logging
 from twisted.internet import reactor
@@ -42,6 +50,27 @@ app = Flask(__name__)
 with app.app_context():
     from helper import *
 
+"""
+Duration of every request (see metrics.py and /metrics), and of the
+searches by mode.
+"""
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+@app.after_request
+def record_duration(response):
+    elapsed = time.perf_counter() - g.get("started", time.perf_counter())
+    searcher.REQUEST_SECONDS.observe(elapsed, endpoint=request.endpoint or "unknown",
+        method=request.method, status=response.status_code)
+    if "search_mode" in g :
+        searcher.SEARCH_SECONDS.observe(elapsed, mode=g.search_mode)
+    return response
+
+RQ_JOBS = metrics.counter("rq_jobs_total", "Redis queue jobs by final state.", ["job", "status"])
+RQ_JOB_SECONDS = metrics.histogram("rq_job_seconds", "Duration of the Redis queue jobs.", ["job"],
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200))
+
 """
 __author__      : Bijin Benny
 __email__       : bijin@ualberta.ca
@@ -56,6 +85,16 @@ Configure and intialize Redis task queue
 app.config['RQ_REDIS_URL']='redis://localhost:6379/0'
 redis_conn = RQ(app)
 
+"""
+Result cache of the /search endpoint : local LRU tier, plus a Redis tier
+shared by all server processes when SEARCH_CACHE_REDIS is set. Entries are
+invalidated by the crawler after each write to the index.
+"""
+app.config['SEARCH_CACHE_REDIS'] = os.getenv("SEARCH_CACHE_REDIS", "1") == "1"
+cache = search_cache.SearchCache(
+    redis_conn.connection if app.config['SEARCH_CACHE_REDIS'] else None,
+    index="web-en")
+
 """
 __author__      : Bijin Benny
 __email__       : bijin@ualberta.ca
@@ -71,7 +110,8 @@ host = os.getenv("HOST")
 user = os.getenv("USERNAME")
 pwd  = os.getenv("PASSWORD")
 port = os.getenv("PORT")
-es = Elasticsearch(hosts="http://"+user+":"+pwd+"@"+host+":"+port+"/")
+es = None
+es_lock = threading.Lock()
 
 """
 __author__      : Bijin Benny
@@ -87,8 +127,6 @@ logging.basicConfig(filename=datetime.now().strftime('server_%d_%m_%Y.log'),
 level=logging.DEBUG,format='%(asctime)s %(levelname)-8s %(message)s')
 
 
-logging.info(es.info())
-
 """
 __author__      : Bijin Benny
 __email__       : bijin@ualberta.ca
@@ -126,9 +164,39 @@ settings = {
                     "type": "text",
                     "analyzer": "english"
                 },
+                "fallback_description":{
+                    "type": "text",
+                    "index": False
+                },
                 "weight":{
                     "type": "long"
                 },
+                "pagerank":{
+                    "type": "rank_feature"
+                },
+                "etag":{
+                    "type": "keyword",
+                    "index": False
+                },
+                "last_modified":{
+                    "type": "keyword",
+                    "index": False
+                },
+                "fingerprint":{
+                    "type": "keyword",
+                    "index": False
+                },
+                "simhash":{
+                    "type": "keyword",
+                    "index": False
+                },
+                "links":{
+                    "type": "keyword",
+                    "index": False
+                },
+                "canonical":{
+                    "type": "keyword"
+                },
                 "bert_vector":{
                     "type": "dense_vector",
                     "dims": 768
@@ -141,7 +209,56 @@ settings = {
     }
     
 }
-es.indices.create(index='web-en',ignore=400,body=settings)
+
+def get_es() :
+    """
+    Elasticsearch client, connected on first use : the cluster information
+    is logged and the index is created if the server runs for the first time.
+    """
+    global es
+    with es_lock :
+        if es is None :
+            client = backend.create_client(hosts="http://"+user+":"+pwd+"@"+host+":"+port+"/")
+            logging.info(client.info())
+            client.indices.create(index='web-en',ignore=400,body=settings)
+            es = client
+    return es
+
+"""
+Type-ahead suggestions of the /suggest endpoint (suggest.py) : loaded from
+the index in the background on first use, then updated with the titles
+written by the crawler and the queries searched on the servers.
+"""
+suggester = None
+suggester_lock = threading.Lock()
+
+def get_suggester() :
+    global suggester
+    with suggester_lock :
+        if suggester is None :
+            suggester = suggest.Suggester().start(get_es, redis_conn.connection, "web-en")
+    return suggester
+
+def warm_up(resources) :
+    """
+    Connect to Elasticsearch (es), load the suggestions (suggest) and the
+    language models (laser, bert) before the first request rather than
+    during it.
+    """
+    for resource in resources :
+        if resource == "es" :
+            get_es()
+        elif resource == "suggest" :
+            get_suggester()
+        elif resource in ("laser", "bert") :
+            import embeddings
+            embeddings.warmUp([resource+"_vector"])
+            vector_index.get_index(resource+"_vector")
+        logging.info("warmed up : %s"%resource)
+
+# comma separated list of the resources loaded at startup, e.g. WARM_UP=es,laser
+if os.getenv("WARM_UP") :
+    warm_up([resource.strip() for resource in os.getenv("WARM_UP").split(",") if resource.strip()])
 
 
 """
@@ -150,8 +267,11 @@ to crawl is handled by this handler
 URL : /explore
 Method : HTTP POST
 POST Data : url - list of urls to explore
-Returns success or error message depending on the task being processed
-in the Redis queue.
+            profile - (optional) 1 : run a sampling profiler during the
+                      job, its stacks are written in PROFILE_DIR and their
+                      path given in the job state
+Returns immediately with the id of the exploration job, run in the
+background by the worker processes of the crawl scheduler (scheduler.py).
 """
 @app.route("/explore", methods=['POST'])
 def explore():
@@ -161,10 +281,23 @@ def explore():
         raise InvalidUsage('No url specified in POST data')
 
     logging.info("launch exploration job")
-    job = explore_job.queue(data["url"])
-    job.perform()
+    job_id = scheduler.get_scheduler().submit(data["url"], profile=data.get("profile") == "1")
 
-    return "Exploration started"
+    return jsonify(message="Exploration started", job=job_id)
+
+"""
+Server endpoint for the state of an exploration job
+URL : /explore/<job_id>
+Method : HTTP GET
+Returns the job state : queued, running, finished or failed, with its
+worker, timestamps and number of indexed pages once finished.
+"""
+@app.route("/explore/<job_id>", methods=['GET'])
+def explore_status(job_id):
+    job = scheduler.get_scheduler().status(job_id)
+    if job is None :
+        raise InvalidUsage('Unknown exploration job', status_code=404)
+    return jsonify(job)
 
 @redis_conn.job('low')
 def explore_job(link) :
@@ -172,7 +305,18 @@ def explore_job(link) :
     Explore a website and index all urls (redis-rq process).
     """
     logging.info("explore website at : %s"%link)
+    status = "failed"
+    try :
+        with metrics.timed(RQ_JOB_SECONDS, job="explore") :
+            result = explore_website(link)
+        status = "finished" if result else "unreachable"
+        return result
+    finally :
+        RQ_JOBS.inc(job="explore", status=status)
+        # the metrics of the job are rendered by /metrics of the servers
+        metrics.publish(redis_conn.connection, "rq-%d"%os.getpid())
 
+def explore_website(link) :
     try :
         link = url.crawl(link).url
     except :
@@ -190,24 +334,9 @@ def explore_job(link) :
             not run parallely in Redis tasks threads. CrawlerProcess was replaced by
             CrawlerRunner class that could run parallely in multiple Redis tasks
             """
-            runner = CrawlerRunner({
-                'USER_AGENT': "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 \
-                (KHTML, like Gecko) Chrome/55.0.2883.75 Safari/537.36",
-                'DOWNLOAD_TIMEOUT':100,
-                'DOWNLOAD_DELAY':0.25,
-                'ROBOTSTXT_OBEY':True,
-                'HTTPCACHE_ENABLED':False,
-                'REDIRECT_ENABLED':False,
-                'SPIDER_MIDDLEWARES' : {
-                'scrapy.downloadermiddlewares.robotstxt.RobotsTxtMiddleware':True,
-                'scrapy.spidermiddlewares.httperror.HttpErrorMiddleware':True,
-                'scrapy.downloadermiddlewares.httpcache.HttpCacheMiddleware':True,
-                'scrapy.extensions.closespider.CloseSpider':True
-                },
-                'CLOSESPIDER_PAGECOUNT':500 #only for debug
-            })
+            runner = CrawlerRunner(crawler.SETTINGS)
             runner.crawl(crawler.Crawler, allowed_domains=[urlparse(link).netloc],
-            start_urls = [link,], es_client=es, redis_conn=redis_conn)
+            start_urls = [link,], es_client=get_es(), redis_conn=redis_conn)
             d = runner.join()
             d.addBoth(lambda _: reactor.stop())
             reactor.run()
@@ -234,45 +363,62 @@ Method : HTTP POST
 POST Data : query - The search query
             hits  - The number of results to be returned
             start - Start number for the hits (for pagination purpose)
+            vector - (optional) 'laser' or 'bert' : rank by similarity with
+                     the query embedding using the local ANN index
+                     (vector_index.py) instead of the full-text query
+            hybrid - (optional) 'laser' or 'bert' : run the full-text query
+                     and the vector search of vector concurrently and
+                     fuse their rankings. Each leg has its own timeout
+                     (HYBRID_LEXICAL_TIMEOUT, HYBRID_VECTOR_TIMEOUT) : a
+                     late leg is left out. The response holds the latency
+                     and status of each leg
+            fusion - (optional, hybrid) 'rrf' (reciprocal rank fusion,
+                     default) or 'weighted' (normalized scores)
+            vector_weight - (optional, hybrid) weight of the vector leg,
+                     0 to 1, default 0.5
+            cursor - (optional) cursor pagination, one result per domain
+                     in a page and the last 100 results only, total is
+                     approximate (see search.cursor_pages) :
+                     empty for the first page, then the cursor returned
+                     with the previous page (start is ignored). The
+                     response holds the next cursor, null after the last page
 """
 @app.route("/search", methods=['POST'])
 def search():
-    def format_result(hit, highlight) :
-        #Highlight title and description
-        title = hit["title"]
-        description = hit["description"]
-        if highlight :
-            if "description" in highlight :
-                description = highlight["description"][0]+"..."
-            elif "body" in highlight :
-                description = highlight["body"][0]+"..."
-            
-
-        #Create false title and description for better user experience
-        if not title :
-            title = hit["domain"]
-        if not description :
-            description = url.create_description(hit["body"])+"..."
-
-        return {
-            "title":title,
-            "description":description,
-            "url":hit["url"],
-            "thumbnail":hit.get("thumbnail", None)
-        }
-
-     #Analyze and validate the user query
+    #Analyze and validate the user query
     data = dict((key, request.form.get(key)) for key in request.form.keys())
-    logging.info("[search request data : "+ str(data))
-    if "query" not in data :
-        raise InvalidUsage('No query specified in POST data')
-    start = int(data.get("start", "0"))
-    hits = int(data.get("hits", "10"))
-    if start < 0 or hits < 0 :
-        raise InvalidUsage('Start or hits cannot be negative numbers')
-    groups = re.search("(site:(?P<domain>[^ ]+))?( ?(?P<query>.*))?",
-        data["query"]).groupdict()
-    logging.info("Expression query : " + str(groups["query"]))
+    logging.debug("search request data : %s", data)
+    try :
+        expression, start, hits = searcher.parse_request(data)
+        g.search_mode = searcher.search_mode(data)
+        logging.debug("Expression query : %s", expression)
+        # popular queries are suggested (first pages only)
+        if start == 0 and not data.get("cursor") :
+            get_suggester().record_query(expression)
+
+        if "cursor" in data :
+            total, results, cursor = searcher.cursor_search(
+                lambda body : get_es().search(index="web-en", body=body), expression, data["cursor"], hits)
+            return jsonify(total=total, results=results, cursor=cursor)
+
+        if data.get("vector") :
+            ids = searcher.vector_ids(expression, data["vector"]+"_vector", start+hits)
+            results = searcher.found_results(get_es().mget(index="web-en", body={"ids":ids},
+                _source_includes=query.RESULT_FIELDS)) if ids else []
+            return jsonify(total=len(results), results=results[start:start+hits])
+
+        if data.get("hybrid") :
+            vector_type, fusion, vector_weight = searcher.parse_hybrid(data)
+            results, legs = searcher.hybrid_search(
+                lambda body : get_es().search(index="web-en", body=body,
+                    request_timeout=searcher.LEXICAL_TIMEOUT),
+                lambda ids : get_es().mget(index="web-en", body={"ids":ids},
+                    _source_includes=query.RESULT_FIELDS),
+                expression, vector_type, start+hits, fusion, vector_weight)
+            logging.debug("Hybrid search legs : %s", legs)
+            return jsonify(total=len(results), results=results[start:start+hits], legs=legs)
+    except searcher.InvalidQuery as e :
+        raise InvalidUsage(e.message, status_code=e.status_code)
 
     """
              __author__     : Bijin Benny
@@ -284,24 +430,49 @@ def search():
     to the experiment use case and the code is modified to perform only query search
     Send search request to Elastic search DB with the user query
     """
-    response = es.search(index="web-en",body=query.expression_query(groups["query"]))
-    logging.info("Raw response" + str(response))
-    results = []
-
-    #Process, sort and return the results back to the user
-    for domain_bucket in response['aggregations']['per_domain']['buckets']:
-        for hit in domain_bucket["top_results"]["hits"]["hits"] :
-            results.append((format_result(hit["_source"],
-            hit.get("highlight", None)),hit["_score"]))
-
-    logging.info("Before Sort Results :" + str(results))        
-    results = [result[0] for result in -
-    sorted(results, key=lambda result: result[1], reverse=True)]
-    logging.info("After Sort Results :" + str(results))
+    cache_key = cache.key(expression)
+    results = cache.get(cache_key)
+    if results is None :
+        response = get_es().search(index="web-en",body=query.expression_query(expression))
+        results = searcher.sort_results(response)
+
+        #All pages of the query are served from the cached list
+        cache.set(cache_key, results)
     
     total = len(results)
     results = results[start:start+hits]
-    logging.info("Total results : "+ str(total))
+    logging.debug("Total results : %s", total)
 
     return jsonify(total=total, results=results)
 
+"""
+Server endpoint for type-ahead suggestions
+URL : /suggest
+Method : HTTP GET
+Parameters : query - beginning of the query typed by the user
+             hits  - (optional) number of suggestions, 10 at most (default)
+Returns the completions of the query among the titles of the indexed pages
+and the popular queries, best first.
+"""
+@app.route("/suggest", methods=['GET'])
+def suggestions():
+    try :
+        prefix, hits = suggest.parse_request(request.args)
+    except searcher.InvalidQuery as e :
+        raise InvalidUsage(e.message, status_code=e.status_code)
+    return jsonify(suggestions=get_suggester().complete(prefix, hits))
+
+"""
+Server endpoint for the metrics
+URL : /metrics
+Method : HTTP GET
+Returns the counters and latency histograms of the server, of the
+workers of the crawl scheduler and of the Redis queue workers, in the
+Prometheus text format.
+"""
+@app.route("/metrics", methods=['GET'])
+def metrics_endpoint():
+    snapshots = [({}, metrics.registry.snapshot())]
+    snapshots.extend(metrics.published(redis_conn.connection))
+    return metrics.render(snapshots), 200, {"Content-Type":"text/plain; version=0.0.4"}
+
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Language identification of pages.
+The declared language of a page (<html lang> or Content-Language header)
+is trusted when it is a single known language. Otherwise langdetect runs on
+a bounded sample of the page (title and first characters of its main text)
+with language profiles loaded once per process and a fixed seed, so the
+same page always gets the same language.
+"""
+
+import os
+import re
+import threading
+from langdetect.detector_factory import DetectorFactory, PROFILES_DIRECTORY
+from langdetect.lang_detect_exception import LangDetectException
+
+# max number of characters of text given to the detector
+MAX_TEXT_LENGTH = int(os.getenv("LANGUAGE_MAX_TEXT_LENGTH", "2000"))
+SEED = 0
+
+_factory = None
+_factory_lock = threading.Lock()
+
+def get_factory() :
+    """
+    Detector factory of the process, language profiles loaded on first use.
+    """
+    global _factory
+    with _factory_lock :
+        if _factory is None :
+            factory = DetectorFactory()
+            factory.load_profile(PROFILES_DIRECTORY)
+            factory.set_seed(SEED)
+            _factory = factory
+    return _factory
+
+def declared_language(value) :
+    """
+    Language code of a lang attribute or Content-Language header (ex : en-US -> en),
+    None if missing, ambiguous (several languages) or unknown.
+    """
+    if not value :
+        return None
+    if isinstance(value, bytes) :
+        value = value.decode("latin1")
+    value = value.strip().lower()
+    if not value or "," in value :
+        return None
+    code = re.split("[-_]", value)[0]
+    return code if code in get_factory().get_lang_list() else None
+
+def detect(text, title=None, declared=()) :
+    """
+    Language of a page and confidence (0 to 1).
+    text     : visible text of the page (only the first MAX_TEXT_LENGTH characters are used),
+               or a function returning it, only called when no declared language is trusted
+    declared : declared languages of the page, in order of trust
+    Return (None, 0.0) when the page has no usable text.
+    """
+    for value in declared :
+        code = declared_language(value)
+        if code :
+            return code, 1.0
+    if callable(text) :
+        text = text()
+    sample = ("%s\n%s"%(title, text) if title else text)[:MAX_TEXT_LENGTH]
+    detector = get_factory().create()
+    detector.set_max_text_length(MAX_TEXT_LENGTH)
+    detector.append(sample)
+    try :
+        best = detector.get_probabilities()[0]
+    except (LangDetectException, IndexError) :
+        return None, 0.0
+    return best.lang, best.prob
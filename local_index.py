@@ -0,0 +1,959 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Embedded inverted index, run in the process of the server or the crawler
+in place of an Elasticsearch cluster (see backend.py).
+Each index is a directory of immutable segments, written when buffered
+documents are refreshed and merged in the background when there are too
+many of them. A segment holds the postings of its terms (document deltas
+and per field frequencies, varint coded), the field lengths, weights,
+PageRanks and domains of its documents and their JSON source, all memory
+mapped. Queries are scored with BM25F over title, description and body
+with the boosts of the query (title^3, description^2, body), plus the
+saturated PageRank and multiplied by the weight of the pages, and can be
+collapsed per domain.
+LocalClient answers the subset of the Elasticsearch client API used by
+the project with these indexes.
+"""
+
+import os
+import re
+import json
+import math
+import mmap
+import uuid
+import fcntl
+import shutil
+import fnmatch
+import logging
+import threading
+import numpy as np
+from collections import Counter, OrderedDict
+
+FIELDS = ("title", "description", "body")
+# BM25F parameters
+K1 = 1.2
+B = 0.75
+# number of buffered documents written as a new segment without refresh
+FLUSH_DOCS = 5000
+# number of segments above which the smallest ones are merged, and how many
+MAX_SEGMENTS = 8
+MERGE_FACTOR = 4
+
+TOKEN = re.compile(r"\w+")
+
+def tokenize(text) :
+    return TOKEN.findall(text.lower()) if text else []
+
+def encode_varints(values) :
+    """
+    Concatenated varints (7 bits per byte, high bit set on all bytes but the
+    last one) of an array of non negative integers.
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any() :
+        lengths += rest > 0
+        rest >>= np.uint64(7)
+    out = np.empty(int(lengths.sum()), dtype=np.uint8)
+    offsets = np.cumsum(lengths) - lengths
+    for i in range(int(lengths.max()) if len(values) else 0) :
+        selected = lengths > i
+        byte = (values[selected] >> np.uint64(7 * i)) & np.uint64(0x7f)
+        more = (lengths[selected] > i + 1).astype(np.uint64) << np.uint64(7)
+        out[offsets[selected] + i] = byte | more
+    return out, lengths
+
+def decode_varints(data) :
+    data = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(data < 128)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    shifts = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+    values = (data & 0x7f).astype(np.uint64) << (7 * shifts).astype(np.uint64)
+    return np.add.reduceat(values, starts) if len(data) else values
+
+class Segment(object):
+    """
+    Immutable segment of an index, opened read only.
+    """
+
+    def __init__(self, directory, name, deleted=()) :
+        self.name = name
+        self.path = os.path.join(directory, name)
+        with open(os.path.join(self.path, "meta.json")) as f :
+            meta = json.load(f)
+        self.size = meta["docs"]
+        self.terms = meta["terms"] # term -> (offset, bytes, document frequency)
+        self.ids = meta["ids"]
+        self.domains = meta["domains"]
+        self.lengths = np.load(os.path.join(self.path, "lengths.npy"), mmap_mode="r")
+        self.weights = np.load(os.path.join(self.path, "weights.npy"), mmap_mode="r")
+        # segments written before the PageRank : pages not ranked
+        path = os.path.join(self.path, "pageranks.npy")
+        self.pageranks = np.load(path, mmap_mode="r") if os.path.exists(path) else np.zeros(self.size, dtype=np.float32)
+        self.domain_ids = np.load(os.path.join(self.path, "domains.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(self.path, "offsets.npy"), mmap_mode="r")
+        self.postings = self._map("postings.bin")
+        self.sources = self._map("sources.bin")
+        self.live = np.ones(self.size, dtype=bool)
+        self.live[list(deleted)] = False
+        self.numbers = dict((doc_id, number) for number, doc_id in enumerate(self.ids))
+
+    def _map(self, filename) :
+        with open(os.path.join(self.path, filename), "rb") as f :
+            if os.fstat(f.fileno()).st_size == 0 :
+                return b""
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @property
+    def deleted(self) :
+        return np.flatnonzero(~self.live).tolist()
+
+    @property
+    def live_count(self) :
+        return int(self.live.sum())
+
+    def postings_of(self, term) :
+        """
+        Document numbers and (title, description, body) frequencies of a term.
+        """
+        entry = self.terms.get(term)
+        if entry is None :
+            return None, None
+        offset, nbytes, df = entry[:3]
+        values = decode_varints(self.postings[offset:offset+nbytes]).astype(np.int64)
+        return np.cumsum(values[:df]), values[df:].reshape(len(FIELDS), df).T
+
+    def source(self, number) :
+        return json.loads(self.sources[self.offsets[number]:self.offsets[number+1]].decode("utf8"))
+
+def write_arrays(directory, name, ids, vocabulary, term_ids, numbers, frequencies, lengths,
+        weights, pageranks, domain_ids, domains, sources) :
+    """
+    Write a segment and return its name.
+    vocabulary  : terms, by term id
+    term_ids, numbers, frequencies : postings, by term then document number,
+                  with their (title, description, body) frequencies
+    lengths, weights, pageranks, domain_ids, domains, sources : per document
+                  arrays, domain names by domain id, JSON sources (bytes)
+    """
+    path = os.path.join(directory, name)
+    os.makedirs(path)
+    first = np.ones(len(term_ids), dtype=bool)
+    first[1:] = term_ids[1:] != term_ids[:-1]
+    starts = np.flatnonzero(first)
+    ends = np.append(starts[1:], len(term_ids)).astype(np.int64)
+    deltas = numbers.copy()
+    deltas[1:] -= numbers[:-1]
+    deltas[starts] = numbers[starts]
+    # block of a term : its document deltas, then its frequencies of each field
+    columns = len(FIELDS) + 1
+    term_index = np.cumsum(first) - 1
+    start_of = starts[term_index]
+    df_of = (ends - starts)[term_index]
+    within = np.arange(len(term_ids)) - start_of
+    values = np.empty(len(term_ids) * columns, dtype=np.int64)
+    for column, data in enumerate([deltas] + [frequencies[:, field] for field in range(len(FIELDS))]) :
+        values[columns * start_of + column * df_of + within] = data
+    encoded, value_lengths = encode_varints(values)
+    byte_offsets = np.concatenate(([0], np.cumsum(value_lengths)))
+    # term -> (byte offset, bytes, document frequency, offset of its first value)
+    terms = dict((vocabulary[term], (begin, end - begin, df, position)) for term, begin, end, df, position in zip(
+        term_ids[starts].tolist(), byte_offsets[columns * starts].tolist(),
+        byte_offsets[columns * ends].tolist(), (ends - starts).tolist(), (columns * starts).tolist()))
+
+    encoded.tofile(os.path.join(path, "postings.bin"))
+    with open(os.path.join(path, "sources.bin"), "wb") as f :
+        f.write(b"".join(sources))
+    offsets = np.zeros(len(sources) + 1, dtype=np.int64)
+    np.cumsum([len(source) for source in sources], out=offsets[1:])
+    np.save(os.path.join(path, "offsets.npy"), offsets)
+    np.save(os.path.join(path, "lengths.npy"), np.asarray(lengths, dtype=np.int32).reshape(-1, len(FIELDS)))
+    np.save(os.path.join(path, "weights.npy"), np.asarray(weights, dtype=np.float32))
+    np.save(os.path.join(path, "pageranks.npy"), np.asarray(pageranks, dtype=np.float32))
+    np.save(os.path.join(path, "domains.npy"), np.asarray(domain_ids, dtype=np.int32))
+    with open(os.path.join(path, "meta.json"), "w") as f :
+        json.dump({"docs":len(ids), "ids":ids, "domains":domains, "terms":terms}, f)
+    return name
+
+def write_segment(directory, name, docs) :
+    """
+    Analyze a list of (id, source) and write them as a segment.
+    """
+    vocabulary = {}
+    term_ids, numbers, fields, counts = [], [], [], []
+    lengths, weights, pageranks, domain_ids, domains, sources = [], [], [], [], {}, []
+    for number, (doc_id, source) in enumerate(docs) :
+        for field, name_ in enumerate(FIELDS) :
+            tokens = tokenize(source.get(name_))
+            lengths.append(len(tokens))
+            frequencies = Counter(tokens)
+            term_ids.extend([vocabulary.setdefault(token, len(vocabulary)) for token in frequencies])
+            counts.extend(frequencies.values())
+            numbers.extend([number] * len(frequencies))
+            fields.extend([field] * len(frequencies))
+        # a missing weight counts as 1 (field_value_factor missing), 0 stays 0
+        weight = source.get("weight", 1)
+        weights.append(1.0 if weight is None else float(weight))
+        pageranks.append(float(source.get("pagerank") or 0))
+        domain_ids.append(domains.setdefault(source.get("domain") or "", len(domains)))
+        sources.append(json.dumps(source).encode("utf8"))
+
+    # one posting per (term, document) with the frequency of each field
+    keys = np.asarray(term_ids, dtype=np.int64) * max(len(docs), 1) + np.asarray(numbers, dtype=np.int64)
+    pairs, inverse = np.unique(keys, return_inverse=True)
+    frequencies = np.zeros((len(pairs), len(FIELDS)), dtype=np.int64)
+    frequencies[inverse, np.asarray(fields, dtype=np.int64)] = counts
+    return write_arrays(directory, name, [doc_id for doc_id, _ in docs],
+        sorted(vocabulary, key=vocabulary.get), pairs // max(len(docs), 1), pairs % max(len(docs), 1),
+        frequencies, lengths, weights, pageranks, domain_ids, sorted(domains, key=domains.get), sources)
+
+def merge_segments(directory, name, segments, masks) :
+    """
+    Write the live documents (masks) of segments as one segment, from
+    their postings : documents are not analyzed again.
+    """
+    vocabulary, domains = {}, {}
+    postings, ids, lengths, weights, pageranks, domain_ids, sources = [], [], [], [], [], [], []
+    base = 0
+    for segment, live in zip(segments, masks) :
+        kept = np.flatnonzero(live)
+        renumber = np.full(segment.size, -1, dtype=np.int64)
+        renumber[kept] = base + np.arange(len(kept))
+        base += len(kept)
+        ids.extend(segment.ids[number] for number in kept)
+        lengths.append(np.asarray(segment.lengths)[kept])
+        weights.append(np.asarray(segment.weights)[kept])
+        pageranks.append(np.asarray(segment.pageranks)[kept])
+        table = np.asarray([domains.setdefault(domain, len(domains)) for domain in segment.domains] or [0])
+        domain_ids.append(table[np.asarray(segment.domain_ids)[kept]])
+        sources.extend(segment.sources[segment.offsets[number]:segment.offsets[number+1]] for number in kept)
+        if not segment.terms :
+            continue
+        # every posting of the segment, decoded at once
+        values = decode_varints(segment.postings[:]).astype(np.int64)
+        entries = list(segment.terms.items())
+        global_ids = np.asarray([vocabulary.setdefault(term, len(vocabulary)) for term, _ in entries])
+        df = np.asarray([entry[2] for _, entry in entries], dtype=np.int64)
+        position = np.repeat(np.asarray([entry[3] for _, entry in entries], dtype=np.int64), df)
+        block = np.repeat(np.cumsum(df) - df, df)
+        within = np.arange(len(position)) - block
+        df_of = np.repeat(df, df)
+        deltas = values[position + within]
+        cumulative = np.cumsum(deltas)
+        numbers = cumulative - np.repeat(cumulative[np.cumsum(df) - df] - deltas[np.cumsum(df) - df], df)
+        frequencies = np.stack([values[position + (column + 1) * df_of + within]
+            for column in range(len(FIELDS))], axis=1)
+        keep = renumber[numbers] >= 0
+        postings.append((np.repeat(global_ids, df)[keep], renumber[numbers][keep], frequencies[keep]))
+
+    if postings :
+        term_ids, numbers, frequencies = (np.concatenate(column) for column in zip(*postings))
+        order = np.lexsort((numbers, term_ids))
+        term_ids, numbers, frequencies = term_ids[order], numbers[order], frequencies[order]
+    else :
+        term_ids = numbers = np.zeros(0, dtype=np.int64)
+        frequencies = np.zeros((0, len(FIELDS)), dtype=np.int64)
+    return write_arrays(directory, name, ids, sorted(vocabulary, key=vocabulary.get), term_ids, numbers,
+        frequencies, np.concatenate(lengths) if lengths else [], np.concatenate(weights) if weights else [],
+        np.concatenate(pageranks) if pageranks else [], np.concatenate(domain_ids) if domain_ids else [], sorted(domains, key=domains.get), sources)
+
+class LocalIndex(object):
+    """
+    Index stored in a directory : manifest of the live segments and their
+    deleted documents, plus the buffer of documents not yet refreshed.
+    Several processes can write to the same index, the manifest is
+    updated under a file lock.
+    """
+
+    def __init__(self, directory, merge=True) :
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.RLock()
+        self.buffer = {} # id -> source, None for a deletion
+        self.segments = []
+        self.generation = None
+        self.domain_table = {}
+        self.merging = threading.Event()
+        self.merge_enabled = merge
+        self.reload()
+
+    @property
+    def manifest(self) :
+        return os.path.join(self.directory, "segments.json")
+
+    def _file_lock(self) :
+        f = open(os.path.join(self.directory, "write.lock"), "w")
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def reload(self) :
+        """
+        Open the segments of the manifest if another process changed it.
+        """
+        while True :
+            try :
+                with open(self.manifest) as f :
+                    state = json.load(f)
+            except (IOError, ValueError) :
+                state = {"generation":0, "segments":[]}
+            with self.lock :
+                # generations only grow : an older manifest was read before a swap
+                if self.generation is not None and state["generation"] <= self.generation :
+                    return
+                opened = dict((segment.name, segment) for segment in self.segments)
+                segments = []
+                try :
+                    for entry in state["segments"] :
+                        segment = opened.get(entry["name"])
+                        if segment is None :
+                            segment = self._open(entry["name"], entry["deleted"])
+                        else :
+                            live = np.ones(segment.size, dtype=bool)
+                            live[entry["deleted"]] = False
+                            segment.live = live
+                        segments.append(segment)
+                except FileNotFoundError :
+                    continue # merged and removed by another process since, read it again
+                self.segments = segments
+                self.generation = state["generation"]
+                return
+
+    def _open(self, name, deleted=()) :
+        segment = Segment(self.directory, name, deleted)
+        # domain ids shared by the segments, for collapsing and filters
+        segment.domain_gids = np.asarray([self.domain_table.setdefault(domain, len(self.domain_table))
+            for domain in segment.domains], dtype=np.int64)
+        return segment
+
+    def _save(self, segments) :
+        state = {"generation":self.generation + 1,
+            "segments":[{"name":segment.name, "deleted":segment.deleted} for segment in segments]}
+        temporary = self.manifest + ".tmp"
+        with open(temporary, "w") as f :
+            json.dump(state, f)
+        os.replace(temporary, self.manifest)
+
+    def _delete(self, segments, doc_ids) :
+        """
+        Mark the documents of doc_ids deleted in segments (copy on write :
+        searches running on the previous masks are not affected).
+        """
+        for segment in segments :
+            numbers = [segment.numbers[doc_id] for doc_id in doc_ids if doc_id in segment.numbers]
+            if numbers :
+                live = segment.live.copy()
+                live[numbers] = False
+                segment.live = live
+
+    def add(self, doc_id, source) :
+        with self.lock :
+            self.buffer[doc_id] = source
+            full = len(self.buffer) >= FLUSH_DOCS
+        if full :
+            self.refresh()
+
+    def update(self, doc_id, partial) :
+        """
+        Merge partial into the source of a document, False if it is unknown.
+        """
+        source = self.get(doc_id)
+        if source is None :
+            return False
+        self.add(doc_id, dict(source, **partial))
+        return True
+
+    def delete(self, doc_id) :
+        with self.lock :
+            self.buffer[doc_id] = None
+
+    def refresh(self) :
+        """
+        Write the buffered documents as a new segment : they become searchable.
+        """
+        with self.lock :
+            if not self.buffer :
+                return
+            buffer, self.buffer = self.buffer, {}
+            lock = self._file_lock()
+            try :
+                self.reload()
+                segments = list(self.segments)
+                self._delete(segments, buffer)
+                docs = [(doc_id, source) for doc_id, source in buffer.items() if source is not None]
+                if docs :
+                    name = write_segment(self.directory, "seg_%s"%uuid.uuid4().hex[:12], docs)
+                    segments.append(self._open(name))
+                self._save(segments)
+                self.segments = segments
+                self.generation += 1
+            finally :
+                lock.close()
+        if self.merge_enabled and len(self.segments) > MAX_SEGMENTS and not self.merging.is_set() :
+            self.merging.set()
+            threading.Thread(target=self.merge, daemon=True).start()
+
+    def merge(self) :
+        """
+        Merge the MERGE_FACTOR smallest segments into one until there are at
+        most MAX_SEGMENTS. The merged segment is written without the locks,
+        documents deleted in the meantime are deleted in it before the swap.
+        """
+        try :
+            while True :
+                with self.lock :
+                    self.reload()
+                    if len(self.segments) <= MAX_SEGMENTS :
+                        return
+                    chosen = sorted(self.segments, key=lambda segment : segment.live_count)[:MERGE_FACTOR]
+                    masks = [segment.live for segment in chosen]
+                name = merge_segments(self.directory, "seg_%s"%uuid.uuid4().hex[:12], chosen, masks)
+                merged = self._open(name)
+                with self.lock :
+                    lock = self._file_lock()
+                    try :
+                        self.reload()
+                        names = set(segment.name for segment in self.segments)
+                        if not all(segment.name in names for segment in chosen) :
+                            shutil.rmtree(merged.path, ignore_errors=True)
+                            continue # merged by another process
+                        current = dict((segment.name, segment) for segment in self.segments)
+                        self._delete([merged], [segment.ids[number] for segment, live in zip(chosen, masks)
+                            for number in np.flatnonzero(live & ~current[segment.name].live)])
+                        segments = [segment for segment in self.segments if segment not in chosen]
+                        segments.append(merged)
+                        self._save(segments)
+                        self.segments = segments
+                        self.generation += 1
+                    finally :
+                        lock.close()
+                # the files stay readable by the searches still using them
+                for segment in chosen :
+                    shutil.rmtree(segment.path, ignore_errors=True)
+                logging.info("merged %d segments into %s (%d documents)"%(len(chosen), name, merged.size))
+        finally :
+            self.merging.clear()
+
+    def snapshot(self) :
+        """
+        Segments and their live masks, consistent for a search.
+        """
+        if self.buffer :
+            self.refresh()
+        self.reload()
+        with self.lock :
+            return [(segment, segment.live) for segment in self.segments]
+
+    def get(self, doc_id) :
+        # the buffer is read first : no refresh (bulk updates get each document)
+        with self.lock :
+            if doc_id in self.buffer :
+                return self.buffer[doc_id]
+        self.reload()
+        with self.lock :
+            segments = [(segment, segment.live) for segment in self.segments]
+        for segment, live in reversed(segments) :
+            number = segment.numbers.get(doc_id)
+            if number is not None and live[number] :
+                return segment.source(number)
+        return None
+
+    def count(self) :
+        return sum(int(live.sum()) for segment, live in self.snapshot())
+
+    def search(self, terms=None, boosts=None, operator="or", weighted=False, domains=None,
+            exclude_domains=None, accept=None, pagerank=None) :
+        """
+        Score the documents matching terms (all documents when terms is None)
+        with BM25F. boosts : boost of each field. pagerank : (pivot, boost)
+        of the saturated PageRank added to the scores. Filters : domains to
+        keep or exclude, accept(source) for other fields (slow, reads sources).
+        Return the matches as arrays (scores, segment numbers, document
+        numbers, global domain ids) and the segments.
+        """
+        segments = self.snapshot()
+        boosts = np.asarray([boosts.get(field, 0.0) for field in FIELDS] if boosts else [1.0] * len(FIELDS))
+        total = sum(segment.size for segment, _ in segments)
+        lengths = sum((np.asarray(segment.lengths, dtype=np.float64).sum(axis=0) for segment, _ in segments),
+            np.zeros(len(FIELDS)))
+        average = np.maximum(lengths / max(total, 1), 1e-9)
+        terms = list(dict.fromkeys(terms)) if terms is not None else None
+        frequencies = dict((term, sum(segment.terms.get(term, (0, 0, 0))[2] for segment, _ in segments))
+            for term in terms or ())
+        results = []
+        for position, (segment, live) in enumerate(segments) :
+            if terms is None :
+                scores = np.ones(segment.size, dtype=np.float64)
+                matched = live.copy()
+            else :
+                scores = np.zeros(segment.size, dtype=np.float64)
+                hits = np.zeros(segment.size, dtype=np.int32)
+                for term in terms :
+                    numbers, tf = segment.postings_of(term)
+                    if numbers is None :
+                        continue
+                    df = frequencies[term]
+                    idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+                    # field frequencies normalized by the field lengths, then boosted
+                    norms = (1 - B) + B * segment.lengths[numbers] / average
+                    pseudo = (tf / norms) @ boosts
+                    scores[numbers] += idf * pseudo / (K1 + pseudo)
+                    hits[numbers] += pseudo > 0
+                matched = live & (hits >= (len(terms) if operator == "and" else 1)) & (hits > 0)
+            if domains is not None :
+                matched &= np.isin(segment.domain_gids[segment.domain_ids], domains)
+            if exclude_domains is not None :
+                matched &= ~np.isin(segment.domain_gids[segment.domain_ids], exclude_domains)
+            numbers = np.flatnonzero(matched)
+            if accept is not None :
+                numbers = np.asarray([number for number in numbers if accept(segment.source(number))],
+                    dtype=np.int64)
+            if len(numbers) == 0 :
+                continue
+            scores = scores[numbers]
+            if pagerank is not None :
+                ranks = segment.pageranks[numbers]
+                scores = scores + pagerank[1] * ranks / (ranks + pagerank[0])
+            if weighted :
+                scores = scores * segment.weights[numbers]
+            results.append((scores, np.full(len(numbers), position), numbers,
+                segment.domain_gids[segment.domain_ids[numbers]]))
+        if not results :
+            empty = np.zeros(0, dtype=np.int64)
+            return (np.zeros(0), empty, empty, empty), [segment for segment, _ in segments]
+        return tuple(np.concatenate(column) for column in zip(*results)), [segment for segment, _ in segments]
+
+    def domain_ids(self, domains) :
+        return [self.domain_table[domain] for domain in domains if domain in self.domain_table]
+
+def collapse(scores, domains, order, per_domain, max_domains) :
+    """
+    Positions of the per_domain best matches of the max_domains best domains,
+    grouped by domain, best domain first. order : matches by decreasing score.
+    """
+    ranked_domains = domains[order]
+    # rank of each match within its domain
+    by_domain = np.argsort(ranked_domains, kind="stable")
+    sorted_domains = ranked_domains[by_domain]
+    starts = np.flatnonzero(np.concatenate(([True], sorted_domains[1:] != sorted_domains[:-1])))
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[by_domain] = np.arange(len(order)) - np.repeat(starts, np.diff(np.append(starts, len(order))))
+    best = order[ranks == 0][:max_domains]
+    groups = []
+    for first in best :
+        domain = domains[first]
+        groups.append(order[(ranked_domains == domain) & (ranks < per_domain)])
+    return groups
+
+class LocalIndices(object):
+    """
+    indices namespace of LocalClient.
+    """
+
+    def __init__(self, client) :
+        self.client = client
+
+    def create(self, index, body=None, ignore=None, **params) :
+        path = os.path.join(self.client.directory, index)
+        if os.path.exists(path) :
+            return {"error":{"type":"resource_already_exists_exception"}, "status":400}
+        os.makedirs(path)
+        with open(os.path.join(path, "mapping.json"), "w") as f :
+            json.dump((body or {}).get("mappings", {}), f)
+        return {"acknowledged":True, "index":index}
+
+    def delete(self, index, ignore=None, **params) :
+        for name in self.client.resolve(index) :
+            with self.client.lock :
+                self.client.indexes.pop(name, None)
+            shutil.rmtree(os.path.join(self.client.directory, name), ignore_errors=True)
+        return {"acknowledged":True}
+
+    def refresh(self, index=None, **params) :
+        for name in self.client.resolve(index) :
+            self.client.index_of(name).refresh()
+        return {"_shards":{"total":1, "successful":1, "failed":0}}
+
+    def exists(self, index, **params) :
+        return bool(self.client.resolve(index))
+
+    def get_mapping(self, index=None, **params) :
+        mappings = {}
+        for name in self.client.resolve(index) :
+            try :
+                with open(os.path.join(self.client.directory, name, "mapping.json")) as f :
+                    mappings[name] = {"mappings":json.load(f)}
+            except IOError :
+                mappings[name] = {"mappings":{}}
+        return mappings
+
+    def put_mapping(self, body, index=None, **params) :
+        for name in self.client.resolve(index) :
+            mapping = self.get_mapping(name)[name]["mappings"]
+            mapping.setdefault("properties", {}).update(body.get("properties", {}))
+            with open(os.path.join(self.client.directory, name, "mapping.json"), "w") as f :
+                json.dump(mapping, f)
+        return {"acknowledged":True}
+
+class UnsupportedQuery(ValueError):
+    """
+    Query not supported by the local backend.
+    """
+
+# body keys of a search accepted as keyword arguments, as the Elasticsearch client does
+BODY_KEYS = ("query", "size", "from_", "sort", "aggs", "highlight", "_source", "search_after",
+    "rescore", "track_total_hits")
+
+class LocalClient(object):
+    """
+    Elasticsearch client API (the subset used by the project) over the
+    local indexes of a directory.
+    """
+
+    def __init__(self, directory) :
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.indexes = {}
+        self.scrolls = {}
+        self.lock = threading.Lock()
+        self.indices = LocalIndices(self)
+
+    def index_of(self, name) :
+        with self.lock :
+            if name not in self.indexes :
+                self.indexes[name] = LocalIndex(os.path.join(self.directory, name))
+            return self.indexes[name]
+
+    def resolve(self, index) :
+        """
+        Existing index names of a name, list or pattern (web-*, _all).
+        """
+        names = [name for name in os.listdir(self.directory)
+            if os.path.isdir(os.path.join(self.directory, name))]
+        patterns = index.split(",") if isinstance(index, str) else (index or ["*"])
+        patterns = ["*" if pattern == "_all" else pattern for pattern in patterns]
+        return sorted(name for name in names if any(fnmatch.fnmatch(name, pattern) for pattern in patterns))
+
+    def info(self, **params) :
+        return {"name":"local", "cluster_name":"local", "version":{"number":"7.17.0",
+            "build_flavor":"local"}, "tagline":"You Know, for Search"}
+
+    def ping(self, **params) :
+        return True
+
+    def close(self) :
+        pass
+
+    def bulk(self, body, index=None, **params) :
+        lines = [json.loads(line) for line in body.split("\n") if line.strip()] if isinstance(body, str) else body
+        items = []
+        touched = set()
+        position = 0
+        while position < len(lines) :
+            op_type, meta = next(iter(lines[position].items()))
+            name = meta.get("_index", index)
+            target = self.index_of(name)
+            touched.add(target)
+            if op_type == "delete" :
+                target.delete(meta["_id"])
+                position += 1
+                items.append({op_type:{"_index":name, "_id":meta["_id"], "status":200}})
+                continue
+            source = lines[position + 1]
+            position += 2
+            status = 200
+            if op_type == "update" :
+                if not target.update(meta["_id"], source.get("doc", {})) :
+                    status = 404
+            else :
+                target.add(meta["_id"], source)
+            items.append({op_type:{"_index":name, "_id":meta["_id"], "status":status}})
+        # the documents of a bulk request are searchable when it returns, as
+        # written by another process (crawler workers) than the searches
+        for target in touched :
+            target.refresh()
+        return {"took":0, "errors":any(next(iter(item.values()))["status"] >= 300 for item in items),
+            "items":items}
+
+    def index(self, index, body, id=None, **params) :
+        doc_id = id or uuid.uuid4().hex
+        self.index_of(index).add(doc_id, body)
+        return {"_index":index, "_id":doc_id, "result":"created"}
+
+    def count(self, index=None, body=None, **params) :
+        return {"count":sum(self.index_of(name).count() for name in self.resolve(index))}
+
+    def mget(self, body, index=None, _source_includes=None, _source_excludes=None, **params) :
+        docs = []
+        for doc_id in body["ids"] :
+            source = self.index_of(index).get(doc_id)
+            if source is None :
+                docs.append({"_index":index, "_id":doc_id, "found":False})
+            else :
+                docs.append({"_index":index, "_id":doc_id, "found":True,
+                    "_source":filter_source(source, _source_includes, _source_excludes)})
+        return {"docs":docs}
+
+    def msearch(self, body, index=None, **params) :
+        lines = [json.loads(line) for line in body.split("\n") if line.strip()] if isinstance(body, str) else body
+        responses = []
+        for header, search in zip(lines[0::2], lines[1::2]) :
+            try :
+                responses.append(dict(self.search(index=header.get("index", index), body=search), status=200))
+            except UnsupportedQuery as e :
+                responses.append({"error":{"type":"unsupported_query", "reason":str(e)}, "status":400})
+        return {"took":0, "responses":responses}
+
+    def scroll(self, scroll_id=None, body=None, **params) :
+        scroll_id = scroll_id or (body or {}).get("scroll_id")
+        with self.lock :
+            state = self.scrolls.get(scroll_id)
+        if state is None :
+            return {"_scroll_id":None, "hits":{"hits":[]}, "_shards":{"total":1, "successful":1, "skipped":0}}
+        hits, size = state
+        page, rest = hits[:size], hits[size:]
+        with self.lock :
+            self.scrolls[scroll_id] = (rest, size)
+        return {"_scroll_id":scroll_id, "hits":{"hits":[hit() for hit in page]},
+            "_shards":{"total":1, "successful":1, "skipped":0, "failed":0}}
+
+    def open_point_in_time(self, index, **params) :
+        # searches see the documents refreshed since, there is no snapshot
+        return {"id":index}
+
+    def close_point_in_time(self, body=None, **params) :
+        return {"succeeded":True}
+
+    def clear_scroll(self, scroll_id=None, body=None, **params) :
+        with self.lock :
+            self.scrolls.pop(scroll_id or (body or {}).get("scroll_id"), None)
+        return {"succeeded":True}
+
+    def search(self, index="_all", body=None, scroll=None, **params) :
+        """
+        Search with an Elasticsearch request body. Supported queries :
+        multi_match, simple_query_string, match_all, term, terms, exists,
+        rank_feature of the PageRank (saturation), bool (must, filter,
+        must_not, should clauses other than rank_feature are ignored) and
+        function_score with the weight field value factor. Supported
+        aggregations : the per domain buckets of query.expression_query
+        and the domain cardinality of query.cursor_expression_query.
+        """
+        body = dict(body or {})
+        for key in BODY_KEYS :
+            if key in params :
+                body[key.rstrip("_")] = params[key]
+        if "pit" in body :
+            index = body.pop("pit")["id"]
+        names = self.resolve(index)
+        plan = {"terms":None, "boosts":None, "operator":"or", "weighted":False, "domains":None,
+            "exclude_domains":None, "filters":[], "pagerank":None}
+        compile_query(body.get("query", {"match_all":{}}), plan)
+        # weight multiplier of expression_query, applied by its last rescore
+        if "weight" in json.dumps(body.get("rescore", [])) :
+            plan["weighted"] = True
+        size = body.get("size", 10)
+        highlight_terms = set(plan["terms"] or ()) if "highlight" in body or "aggs" in body else None
+
+        matches = []
+        for name in names :
+            target = self.index_of(name)
+            accept = None
+            if plan["filters"] :
+                accept = lambda source, filters=plan["filters"] : all(f(source) for f in filters)
+            (scores, positions, numbers, domains), segments = target.search(plan["terms"],
+                plan["boosts"], plan["operator"], plan["weighted"],
+                target.domain_ids(plan["domains"]) if plan["domains"] is not None else None,
+                target.domain_ids(plan["exclude_domains"]) if plan["exclude_domains"] else None,
+                accept, plan["pagerank"])
+            matches.append((name, scores, positions, numbers, domains, segments))
+
+        def hit(name, score, segment, number, sort=None, fields=body.get("_source")) :
+            source = segment.source(number)
+            result = {"_index":name, "_id":segment.ids[number], "_score":float(score),
+                "_source":filter_source(source, *source_filter(fields))}
+            if highlight_terms :
+                result["highlight"] = highlight(source, highlight_terms)
+            if sort is not None :
+                result["sort"] = sort
+            return result
+
+        total = sum(len(scores) for _, scores, _, _, _, _ in matches)
+        response = {"took":0, "timed_out":False, "_shards":{"total":1, "successful":1, "skipped":0, "failed":0},
+            "hits":{"total":{"value":total, "relation":"eq"}, "max_score":None, "hits":[]}}
+        aggregations = body.get("aggs", {})
+        if "per_domain" in aggregations :
+            top = aggregations["per_domain"].get("aggs", {}).get("top_results", {}).get("top_hits", {})
+            per_domain, max_domains = top.get("size", 3), aggregations["per_domain"]["terms"].get("size", 10)
+            # buckets of a domain found in several indices are merged, as by Elasticsearch
+            groups = OrderedDict()
+            for name, scores, positions, numbers, domains, segments in matches :
+                order = np.argsort(-scores, kind="stable")
+                for group in collapse(scores, domains, order, per_domain, max_domains) :
+                    segment, number = segments[positions[group[0]]], numbers[group[0]]
+                    groups.setdefault(segment.domains[segment.domain_ids[number]], []).extend(
+                        (float(scores[i]), name, segments[positions[i]], numbers[i]) for i in group)
+            buckets = []
+            for domain, entries in groups.items() :
+                entries.sort(key=lambda entry : -entry[0])
+                hits = [hit(name, score, segment, number, fields=top.get("_source"))
+                    for score, name, segment, number in entries[:per_domain]]
+                buckets.append({"key":domain, "doc_count":len(entries), "top_hit":{"value":hits[0]["_score"]},
+                    "top_results":{"hits":{"total":{"value":len(entries)}, "hits":hits}}})
+            buckets.sort(key=lambda bucket : -bucket["top_hit"]["value"])
+            response["aggregations"] = {"per_domain":{"buckets":buckets[:max_domains]}}
+            return response
+        if "total_domains" in aggregations :
+            response["aggregations"] = {"total_domains":{"value":len(set(int(d)
+                for _, _, _, _, domains, _ in matches for d in domains))}}
+
+        # flat hits by decreasing score, then by id, after search_after : only
+        # the matches scoring at least as the last hit of the page are sorted
+        start = body.get("from", 0)
+        after = body.get("search_after")
+        ranked = []
+        for name, scores, positions, numbers, domains, segments in matches :
+            candidates = np.arange(len(scores))
+            if after :
+                candidates = candidates[scores <= after[0]]
+            depth = start + size
+            if not scroll and len(candidates) > depth :
+                threshold = np.partition(-scores[candidates], depth - 1)[depth - 1]
+                candidates = candidates[-scores[candidates] <= threshold]
+            ranked.extend((-float(scores[i]), segments[positions[i]].ids[numbers[i]], name,
+                segments[positions[i]], int(numbers[i])) for i in candidates)
+        ranked.sort(key=lambda entry : entry[:2])
+        if after :
+            ranked = [entry for entry in ranked if entry[:2] > (-after[0], after[1])]
+        sort = "sort" in body
+        materialize = lambda entry : hit(entry[2], -entry[0], entry[3], entry[4],
+            [-entry[0], entry[1]] if sort else None)
+        if scroll :
+            scroll_id = uuid.uuid4().hex
+            with self.lock :
+                self.scrolls[scroll_id] = ([lambda entry=entry : materialize(entry) for entry in ranked[size:]], size)
+            response["_scroll_id"] = scroll_id
+        response["hits"]["hits"] = [materialize(entry) for entry in ranked[start:start+size]]
+        if response["hits"]["hits"] :
+            response["hits"]["max_score"] = response["hits"]["hits"][0]["_score"]
+        return response
+
+def compile_query(query, plan) :
+    """
+    Fill the search plan of LocalIndex.search from an Elasticsearch query.
+    """
+    kind, clause = next(iter(query.items()))
+    if kind in ("multi_match", "simple_query_string", "match") :
+        if kind == "match" :
+            field, clause = next(iter(clause.items()))
+            clause = clause if isinstance(clause, dict) else {"query":clause}
+            clause = dict(clause, fields=[field])
+        boosts = {}
+        for field in clause.get("fields", FIELDS) :
+            name, _, boost = field.partition("^")
+            boosts[name] = float(boost or 1)
+        plan["terms"] = tokenize(clause["query"])
+        plan["boosts"] = boosts
+        if clause.get("default_operator", clause.get("operator", "or")).lower() == "and" :
+            plan["operator"] = "and"
+    elif kind == "match_all" :
+        pass
+    elif kind == "bool" :
+        musts = clause.get("must", [])
+        for must in musts if isinstance(musts, list) else [musts] :
+            compile_query(must, plan)
+        filters = clause.get("filter", [])
+        for condition in filters if isinstance(filters, list) else [filters] :
+            compile_query(condition, plan)
+        excluded = clause.get("must_not", [])
+        for condition in excluded if isinstance(excluded, list) else [excluded] :
+            kind_, condition_ = next(iter(condition.items()))
+            if kind_ in ("term", "terms") and "domain" in condition_ :
+                plan["exclude_domains"] = (plan["exclude_domains"] or []) + term_values(condition_["domain"])
+            else :
+                accept = predicate(condition)
+                plan["filters"].append(lambda source : not accept(source))
+        shoulds = clause.get("should", [])
+        for should in shoulds if isinstance(shoulds, list) else [shoulds] :
+            if "rank_feature" in should :
+                compile_query(should, plan)
+    elif kind == "function_score" :
+        compile_query(clause.get("query", {"match_all":{}}), plan)
+        if clause.get("field_value_factor", {}).get("field") == "weight" :
+            plan["weighted"] = True
+    elif kind == "rank_feature" and clause["field"] == "pagerank" :
+        pivot = clause.get("saturation", {}).get("pivot")
+        if pivot is None :
+            raise UnsupportedQuery("rank_feature queries need a saturation pivot on the local backend")
+        plan["pagerank"] = (float(pivot), float(clause.get("boost", 1.0)))
+    elif kind in ("term", "terms") and "domain" in clause :
+        values = term_values(clause["domain"])
+        plan["domains"] = values if plan["domains"] is None else [v for v in plan["domains"] if v in values]
+    else :
+        plan["filters"].append(predicate(query))
+
+def term_values(value) :
+    if isinstance(value, list) :
+        return value
+    return [value.get("value") if isinstance(value, dict) else value]
+
+def predicate(query) :
+    """
+    Function source -> bool of a term, terms or exists query.
+    """
+    kind, clause = next(iter(query.items()))
+    if kind in ("term", "terms") :
+        field, value = next((key, value) for key, value in clause.items() if key != "boost")
+        values = term_values(value)
+        return lambda source : source.get(field) in values
+    if kind == "exists" :
+        return lambda source : source.get(clause["field"]) is not None
+    raise UnsupportedQuery("%s queries are not supported by the local backend"%kind)
+
+def source_filter(spec) :
+    """
+    (includes, excludes) of the _source parameter of a search.
+    """
+    if spec is None or spec is True :
+        return None, None
+    if spec is False :
+        return [], None
+    if isinstance(spec, (list, str)) :
+        return ([spec] if isinstance(spec, str) else spec), None
+    return spec.get("includes"), spec.get("excludes")
+
+def filter_source(source, includes=None, excludes=None) :
+    if includes is not None :
+        source = dict((key, value) for key, value in source.items() if key in includes)
+    if excludes :
+        source = dict((key, value) for key, value in source.items() if key not in excludes)
+    return source
+
+def highlight(source, terms, fragment_size=180) :
+    """
+    Fragment of each field around the first query term, terms in bold.
+    """
+    result = {}
+    pattern = re.compile(r"\b(%s)\b"%"|".join(re.escape(term) for term in sorted(terms)), re.I | re.U)
+    for field in FIELDS :
+        text = source.get(field) or ""
+        match = pattern.search(text) if terms else None
+        if match is None :
+            continue
+        start = max(0, match.start() - fragment_size // 3)
+        fragment = text[start:start+fragment_size]
+        result[field] = [pattern.sub(r"<b>\1</b>", fragment)]
+    return result
+
+clients = {}
+
+def get_client(directory) :
+    """
+    Shared client of the indexes of a directory.
+    """
+    directory = os.path.abspath(directory)
+    if directory not in clients :
+        clients[directory] = LocalClient(directory)
+    return clients[directory]
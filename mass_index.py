@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Submit the explorations of a list of URLs (one per line) to the search engine.
+URLs are normalized and deduplicated, then submitted with a bounded number
+of concurrent requests to /explore, or enqueued directly in the RQ "low"
+queue of explore_job (index.py) when run next to Redis. URLs are sent by
+rounds over their registered domain, so concurrent explorations target
+different websites. Each submitted URL is appended to a state file : an
+interrupted run resumes where it stopped.
+Usage : python mass_index.py <filename> [--server http://localhost:5000]
+        [--redis redis://localhost:6379/0] [--concurrency 8] [--retries 3]
+        [--max-per-domain 0] [--state <filename>.state]
+"""
+
+import os
+import sys
+import time
+import argparse
+import threading
+from itertools import islice
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from w3lib.url import canonicalize_url
+import url
+
+# number of lines of the file read and grouped at once
+BATCH_SIZE = 10000
+
+def normalize(line) :
+    """
+    Canonical form of an URL of the list, None for blank lines and comments.
+    """
+    link = line.strip()
+    if not link or link.startswith("#") :
+        return None
+    if "://" not in link :
+        link = "http://" + link
+    return canonicalize_url(link)
+
+def by_domain(links, max_per_domain=0) :
+    """
+    Order links by rounds over their domains (one link of each domain per round).
+    """
+    groups = OrderedDict()
+    for link in links :
+        group = groups.setdefault(url.domain(link) or link, [])
+        if not max_per_domain or len(group) < max_per_domain :
+            group.append(link)
+    rounds = []
+    for i in range(max((len(group) for group in groups.values()), default=0)) :
+        rounds.extend(group[i] for group in groups.values() if i < len(group))
+    return rounds
+
+class Submitter(object):
+    """
+    Submit explorations with retries, through the HTTP API (one session per
+    thread) or RQ.
+    """
+
+    def __init__(self, server=None, redis_url=None, retries=3, backoff=1.0) :
+        self.server = server
+        self.retries = retries
+        self.backoff = backoff
+        self.local = threading.local()
+        self.queue = None
+        if redis_url :
+            from redis import Redis
+            from rq import Queue
+            self.queue = Queue("low", connection=Redis.from_url(redis_url))
+
+    @property
+    def session(self) :
+        session = getattr(self.local, "session", None)
+        if session is None :
+            session = self.local.session = requests.Session()
+        return session
+
+    def submit_once(self, link) :
+        if self.queue is not None :
+            self.queue.enqueue("index.explore_job", link)
+            return
+        r = self.session.post(self.server.rstrip("/")+"/explore", data={"url":link}, timeout=30)
+        if r.status_code == 429 or r.status_code >= 500 :
+            raise IOError("HTTP %d"%r.status_code)
+        r.raise_for_status()
+
+    def submit(self, link) :
+        """
+        Submit a link, retrying on connection errors and overloaded server.
+        Return None or the last error.
+        """
+        for attempt in range(self.retries + 1) :
+            try :
+                self.submit_once(link)
+                return None
+            except requests.HTTPError as e :
+                return e # rejected by the server, no retry
+            except Exception as e :
+                error = e
+                time.sleep(self.backoff * 2 ** attempt)
+        return error
+
+class Progress(object):
+    """
+    Progress and throughput, printed at most once per second.
+    """
+
+    def __init__(self, state_filename) :
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.failed = 0
+        self.begin = time.time()
+        self.printed = 0
+        self.state = open(state_filename, "a")
+
+    def done(self, link, error) :
+        with self.lock :
+            if error is None :
+                self.submitted += 1
+                self.state.write(link+"\n")
+                self.state.flush()
+            else :
+                self.failed += 1
+                print("failed %s : %s"%(link, error), file=sys.stderr)
+            if time.time() - self.printed >= 1 :
+                self.print()
+
+    def print(self) :
+        self.printed = time.time()
+        elapsed = max(self.printed - self.begin, 1e-6)
+        print("%d submitted, %d failed, %.1f urls/s"%(self.submitted, self.failed,
+            self.submitted / elapsed))
+        sys.stdout.flush()
+
+def on_done(progress, pending, link) :
+    """
+    Callback of the submission of link : record it, then release its slot
+    of pending, also when recording fails (the run would block).
+    """
+    def done(future) :
+        try :
+            error = future.exception()
+            progress.done(link, error if error is not None else future.result())
+        finally :
+            pending.release()
+    return done
+
+def load_state(filename) :
+    if not os.path.exists(filename) :
+        return set()
+    with open(filename) as f :
+        return set(line.strip() for line in f if line.strip())
+
+def main() :
+    parser = argparse.ArgumentParser(description="Submit the explorations of a list of URLs.")
+    parser.add_argument("filename")
+    parser.add_argument("--server", default="http://localhost:5000", help="URL of the search engine API")
+    parser.add_argument("--redis", help="enqueue in the RQ low queue of this Redis instead of the API")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--retries", type=int, default=3)
+    parser.add_argument("--max-per-domain", type=int, default=0, help="0 : no limit")
+    parser.add_argument("--state", help="file of the submitted URLs (default : <filename>.state)")
+    args = parser.parse_args()
+
+    state_filename = args.state or args.filename + ".state"
+    seen = load_state(state_filename)
+    if seen :
+        print("resuming : %d urls already submitted"%len(seen))
+    submitter = Submitter(args.server, args.redis, args.retries)
+    progress = Progress(state_filename)
+    skipped = 0
+    # bounded number of pending submissions : the file is streamed
+    pending = threading.BoundedSemaphore(args.concurrency * 2)
+    with open(args.filename) as f, ThreadPoolExecutor(args.concurrency) as executor :
+        while True :
+            lines = list(islice(f, BATCH_SIZE))
+            if not lines :
+                break
+            links = []
+            for line in lines :
+                link = normalize(line)
+                if link is None or link in seen :
+                    skipped += link is not None
+                    continue
+                seen.add(link)
+                links.append(link)
+            for link in by_domain(links, args.max_per_domain) :
+                pending.acquire()
+                future = executor.submit(submitter.submit, link)
+                future.add_done_callback(on_done(progress, pending, link))
+    progress.print()
+    print("%d duplicate or already submitted urls skipped"%skipped)
+    progress.state.close()
+
+if __name__ == "__main__" :
+    main()
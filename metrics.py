@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Counters and latency histograms of the crawl pipeline, the Elasticsearch
+requests, the jobs and the search requests, exposed by the servers on
+/metrics in the Prometheus text format. Recording a value costs a lock
+and a few dictionary operations, so metrics are always on.
+Each process records in its own registry : the crawl workers of the
+scheduler send snapshots of theirs to the scheduler (scheduler.py), which
+publishes them in Redis, the Redis queue workers publish theirs in Redis
+after each job (publish), and the page analysis processes
+return their stage durations with the pages (document.analyze).
+SamplingProfiler is an opt-in statistical profiler, started for a single
+crawl job (profile option of /explore).
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import bisect
+import threading
+import contextlib
+from collections import Counter as Tally
+
+# snapshots published in Redis, kept PUBLISHED_TTL seconds
+PUBLISHED_KEY = "metrics:process:%s"
+PUBLISHED_TTL = 86400
+
+# upper bounds (seconds) of the buckets of the latency histograms
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Counter(object):
+    """
+    Monotonic counter, per set of label values.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, description, labels=()) :
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {} # label values -> value
+
+    def inc(self, amount=1, **labels) :
+        key = tuple(str(labels[label]) for label in self.labels)
+        with self.lock :
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def snapshot(self) :
+        with self.lock :
+            return [[list(key), value] for key, value in self.values.items()]
+
+class Histogram(object):
+    """
+    Distribution of observed values (durations in seconds) in cumulative
+    buckets, with their sum and count, per set of label values.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=BUCKETS) :
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.values = {} # label values -> [counts per bucket (+Inf last), sum]
+
+    def observe(self, value, **labels) :
+        key = tuple(str(labels[label]) for label in self.labels)
+        position = bisect.bisect_left(self.buckets, value)
+        with self.lock :
+            entry = self.values.get(key)
+            if entry is None :
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][position] += 1
+            entry[1] += value
+
+    def snapshot(self) :
+        with self.lock :
+            return [[list(key), list(counts), total] for key, (counts, total) in self.values.items()]
+
+class Registry(object):
+    """
+    Metrics of a process, by name.
+    """
+
+    def __init__(self) :
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def get(self, kind, name, description, labels=(), **options) :
+        """
+        Metric of a name, created on first use.
+        """
+        with self.lock :
+            metric = self.metrics.get(name)
+            if metric is None :
+                metric = self.metrics[name] = kind(name, description, labels, **options)
+            return metric
+
+    def snapshot(self) :
+        """
+        Picklable copy of the values of the metrics.
+        """
+        with self.lock :
+            metrics = list(self.metrics.values())
+        return dict((metric.name, {"kind":metric.kind, "description":metric.description,
+            "labels":list(metric.labels), "buckets":list(getattr(metric, "buckets", [])),
+            "values":metric.snapshot()}) for metric in metrics)
+
+registry = Registry()
+
+def counter(name, description, labels=()) :
+    return registry.get(Counter, name, description, labels)
+
+def histogram(name, description, labels=(), buckets=BUCKETS) :
+    return registry.get(Histogram, name, description, labels, buckets=buckets)
+
+@contextlib.contextmanager
+def timed(metric, **labels) :
+    """
+    Observe the duration of a block in a histogram (also when it fails).
+    """
+    begin = time.perf_counter()
+    try :
+        yield
+    finally :
+        metric.observe(time.perf_counter() - begin, **labels)
+
+class Stopwatch(object):
+    """
+    Durations of consecutive steps : lap(name) ends a step.
+    """
+
+    def __init__(self) :
+        self.laps = {}
+        self.last = time.perf_counter()
+
+    def lap(self, name) :
+        now = time.perf_counter()
+        self.laps[name] = self.laps.get(name, 0.0) + now - self.last
+        self.last = now
+
+def _escape(value) :
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names, values, extra=None) :
+    pairs = list(zip(names, values)) + sorted((extra or {}).items())
+    if not pairs :
+        return ""
+    return "{%s}"%",".join('%s="%s"'%(name, _escape(str(value))) for name, value in pairs)
+
+def render(snapshots) :
+    """
+    Prometheus text exposition of a list of (extra labels, snapshot), the
+    samples of a metric in all the snapshots grouped under its name.
+    """
+    families = {}
+    for extra, snapshot in snapshots :
+        for name, metric in snapshot.items() :
+            families.setdefault(name, (metric, []))[1].append((extra, metric))
+    lines = []
+    for name in sorted(families) :
+        first, members = families[name]
+        lines.append("# HELP %s %s"%(name, first["description"]))
+        lines.append("# TYPE %s %s"%(name, first["kind"]))
+        for extra, metric in members :
+            for entry in metric["values"] :
+                if metric["kind"] == "counter" :
+                    lines.append("%s%s %r"%(name, _labels(metric["labels"], entry[0], extra), entry[1]))
+                    continue
+                values, counts, total = entry
+                cumulative = 0
+                for bound, count in zip(metric["buckets"] + ["+Inf"], counts) :
+                    cumulative += count
+                    lines.append("%s_bucket%s %d"%(name, _labels(metric["labels"] + ["le"],
+                        values + [bound], extra), cumulative))
+                lines.append("%s_sum%s %r"%(name, _labels(metric["labels"], values, extra), total))
+                lines.append("%s_count%s %d"%(name, _labels(metric["labels"], values, extra), cumulative))
+    return "\n".join(lines) + "\n"
+
+def publish(redis, name, snapshot=None) :
+    """
+    Store the snapshot of the metrics of the process (or a snapshot received
+    from another process) in Redis.
+    """
+    from redis.exceptions import RedisError
+    try :
+        redis.set(PUBLISHED_KEY%name, json.dumps(snapshot if snapshot is not None else registry.snapshot()),
+            ex=PUBLISHED_TTL)
+    except RedisError as e :
+        logging.warning("metrics not published : %s"%e)
+
+def published(redis) :
+    """
+    (extra labels, snapshot) of the snapshots published in Redis.
+    """
+    from redis.exceptions import RedisError
+    snapshots = []
+    try :
+        for key in redis.scan_iter(match=PUBLISHED_KEY%"*") :
+            data = redis.get(key)
+            if data is not None :
+                name = key.decode("utf8")[len(PUBLISHED_KEY%""):]
+                snapshots.append(({"process":name}, json.loads(data)))
+    except RedisError as e :
+        logging.warning("published metrics unavailable : %s"%e)
+    return snapshots
+
+class SamplingProfiler(object):
+    """
+    Statistical profiler : a thread samples the stacks of the other threads
+    of the process every interval seconds and counts them, written as
+    collapsed stacks (one "file:function;...;file:function count" line per
+    stack, the input of flame graph tools).
+    """
+
+    def __init__(self, interval=float(os.getenv("PROFILE_INTERVAL", "0.01"))) :
+        self.interval = interval
+        self.stacks = Tally()
+        self.samples = 0
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self) :
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def _run(self) :
+        me = threading.get_ident()
+        while not self.stopping.wait(self.interval) :
+            for thread_id, frame in sys._current_frames().items() :
+                if thread_id == me :
+                    continue
+                stack = []
+                while frame is not None :
+                    stack.append("%s:%s"%(os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self) :
+        self.stopping.set()
+        if self.thread is not None :
+            self.thread.join()
+        return self
+
+    def write(self, path) :
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f :
+            for stack, count in self.stacks.most_common() :
+                f.write("%s %d\n"%(stack, count))
+        return path
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Static rank of the indexed pages : PageRank of the link graph recorded by
+the crawler (the links field of the pages, see recrawl.LinkRecorderMiddleware),
+computed offline by power iteration over a sparse matrix, and written back
+in bulk as the pagerank rank feature used by the queries (query.pagerank_clause).
+Links to pages which are not indexed are ignored, links to a near-duplicate
+go to its canonical page, several links between two pages count once.
+Scores are normalized to a mean of 1, a page is only updated when its
+score changed by more than MIN_CHANGE.
+Usage : python pagerank.py [--index web-*] [--damping 0.85] [--dry-run]
+"""
+
+import os
+import time
+import logging
+import argparse
+import numpy as np
+from scipy import sparse
+from urllib.parse import urldefrag
+from elasticsearch.helpers import scan
+import backend
+from bulk import BulkIndexer
+
+DAMPING = 0.85
+TOLERANCE = 1e-6 # L1 distance between two iterations
+MAX_ITERATIONS = 100
+MIN_CHANGE = 0.01 # relative change of the score of a page to update it
+FIELDS = ["url", "links", "canonical", "pagerank"]
+
+def load_graph(es, index="web-*") :
+    """
+    Pages (index, id, stored score) and links (arrays of source and target
+    page numbers) of the indexed pages.
+    """
+    pages, numbers, links, canonicals = [], {}, [], {}
+    for hit in scan(es, index=index, query={"query":{"match_all":{}}}, _source=FIELDS) :
+        source = hit["_source"]
+        numbers[hit["_id"]] = len(pages)
+        pages.append((hit["_index"], hit["_id"], source.get("pagerank")))
+        links.append(source.get("links") or [])
+        if source.get("canonical") :
+            canonicals[hit["_id"]] = source["canonical"]
+    # links to a near-duplicate count for its canonical page
+    for page, canonical in canonicals.items() :
+        if canonical in numbers :
+            numbers[page] = numbers[canonical]
+    sources, targets = [], []
+    for number, page_links in enumerate(links) :
+        for link in page_links :
+            target = numbers.get(urldefrag(link)[0])
+            if target is not None and target != number :
+                sources.append(number)
+                targets.append(target)
+    return pages, np.asarray(sources, dtype=np.int64), np.asarray(targets, dtype=np.int64)
+
+def pagerank(sources, targets, count, damping=DAMPING, tolerance=TOLERANCE, max_iterations=MAX_ITERATIONS) :
+    """
+    PageRank of count pages linked by sources -> targets, summing to 1, and
+    the number of iterations. The rank of pages without links is spread over
+    all pages.
+    """
+    if count == 0 :
+        return np.zeros(0), 0
+    graph = sparse.csr_matrix((np.ones(len(sources)), (targets, sources)), shape=(count, count))
+    graph.data[:] = 1 # duplicate links summed by the conversion
+    out_degrees = np.asarray(graph.sum(axis=0)).ravel()
+    dangling = out_degrees == 0
+    graph = graph @ sparse.diags(np.divide(1.0, out_degrees, out=np.zeros(count), where=~dangling))
+    graph = graph.tocsr()
+    ranks = np.full(count, 1.0 / count)
+    for iteration in range(1, max_iterations + 1) :
+        updated = damping * (graph @ ranks + ranks[dangling].sum() / count) + (1 - damping) / count
+        delta = np.abs(updated - ranks).sum()
+        ranks = updated
+        if delta < tolerance :
+            break
+    return ranks, iteration
+
+def write_ranks(es, pages, ranks, min_change=MIN_CHANGE) :
+    """
+    Store the scores (ranks normalized to a mean of 1) of the pages whose
+    score changed, return the number of updated pages.
+    """
+    indexer = BulkIndexer(es)
+    for index in set(index for index, _, _ in pages) :
+        es.indices.put_mapping(index=index, body={"properties":{"pagerank":{"type":"rank_feature"}}})
+    scores = ranks * len(ranks)
+    updated = 0
+    for (index, doc_id, stored), score in zip(pages, scores.tolist()) :
+        if stored and abs(score - stored) <= min_change * stored :
+            continue
+        updated += 1
+        if indexer.add(index, doc_id, {"pagerank":round(score, 6)}, op_type="update") :
+            indexer.flush(index)
+    indexer.flush_all()
+    return updated
+
+def main() :
+    parser = argparse.ArgumentParser(description="Compute the PageRank of the indexed pages.")
+    parser.add_argument("--index", default="web-*")
+    parser.add_argument("--damping", type=float, default=DAMPING)
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    parser.add_argument("--dry-run", action="store_true", help="compute the scores without storing them")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s %(message)s')
+
+    host, user, pwd, port = (os.getenv(name) for name in ("HOST", "USERNAME", "PASSWORD", "PORT"))
+    es = backend.create_client(hosts="http://%s:%s@%s:%s/"%(user, pwd, host, port), timeout=60)
+    begin = time.perf_counter()
+    pages, sources, targets = load_graph(es, args.index)
+    loaded = time.perf_counter()
+    logging.info("%d pages, %d links loaded in %.1f s"%(len(pages), len(sources), loaded - begin))
+    ranks, iterations = pagerank(sources, targets, len(pages), args.damping, args.tolerance)
+    computed = time.perf_counter()
+    logging.info("PageRank computed in %d iterations, %.2f s"%(iterations, computed - loaded))
+    if not args.dry_run :
+        updated = write_ranks(es, pages, ranks)
+        logging.info("%d pages updated in %.1f s"%(updated, time.perf_counter() - computed))
+
+if __name__ == "__main__" :
+    main()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Scrapy item pipelines of the crawler.
+"""
+
+import os
+import time
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import dedup
+import metrics
+import document
+import language_id
+import search_cache
+import suggest
+from bulk import BulkIndexer
+from scrapy.exceptions import DropItem
+from twisted.internet import threads, reactor
+from twisted.internet.task import LoopingCall
+from twisted.internet.defer import Deferred, DeferredList, DeferredSemaphore
+
+# process pools of the content extraction, shared by the crawls of a process
+executors = {}
+
+# duration of the stages of the processing of a page : steps of
+# document.analyze, wait for the pool (pool), near duplicate detection and
+# bulk write (with the retries) of the buffered pages (bulk_index)
+STAGE_SECONDS = metrics.histogram("crawl_stage_seconds", "Duration of the stages of the page processing.",
+    ["stage"])
+
+def get_executor(workers, max_pending) :
+    """
+    Process pool with workers processes and its semaphore of max_pending pages.
+    """
+    if workers not in executors :
+        # fresh interpreters : no reactor or connection inherited from the crawler,
+        # the language profiles are loaded when a worker starts, not on its first page
+        executors[workers] = (ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"),
+            initializer=language_id.get_factory), DeferredSemaphore(max_pending))
+    return executors[workers]
+
+class ContentExtractionPipeline(object):
+    """
+    Analyze the pages yielded by crawler.pipeline (document.analyze : parse,
+    language detection, boilerplate removal) in a pool of processes, so the
+    reactor keeps downloading while pages are analyzed.
+    At most CONTENT_MAX_PENDING pages are in the pool : the next ones wait,
+    keeping their response in the Scrapy scraper, which stops the downloads
+    once SCRAPER_SLOT_MAX_ACTIVE_SIZE is reached (backpressure).
+    Settings : CONTENT_WORKERS (0 : number of cores), CONTENT_MAX_PENDING
+    """
+
+    def __init__(self, settings, stats) :
+        self.stats = stats
+        self.executor, self.semaphore = get_executor(
+            settings.getint("CONTENT_WORKERS", 0) or os.cpu_count(),
+            settings.getint("CONTENT_MAX_PENDING", 64))
+
+    @classmethod
+    def from_crawler(cls, crawler) :
+        return cls(crawler.settings, crawler.stats)
+
+    def process_item(self, item, spider) :
+        if "html" not in item :
+            return item
+        d = self.semaphore.run(self.analyze, item)
+        d.addCallback(self._analyzed, item, spider, time.perf_counter())
+        return d
+
+    def analyze(self, item) :
+        """
+        Run document.analyze in the pool, return a Deferred.
+        """
+        d = Deferred()
+        future = self.executor.submit(document.analyze, item["url"], item["html"],
+            item["encoding"], item["content_language"])
+        future.add_done_callback(lambda future : reactor.callFromThread(self._done, d, future))
+        return d
+
+    def _done(self, d, future) :
+        error = future.exception()
+        if error is not None :
+            d.errback(error)
+        else :
+            d.callback(future.result())
+
+    def _analyzed(self, result, page, spider, begin) :
+        lang, item = result
+        timings = item.pop("timings", {})
+        for stage, seconds in timings.items() :
+            STAGE_SECONDS.observe(seconds, stage=stage)
+        # waiting for a slot and a process, and transfers
+        STAGE_SECONDS.observe(max(time.perf_counter() - begin - sum(timings.values()), 0.0), stage="pool")
+        languages = getattr(spider, "languages", None)
+        if languages is not None and lang not in languages :
+            self.stats.inc_value("content/unsupported_language")
+            raise DropItem('Language not supported')
+        self.stats.inc_value("content/analyzed")
+        # validators and links for the next incremental crawl (see recrawl.py),
+        # PageRank of the page indexed before (see pagerank.py)
+        for field in ("etag", "last_modified", "fingerprint", "links", "pagerank") :
+            if field in page :
+                item["source"][field] = page[field]
+        return item
+
+class NearDuplicatePipeline(object):
+    """
+    Detect the pages whose main content is a near-duplicate of a page
+    already indexed (SimHash signatures in an LSH index, see dedup.py), and
+    drop them or index them as a reference to the first page (no
+    description nor body, weight 0), so they cost neither index space nor
+    vectorization. The signature is indexed with the page : the index of a
+    crawl starts with the signatures of the pages indexed by the previous
+    ones (spider.indexed_pages, see recrawl.py), which are not analyzed
+    again when they did not change.
+    Settings : NEAR_DUPLICATE_ACTION (drop, canonicalize or none),
+    NEAR_DUPLICATE_DISTANCE (max number of different bits of the signatures)
+    """
+
+    def __init__(self, settings, stats) :
+        self.stats = stats
+        self.action = settings.get("NEAR_DUPLICATE_ACTION", "drop")
+        self.index = dedup.SimHashIndex(settings.getint("NEAR_DUPLICATE_DISTANCE", dedup.DISTANCE))
+        self.seeded = False
+
+    @classmethod
+    def from_crawler(cls, crawler) :
+        return cls(crawler.settings, crawler.stats)
+
+    def seed(self, pages) :
+        """
+        Add the stored signatures of the indexed pages (by url), but those of
+        the pages indexed as near-duplicates.
+        """
+        for page_url, page in pages.items() :
+            if page.get("simhash") and not page.get("canonical") :
+                self.index.add(dedup.decode(page["simhash"]), page_url)
+        self.stats.set_value("near_duplicate/seeded", self.index.size)
+
+    def process_item(self, item, spider) :
+        # the indexed pages are loaded once the spider is opened, before the first page
+        if not self.seeded :
+            self.seeded = True
+            self.seed(getattr(spider, "indexed_pages", None) or {})
+        signature = item.pop("simhash", None)
+        if signature is None :
+            return item
+        item["source"]["simhash"] = dedup.encode(signature)
+        if self.action == "none" :
+            return item
+        with metrics.timed(STAGE_SECONDS, stage="near_duplicate") :
+            # the previous signature of the page itself is not a duplicate
+            canonical = self.index.find(signature, ignore=item["id"])
+        if canonical is None :
+            self.index.add(signature, item["id"])
+            return item
+        self.stats.inc_value("near_duplicate/%s"%self.action)
+        if self.action == "drop" :
+            raise DropItem('Near-duplicate of %s'%canonical)
+        source = item["source"]
+        source.update(description="", fallback_description="", body="", weight=0, canonical=canonical)
+        return item
+
+class BulkIndexPipeline(object):
+    """
+    Buffer the pages produced by crawler.pipeline per web-<lang> index and
+    write them with the bulk API instead of one index request per page.
+    Bulk requests run in the reactor thread pool so downloads go on while
+    Elasticsearch is writing. After each write, the cached search results of
+    the index are invalidated and the titles of the pages are sent to the
+    suggestions of the servers (suggest.py) through the spider Redis
+    connection, if any.
+    Settings : BULK_INDEX_MAX_DOCS, BULK_INDEX_MAX_BYTES, BULK_INDEX_MAX_INTERVAL,
+    BULK_INDEX_MAX_RETRIES
+    """
+
+    def __init__(self, settings, stats) :
+        self.settings = settings
+        self.stats = stats
+        self.indexer = None
+        self.redis = None
+        self.titles = {} # index -> title, weight and PageRank of the buffered pages
+        self.pending = set()
+        self.task = None
+
+    @classmethod
+    def from_crawler(cls, crawler) :
+        return cls(crawler.settings, crawler.stats)
+
+    def open_spider(self, spider) :
+        # flask_rq2 RQ object or plain Redis connection
+        redis_conn = getattr(spider, "redis_conn", None)
+        self.redis = getattr(redis_conn, "connection", redis_conn)
+        self.indexer = BulkIndexer(spider.es_client,
+            max_docs=self.settings.getint("BULK_INDEX_MAX_DOCS", 500),
+            max_bytes=self.settings.getint("BULK_INDEX_MAX_BYTES", 5*1024*1024),
+            max_interval=self.settings.getfloat("BULK_INDEX_MAX_INTERVAL", 5.0),
+            max_retries=self.settings.getint("BULK_INDEX_MAX_RETRIES", 3))
+        # time based flush, for slow crawls that never fill a buffer
+        self.task = LoopingCall(self.flush_expired)
+        self.task.start(max(self.indexer.max_interval / 2, 0.1), now=False)
+
+    def close_spider(self, spider) :
+        """
+        Flush everything left and wait for in-flight bulk requests.
+        """
+        if self.task and self.task.running :
+            self.task.stop()
+        for index in list(self.indexer.buffers) :
+            self.flush(index)
+        return DeferredList(list(self.pending))
+
+    def process_item(self, item, spider) :
+        source = item["source"]
+        self.titles.setdefault(item["index"], []).append(dict((field, source.get(field))
+            for field in ("title", "weight", "pagerank")))
+        if self.indexer.add(item["index"], item["id"], source) :
+            # wait for the flush : slows down item processing if ES lags behind
+            return self.flush(item["index"]).addCallback(lambda _: item)
+        return item
+
+    def flush_expired(self) :
+        for index in self.indexer.expired() :
+            self.flush(index)
+
+    def flush(self, index) :
+        """
+        Send the buffer of one index in a thread, return a Deferred.
+        """
+        actions = self.indexer.take(index)
+        d = threads.deferToThread(self._send, index, actions, self.titles.pop(index, []))
+        self.pending.add(d)
+        d.addBoth(self._flushed, d, len(actions))
+        return d
+
+    def _send(self, index, actions, titles) :
+        with metrics.timed(STAGE_SECONDS, stage="bulk_index") :
+            failed = self.indexer.send(actions)
+        if self.redis is not None and len(failed) < len(actions) :
+            search_cache.bump_generation(self.redis, index)
+            suggest.publish_titles(self.redis, index, titles)
+        return failed
+
+    def _flushed(self, result, d, count) :
+        self.pending.discard(d)
+        self.stats.inc_value("bulk_index/requests")
+        if isinstance(result, list) :
+            self.stats.inc_value("bulk_index/docs", count - len(result))
+            self.stats.inc_value("bulk_index/failed", len(result))
+        else :
+            logging.error("bulk indexing error : %s"%result.getErrorMessage())
+            self.stats.inc_value("bulk_index/failed", count)
+        return None
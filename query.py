@@ -1,13 +1,59 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+# fields of the pages needed to render a result (see search.format_result) :
+# the bodies are only read by the highlighter, never returned
+RESULT_FIELDS = ["url", "domain", "title", "description", "fallback_description", "thumbnail"]
+
+# static rank of the pages computed from the link graph (see pagerank.py),
+# normalized to a mean of 1 : a page of average PageRank adds half the boost
+PAGERANK_PIVOT = 1.0
+PAGERANK_BOOST = 2.0
+
+def pagerank_clause() :
+    """
+    Should clause adding the saturated PageRank of a page to its score
+    (pages not ranked yet add nothing).
+    """
+    return {
+      "rank_feature": {
+        "field": "pagerank",
+        "saturation": {"pivot": PAGERANK_PIVOT},
+        "boost": PAGERANK_BOOST
+      }
+    }
+
+def weight_rescore() :
+    """
+    Rescore multiplying the scores by the weight of the pages, with a field
+    value factor rather than a script.
+    """
+    return {
+      "query" : {
+         "score_mode": "multiply",
+         "rescore_query" : {
+            "function_score" : {
+               "field_value_factor": {
+                  "field": "weight",
+                  "missing": 1
+               }
+            }
+         }
+      }
+    }
+
 def expression_query(expression) :
     return {
       "query": {
-        "multi_match" : {
-          "query":    expression,
-          "type":       "best_fields",
-          "fields": [ "title^3", "description^2", "body" ]
+        "bool": {
+          "must": {
+            "multi_match" : {
+              "query":    expression,
+              "type":       "best_fields",
+              "fields": [ "title^3", "description^2", "body" ]
+            }
+          },
+          "should": pagerank_clause()
         }
       },
       "rescore" : [{
@@ -24,20 +70,7 @@ def expression_query(expression) :
              "rescore_query_weight" : 1.5
           }
        },
-       {
-          "query" : {
-             "score_mode": "multiply",
-             "rescore_query" : {
-                "function_score" : {
-                   "script_score": {
-                      "script": {
-                        "inline": "_score*doc.weight.value"
-                      }
-                   }
-                }
-             }
-          }
-       } ],
+       weight_rescore() ],
       "size": 0,
       "aggs":{
         "per_domain":{
@@ -50,6 +83,7 @@ def expression_query(expression) :
           "aggs": {
                 "top_results": {
                     "top_hits": {
+                        "_source": RESULT_FIELDS,
                         "highlight" : {
                             "pre_tags" : ["<b>"],
                             "post_tags" : ["</b>"],
@@ -94,11 +128,13 @@ def domain_expression_query(domain, expression) :
                       "fields": [ "title^3", "description^2", "body" ]
                     }
                 },
+                "should": pagerank_clause(),
                 "filter":{
                     "term": {"domain": domain}
                 }
             }
         },
+        "_source": RESULT_FIELDS,
         "highlight" : {
             "pre_tags" : ["<b>"],
             "post_tags" : ["</b>"],
@@ -122,19 +158,86 @@ def domain_expression_query(domain, expression) :
              "rescore_query_weight" : 1.5
           }
         },
-        {
-          "query" : {
-             "score_mode": "multiply",
-             "rescore_query" : {
-                "function_score" : {
-                   "script_score": {
-                      "script": {
-                        "inline": "_score*doc.weight.value"
-                      }
-                   }
+        weight_rescore() ]
+    }
+
+
+def cursor_expression_query(expression, size, search_after=None, seen_domains=None, with_total=False) :
+    """
+    One page of results for cursor pagination, one result per domain.
+    Elasticsearch 7 refuses collapse and rescore together with search_after,
+    so the weight is applied natively by a function score, the cross fields
+    query is a should clause (with the PageRank) and the domains of the
+    last returned results are filtered out.
+    """
+    body = {
+      "query": {
+        "function_score": {
+          "query": {
+            "bool": {
+              "must": {
+                "multi_match" : {
+                  "query":    expression,
+                  "type":       "best_fields",
+                  "fields": [ "title^3", "description^2", "body" ]
                 }
-             }
-          }
-        } ]
+              },
+              "should": [{
+                "multi_match" : {
+                  "query": expression,
+                  "type":       "cross_fields",
+                  "fields": [ "title", "description", "body" ],
+                  "minimum_should_match":"100%",
+                  "boost": 1.5
+                }
+              },
+              pagerank_clause()]
+            }
+          },
+          "field_value_factor": {
+            "field": "weight",
+            "missing": 1
+          },
+          "boost_mode": "multiply"
+        }
+      },
+      "sort": [
+        {"_score": "desc"},
+        {"url": "asc"}
+      ],
+      "size": size,
+      "_source": RESULT_FIELDS,
+      "track_total_hits": False,
+      "highlight" : {
+        "pre_tags" : ["<b>"],
+        "post_tags" : ["</b>"],
+        "fields" : {
+          "title" : {"fragment_size" : 180},
+          "description" : {"fragment_size" : 180},
+          "body" : {"fragment_size" : 180}
+        }
+      }
     }
+    if search_after :
+        body["search_after"] = search_after
+    if seen_domains :
+        body["query"]["function_score"]["query"]["bool"]["must_not"] = {
+          "terms": {"domain": seen_domains}
+        }
+    if with_total :
+        # number of domains matching the query = number of results
+        body["aggs"] = {
+          "total_domains": {
+            "cardinality": {"field": "domain"}
+          }
+        }
+    return body
 
+def lexical_query(expression, size) :
+    """
+    Lexical leg of an hybrid search : the size best hits, scored as the
+    pages of cursor_expression_query, without per domain grouping.
+    """
+    body = cursor_expression_query(expression, size)
+    del body["sort"]
+    return body
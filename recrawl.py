@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Incremental re-crawl of a website.
+The validators of each page (ETag, Last-Modified, fingerprint of the body)
+and its outgoing links are indexed with the page. When a website is
+explored again, they are loaded from the index and sent as conditional
+request headers : a page answered by 304 Not Modified, or whose body did
+not change, is neither analyzed nor indexed again, and its stored links
+are followed so the exploration goes on.
+"""
+
+import hashlib
+import logging
+import url
+from elasticsearch.helpers import scan
+from scrapy import signals
+from twisted.internet import threads
+
+# fields of the indexed pages used by the incremental re-crawl (the
+# PageRank is kept when a page is indexed again, see pagerank.py, the
+# near-duplicates are detected against the signatures of the indexed
+# pages, see pipelines.NearDuplicatePipeline)
+FIELDS = ["url", "etag", "last_modified", "fingerprint", "links", "pagerank", "simhash", "canonical"]
+
+def fingerprint(body) :
+    return hashlib.sha1(body).hexdigest()
+
+def load_validators(es, domain, index="web-*") :
+    """
+    Validators and links of the indexed pages of a domain, by url.
+    """
+    validators = {}
+    for hit in scan(es, index=index, query={"query":{"term":{"domain":domain}}, "_source":FIELDS},
+            ignore_unavailable=True) :
+        source = hit["_source"]
+        validators[source["url"]] = source
+    return validators
+
+class ConditionalRequestMiddleware(object):
+    """
+    Downloader middleware adding If-None-Match / If-Modified-Since to the
+    requests of pages already indexed. The stored validators of a page are
+    available in request.meta["validators"], those of all the pages in
+    spider.indexed_pages.
+    """
+
+    def __init__(self, stats) :
+        self.stats = stats
+        self.validators = {}
+
+    @classmethod
+    def from_crawler(cls, crawler) :
+        middleware = cls(crawler.stats)
+        crawler.signals.connect(middleware.spider_opened, signal=signals.spider_opened)
+        return middleware
+
+    def spider_opened(self, spider) :
+        es = getattr(spider, "es_client", None)
+        if es is None or not spider.start_urls :
+            return None
+        domain = url.domain(spider.start_urls[0])
+        d = threads.deferToThread(load_validators, es, domain)
+        d.addCallbacks(self._loaded, self._failed, callbackArgs=(domain, spider))
+        # the crawl starts once the validators are loaded
+        return d
+
+    def _loaded(self, validators, domain, spider) :
+        logging.info("%d indexed pages of %s for incremental crawl"%(len(validators), domain))
+        self.validators = validators
+        spider.indexed_pages = validators
+
+    def _failed(self, failure) :
+        logging.warning("cannot load validators, full crawl : %s"%failure.getErrorMessage())
+
+    def process_request(self, request, spider) :
+        validators = self.validators.get(request.url)
+        if validators is None or "validators" in request.meta :
+            return None
+        request.meta["validators"] = validators
+        if validators.get("etag") :
+            request.headers.setdefault("If-None-Match", validators["etag"])
+        if validators.get("last_modified") :
+            request.headers.setdefault("If-Modified-Since", validators["last_modified"])
+        self.stats.inc_value("recrawl/conditional_requests", spider=spider)
+        return None
+
+    def process_response(self, request, response, spider) :
+        if response.status == 304 and "validators" in request.meta :
+            self.stats.inc_value("recrawl/not_modified", spider=spider)
+        return response
+
+class LinkRecorderMiddleware(object):
+    """
+    Spider middleware storing in the page items of a response the links
+    extracted from it (the requests of the CrawlSpider rules kept by
+    Crawler.links_processor, produced after the items) : the link graph of
+    pagerank.py, and the links followed again by the incremental re-crawl
+    of pages answered by 304. It runs before the OffsiteMiddleware so the
+    links to other websites are recorded too (they are not followed).
+    """
+
+    def process_spider_output(self, response, result, spider) :
+        pages = []
+        links = []
+        for output in result :
+            if isinstance(output, dict) and "html" in output :
+                pages.append(output) # yielded once all links are known
+                continue
+            if hasattr(output, "url") :
+                links.append(output.url)
+            yield output
+        for page in pages :
+            page["links"] = links
+            yield page
@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Long-lived crawl scheduler.
+A pool of worker processes (one per core by default) each keeps a Twisted
+reactor and a Scrapy CrawlerRunner alive and runs many explorations
+concurrently. Websites are assigned to workers by consistent hashing of
+their host (job_domain), and a worker never crawls the same host twice at
+the same time, so the per-host politeness of DOWNLOAD_DELAY (Scrapy
+download slots) is kept. The exploration stays on the same host.
+The jobs and their state are kept in Redis : any server process submits
+jobs and reads their state, a single one runs the worker pool (or
+python scheduler.py runs it as a service of its own).
+Workers send the snapshots of their metrics (metrics.py) to the scheduler
+every METRICS_INTERVAL seconds, which publishes them in Redis. A job can be profiled : a sampling
+profiler runs in its worker during the job and its stacks are written in
+PROFILE_DIR (the crawls running at the same time in the worker are
+sampled too, the analysis of the pages in the pool processes is not).
+"""
+
+import os
+import json
+import uuid
+import atexit
+import socket
+import time
+import bisect
+import hashlib
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from urllib.parse import urlparse
+from redis.exceptions import RedisError
+import metrics
+
+# Redis keys : state of a job (JSON, kept JOB_TTL seconds), submitted jobs
+# not yet sent to a worker, and server process running the worker pool
+# (renewed while it runs, taken over OWNER_TTL seconds after it stopped)
+JOB_KEY = "crawl:job:%s"
+JOBS_QUEUE = "crawl:jobs"
+OWNER_KEY = "crawl:scheduler"
+JOB_TTL = 7 * 86400
+OWNER_TTL = 30
+# start urls redirected at the same time, and timeout (seconds) of their request
+RESOLVE_THREADS = 16
+RESOLVE_TIMEOUT = 10.0
+REDIS_URL = os.getenv("RQ_REDIS_URL", "redis://localhost:6379/0")
+# seconds between two snapshots of the metrics of a worker
+METRICS_INTERVAL = 10.0
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+JOBS = metrics.counter("crawl_jobs_total", "Exploration jobs by final state.", ["status"])
+JOB_SECONDS = metrics.histogram("crawl_job_seconds", "Duration of the exploration jobs.",
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200))
+
+def _hash(key) :
+    return int.from_bytes(hashlib.md5(key.encode("utf8")).digest()[:8], "big")
+
+class HashRing(object):
+    """
+    Consistent hashing of keys over nodes, with virtual nodes (replicas).
+    """
+
+    def __init__(self, nodes, replicas=64) :
+        self.ring = sorted((_hash("%s:%d"%(node, i)), node) for node in nodes for i in range(replicas))
+        self.keys = [key for key, _ in self.ring]
+
+    def get(self, key) :
+        i = bisect.bisect(self.keys, _hash(key)) % len(self.keys)
+        return self.ring[i][1]
+
+def job_domain(link) :
+    """
+    Key of the website of a link : its host, the allowed domain of its
+    crawl, and the key of its worker and of its politeness.
+    """
+    return urlparse(link).hostname or link
+
+def worker_main(number, jobs, status, content_workers) :
+    """
+    Entry point of a worker process : run the crawls received on the jobs
+    queue in a single reactor, report their state on the status queue.
+    content_workers : processes of the page analysis pool of the worker
+    """
+    import crawler
+    from redis import Redis
+    from twisted.internet import reactor
+    from twisted.internet.task import LoopingCall
+    from scrapy.crawler import CrawlerRunner
+
+    runner = CrawlerRunner(dict(crawler.SETTINGS, CONTENT_WORKERS=content_workers))
+    redis = Redis.from_url(REDIS_URL)
+    running = {} # domain -> jobs waiting for the running crawl of this domain
+
+    def crawl(job_id, link, domain, profile=False, waiting=None) :
+        if domain in running :
+            running[domain].append((job_id, link, profile))
+            return
+        running[domain] = waiting if waiting is not None else deque()
+        status.put((job_id, "running", {"worker":number, "started":time.time()}))
+        profiler = metrics.SamplingProfiler().start() if profile else None
+        spider = runner.create_crawler(crawler.Crawler)
+        d = runner.crawl(spider, allowed_domains=[domain],
+            start_urls=[link,], es_client=crawler.get_client(), redis_conn=redis)
+        d.addCallbacks(finished, failed, callbackArgs=(job_id, spider, profiler, time.time()),
+            errbackArgs=(job_id, profiler, time.time()))
+        d.addBoth(next_job, domain)
+
+    def ended(job_id, profiler, started, state, info) :
+        JOBS.inc(status=state)
+        JOB_SECONDS.observe(time.time() - started)
+        if profiler is not None :
+            info["profile"] = profiler.stop().write(os.path.join(PROFILE_DIR, "%s.txt"%job_id))
+            info["profile_samples"] = profiler.samples
+        status.put((job_id, state, dict(info, finished=time.time())))
+
+    def finished(_, job_id, spider, profiler, started) :
+        stats = spider.stats.get_stats()
+        ended(job_id, profiler, started, "finished", {"pages":stats.get("item_scraped_count", 0),
+            "responses":stats.get("response_received_count", 0)})
+
+    def failed(failure, job_id, profiler, started) :
+        ended(job_id, profiler, started, "failed", {"error":failure.getErrorMessage()})
+
+    def next_job(_, domain) :
+        # the next crawl takes over the waiting jobs before it starts : it
+        # may end (and call next_job) before runner.crawl returns
+        waiting = running.pop(domain)
+        if waiting :
+            job_id, link, profile = waiting.popleft()
+            crawl(job_id, link, domain, profile, waiting)
+
+    def send_metrics() :
+        status.put((None, "metrics", {"worker":number, "metrics":metrics.registry.snapshot()}))
+
+    def listen() :
+        while True :
+            item = jobs.get()
+            if item is None :
+                reactor.callFromThread(reactor.stop)
+                return
+            # start url already redirected by the scheduler (CrawlScheduler.resolve)
+            job_id, link, profile = item
+            reactor.callFromThread(crawl, job_id, link, job_domain(link), profile)
+
+    threading.Thread(target=listen, daemon=True).start()
+    LoopingCall(send_metrics).start(METRICS_INTERVAL, now=False)
+    reactor.run(installSignalHandlers=False)
+
+class CrawlScheduler(object):
+    """
+    Dispatch explorations to the worker processes and track their state.
+    The jobs and their state are kept in Redis, so every server process
+    (uvicorn or gunicorn workers) can submit jobs and read their state,
+    while a single one, the owner of OWNER_KEY, runs the worker pool and
+    its hash ring : a host is never sent to two workers at the same time.
+    """
+
+    def __init__(self, redis=None, workers=None) :
+        if redis is None :
+            from redis import Redis
+            redis = Redis.from_url(REDIS_URL)
+        self.redis = redis
+        self.workers = workers or int(os.getenv("CRAWL_WORKERS", "0")) or os.cpu_count()
+        self.ring = HashRing(range(self.workers))
+        # fresh interpreters : no reactor or connection inherited from the server
+        self.context = multiprocessing.get_context("spawn")
+        self.owner = "%s:%d:%s"%(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.running = False
+        self.queues = []
+        self.processes = []
+        self.status_queue = None
+        self.stopping = threading.Event()
+        self.resolver = None
+
+    def claim(self) :
+        """
+        Start the worker pool in this process if no other process runs it.
+        """
+        if not self.running and self.redis.set(OWNER_KEY, self.owner, nx=True, ex=OWNER_TTL) :
+            logging.info("crawl scheduler %s runs the %d crawl workers"%(self.owner, self.workers))
+            self.start()
+        return self
+
+    def start(self) :
+        self.running = True
+        self.resolver = ThreadPoolExecutor(RESOLVE_THREADS)
+        self.status_queue = self.context.Queue()
+        for number in range(self.workers) :
+            jobs = self.context.Queue()
+            # the cores are shared by the page analysis pools of the workers, not daemonic
+            # since a daemonic process cannot start a pool (stopped at exit instead)
+            process = self.context.Process(target=worker_main, args=(number, jobs, self.status_queue,
+                max(1, os.cpu_count() // self.workers)))
+            process.start()
+            self.queues.append(jobs)
+            self.processes.append(process)
+        threading.Thread(target=self._collect, daemon=True).start()
+        threading.Thread(target=self._dispatch, daemon=True).start()
+        return self
+
+    def stop(self) :
+        if not self.running :
+            return
+        self.stopping.set()
+        for jobs in self.queues :
+            jobs.put(None)
+        for process in self.processes :
+            process.join()
+        self.status_queue.put(None)
+        self.resolver.shutdown(wait=False)
+        try :
+            if self.redis.get(OWNER_KEY) == self.owner.encode("utf8") :
+                self.redis.delete(OWNER_KEY)
+        except RedisError :
+            pass
+
+    def _dispatch(self) :
+        while not self.stopping.is_set() :
+            try :
+                self.redis.set(OWNER_KEY, self.owner, ex=OWNER_TTL)
+                item = self.redis.brpop(JOBS_QUEUE, timeout=1)
+                if item is not None :
+                    # a slow start url does not hold the jobs submitted after it
+                    self.resolver.submit(self.dispatch, json.loads(item[1]))
+            except RedisError as e :
+                logging.warning("crawl scheduler cannot read the jobs : %s"%e)
+                time.sleep(1)
+
+    def resolve(self, link) :
+        """
+        Url of a start url after its redirections, None if unreachable.
+        """
+        import url
+        response = url.crawl(link, timeout=RESOLVE_TIMEOUT)
+        return response.url if response is not None else None
+
+    def dispatch(self, item) :
+        """
+        Send a submitted job to the worker of the host of its redirected
+        start url : the key of the crawl (allowed domain, running crawls).
+        """
+        job_id, link, profile = item
+        try :
+            resolved = self.resolve(link)
+            if resolved is None :
+                JOBS.inc(status="failed")
+                self.update(job_id, "failed", {"finished":time.time(), "error":"unreachable url"})
+                return
+            domain = job_domain(resolved)
+            worker = self.ring.get(domain)
+            self.update(job_id, "queued", {"domain":domain, "worker":worker})
+        except RedisError as e :
+            logging.warning("crawl job state not saved : %s"%e)
+            return
+        self.queues[worker].put((job_id, resolved, profile))
+        logging.info("exploration job %s of %s sent to worker %d"%(job_id, resolved, worker))
+
+    def _collect(self) :
+        while True :
+            item = self.status_queue.get()
+            if item is None :
+                return
+            job_id, state, info = item
+            try :
+                if state == "metrics" :
+                    # read by the /metrics endpoint of every server process
+                    metrics.publish(self.redis, "crawl-%d"%info["worker"], info["metrics"])
+                else :
+                    self.update(job_id, state, info)
+            except RedisError as e :
+                logging.warning("crawl job state not saved : %s"%e)
+
+    def update(self, job_id, state, info) :
+        key = JOB_KEY%job_id
+        data = self.redis.get(key)
+        if data is None :
+            return
+        job = json.loads(data)
+        job["status"] = state
+        job.update(info)
+        self.redis.set(key, json.dumps(job), ex=JOB_TTL)
+
+    def submit(self, link, profile=False) :
+        """
+        Queue the exploration of a website, return its job id.
+        profile : run a sampling profiler during the job (see metrics.py)
+        """
+        job_id = uuid.uuid4().hex
+        job = {"id":job_id, "url":link, "status":"queued", "submitted":time.time(), "profile":bool(profile)}
+        pipeline = self.redis.pipeline()
+        pipeline.set(JOB_KEY%job_id, json.dumps(job), ex=JOB_TTL)
+        pipeline.lpush(JOBS_QUEUE, json.dumps([job_id, link, bool(profile)]))
+        pipeline.execute()
+        return job_id
+
+    def status(self, job_id) :
+        data = self.redis.get(JOB_KEY%job_id)
+        return json.loads(data) if data is not None else None
+
+scheduler = None
+scheduler_lock = threading.Lock()
+
+def get_scheduler() :
+    """
+    Scheduler of the process. It runs the worker pool if no other process
+    does (and CRAWL_SCHEDULER is not 0), otherwise it only submits jobs.
+    """
+    global scheduler
+    with scheduler_lock :
+        if scheduler is None :
+            scheduler = CrawlScheduler()
+            atexit.register(scheduler.stop)
+        if os.getenv("CRAWL_SCHEDULER", "1") == "1" :
+            scheduler.claim()
+    return scheduler
+
+def main() :
+    """
+    Run the worker pool as a service of its own (servers started with
+    CRAWL_SCHEDULER=0), taking over if the current owner goes away.
+    """
+    logging.basicConfig(level=logging.INFO)
+    service = CrawlScheduler()
+    atexit.register(service.stop)
+    while True :
+        service.claim()
+        time.sleep(OWNER_TTL / 3)
+
+if __name__ == "__main__" :
+    main()
@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Search logic shared by the Flask server (index.py) and the asynchronous
+server (async_index.py) : request validation, Elasticsearch responses
+processing and cursor pagination. Nothing here talks to Elasticsearch :
+the servers send the request bodies built here with their own client.
+"""
+
+import os
+import re
+import json
+import time
+import zlib
+import base64
+import logging
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import url
+import query
+import metrics
+import vector_index
+
+# hybrid search : number of hits of each leg, fusion method (rrf or weighted),
+# weight of the vector leg and timeouts of the legs (seconds)
+HYBRID_DEPTH = int(os.getenv("HYBRID_DEPTH", "100"))
+HYBRID_FUSION = os.getenv("HYBRID_FUSION", "rrf")
+HYBRID_VECTOR_WEIGHT = float(os.getenv("HYBRID_VECTOR_WEIGHT", "0.5"))
+LEXICAL_TIMEOUT = float(os.getenv("HYBRID_LEXICAL_TIMEOUT", "1.0"))
+VECTOR_TIMEOUT = float(os.getenv("HYBRID_VECTOR_TIMEOUT", "1.0"))
+# rank constant of reciprocal rank fusion
+RRF_K = 60
+# cursor pagination : number of domains of the last results carried by the
+# cursor and excluded from the next page
+CURSOR_DOMAINS = 100
+
+# latency of the requests of the servers, and of the searches by mode
+REQUEST_SECONDS = metrics.histogram("http_request_seconds", "Duration of the requests of the search servers.",
+    ["endpoint", "method", "status"])
+SEARCH_SECONDS = metrics.histogram("search_request_seconds", "Duration of the /search requests by mode.",
+    ["mode"])
+
+# threads running the legs of the hybrid searches of the Flask server
+legs_executor = ThreadPoolExecutor(int(os.getenv("HYBRID_THREADS", "16")))
+
+class InvalidQuery(ValueError):
+    """
+    Invalid search request, reported to the client with status_code.
+    """
+
+    def __init__(self, message, status_code=400) :
+        ValueError.__init__(self, message)
+        self.message = message
+        self.status_code = status_code
+
+def parse_request(data) :
+    """
+    Validate the POST data of /search.
+    Return (expression, start, hits).
+    """
+    if "query" not in data :
+        raise InvalidQuery('No query specified in POST data')
+    try :
+        start = int(data.get("start") or "0")
+        hits = int(data.get("hits") or "10")
+    except ValueError :
+        raise InvalidQuery('Start and hits must be numbers')
+    if start < 0 or hits < 0 :
+        raise InvalidQuery('Start or hits cannot be negative numbers')
+    groups = re.search("(site:(?P<domain>[^ ]+))?( ?(?P<query>.*))?",
+        data["query"]).groupdict()
+    return groups["query"], start, hits
+
+def search_mode(data) :
+    """
+    Mode of a /search request : cursor, vector, hybrid or default (results per domain).
+    """
+    if "cursor" in data :
+        return "cursor"
+    if data.get("vector") :
+        return "vector"
+    if data.get("hybrid") :
+        return "hybrid"
+    return "default"
+
+def format_result(hit, highlight) :
+    """
+    Result of a hit, as returned to the client.
+    """
+    #Highlight title and description
+    title = hit["title"]
+    description = hit["description"]
+    if highlight :
+        if "description" in highlight :
+            description = highlight["description"][0]+"..."
+        elif "body" in highlight :
+            description = highlight["body"][0]+"..."
+
+    #Create false title and description for better user experience
+    if not title :
+        title = hit["domain"]
+    if not description :
+        # computed at index time, from the body for pages indexed before
+        description = hit.get("fallback_description")
+        if description is None and "body" in hit :
+            description = url.create_description(hit["body"])
+        description = (description or "")+"..."
+
+    return {
+        "title":title,
+        "description":description,
+        "url":hit["url"],
+        "thumbnail":hit.get("thumbnail", None)
+    }
+
+def sort_results(response) :
+    """
+    Flatten the per domain aggregation of query.expression_query and sort
+    the results by score.
+    """
+    logging.debug("Raw response %s", response)
+    results = []
+    for domain_bucket in response['aggregations']['per_domain']['buckets']:
+        for hit in domain_bucket["top_results"]["hits"]["hits"] :
+            results.append((format_result(hit["_source"],
+            hit.get("highlight", None)),hit["_score"]))
+    results = [result[0] for result in
+    sorted(results, key=lambda result: result[1], reverse=True)]
+    logging.debug("Sorted results %s", results)
+    return results
+
+def encode_cursor(state) :
+    """
+    Opaque cursor token of a pagination state.
+    """
+    data = zlib.compress(json.dumps(state, separators=(",",":")).encode("utf8"))
+    return base64.urlsafe_b64encode(data).decode("ascii")
+
+def decode_cursor(cursor) :
+    try :
+        return json.loads(zlib.decompress(base64.urlsafe_b64decode(cursor.encode("ascii"))))
+    except Exception :
+        raise InvalidQuery('Invalid cursor')
+
+def cursor_pages(expression, cursor, hits) :
+    """
+    One page of cursor pagination : search_after the last returned hit.
+    The cursor only carries the sort values of the last hit, the domains of
+    the last CURSOR_DOMAINS results and the total, so the cost of a page
+    does not depend on its depth. This bounds the guarantees :
+    - a domain is unique within a page and within the last CURSOR_DOMAINS
+      results only : once it is older than that, another page of the same
+      domain can be returned again;
+    - the total is the approximate number of matching domains (cardinality
+      aggregation) counted by the first page, and is not the number of
+      results the pages will return. The last page is the one on which
+      Elasticsearch runs out of hits, whatever the total.
+    Generator : yields the search bodies to send and receives their
+    responses, returns (total, results, next cursor or None).
+    """
+    state = decode_cursor(cursor) if cursor else {"after":None, "recent":[], "total":None}
+    after, recent, total = state.get("after"), state.get("recent") or [], state.get("total")
+    results = []
+    domains = set(recent)
+    exhausted = False
+    size = max(2 * hits, 10)
+    while len(results) < hits :
+        response = yield query.cursor_expression_query(expression,
+            size, after, recent, with_total=total is None)
+        if total is None :
+            total = response["aggregations"]["total_domains"]["value"]
+        page = response["hits"]["hits"]
+        for hit in page :
+            after = hit["sort"]
+            domain = hit["_source"]["domain"]
+            if domain in domains :
+                continue
+            domains.add(domain)
+            recent = (recent + [domain])[-CURSOR_DOMAINS:]
+            results.append(format_result(hit["_source"], hit.get("highlight", None)))
+            if len(results) == hits :
+                break
+        if len(page) < size and len(results) < hits :
+            exhausted = True
+            break
+    if exhausted or not results :
+        return total, results, None
+    return total, results, encode_cursor({"after":after, "recent":recent, "total":total})
+
+def cursor_search(search, expression, cursor, hits) :
+    """
+    Run cursor_pages with a blocking search function (body -> response).
+    """
+    pages = cursor_pages(expression, cursor, hits)
+    try :
+        body = next(pages)
+        while True :
+            body = pages.send(search(body))
+    except StopIteration as e :
+        return e.value
+
+def vector_hits(expression, vector_type, size) :
+    """
+    Embed the query and return the (id, similarity) of the size closest
+    documents of the local ANN index (CPU bound, blocking).
+    """
+    if vector_type not in ("laser_vector", "bert_vector") :
+        raise InvalidQuery('Vector must be laser or bert')
+    import embeddings # the language models are only loaded for vector searches
+    ann = vector_index.get_index(vector_type)
+    if not ann.exists() :
+        raise InvalidQuery('No local index for %s'%vector_type, status_code=503)
+    query_vector = embeddings.embed([expression or ""], vector_type)[0]
+    return ann.search([query_vector], size)[0]
+
+def vector_ids(expression, vector_type, size) :
+    return [doc_id for doc_id, score in vector_hits(expression, vector_type, size)]
+
+def parse_hybrid(data) :
+    """
+    Validate the hybrid search options of the POST data of /search.
+    Return (vector_type, fusion, vector_weight).
+    """
+    vector_type = data["hybrid"]+"_vector"
+    if vector_type not in ("laser_vector", "bert_vector") :
+        raise InvalidQuery('Hybrid must be laser or bert')
+    fusion = data.get("fusion") or HYBRID_FUSION
+    if fusion not in ("rrf", "weighted") :
+        raise InvalidQuery('Fusion must be rrf or weighted')
+    try :
+        weight = float(data.get("vector_weight") or HYBRID_VECTOR_WEIGHT)
+    except ValueError :
+        raise InvalidQuery('Vector weight must be a number')
+    if not 0 <= weight <= 1 :
+        raise InvalidQuery('Vector weight must be between 0 and 1')
+    return vector_type, fusion, weight
+
+def fuse(rankings, fusion="rrf", weights=None, k=RRF_K) :
+    """
+    Merge ranked lists of (id, score) into a list of ids, best first.
+    rrf : sum over the lists of weight / (k + rank), scores are ignored.
+    weighted : sum of weight * score, scores min-max normalized per list.
+    """
+    weights = weights or [1.0] * len(rankings)
+    fused = {}
+    for ranking, weight in zip(rankings, weights) :
+        if not ranking :
+            continue
+        if fusion == "rrf" :
+            scores = [1.0 / (k + rank) for rank in range(1, len(ranking) + 1)]
+        else :
+            low = min(score for _, score in ranking)
+            high = max(score for _, score in ranking)
+            scores = [(score - low) / (high - low) if high > low else 1.0 for _, score in ranking]
+        for (doc_id, _), score in zip(ranking, scores) :
+            fused[doc_id] = fused.get(doc_id, 0.0) + weight * score
+    return sorted(fused, key=lambda doc_id : fused[doc_id], reverse=True)
+
+def run_legs(legs, timeouts) :
+    """
+    Run functions (name -> function) concurrently, each within its own
+    timeout : a slow or failed leg is left out instead of stalling the
+    others. Return name -> (result or None, {"ms", "status"}).
+    """
+    def timed(function) :
+        begin = time.perf_counter()
+        try :
+            return function(), (time.perf_counter() - begin) * 1000, None
+        except Exception as e :
+            return None, (time.perf_counter() - begin) * 1000, e
+
+    begin = time.perf_counter()
+    futures = dict((name, legs_executor.submit(timed, function)) for name, function in legs.items())
+    results = {}
+    for name, future in futures.items() :
+        try :
+            result, elapsed, error = future.result(max(0, timeouts[name] - (time.perf_counter() - begin)))
+        except TimeoutError :
+            future.cancel()
+            results[name] = (None, {"ms":timeouts[name] * 1000, "status":"timeout"})
+            continue
+        if isinstance(error, InvalidQuery) :
+            raise error
+        if error is not None :
+            logging.warning("%s leg of hybrid search failed : %s", name, error)
+        results[name] = (result, {"ms":elapsed, "status":"error" if error is not None else "ok"})
+    return results
+
+def hybrid_merge(lexical_response, vector_ranking, fusion, vector_weight, size) :
+    """
+    Fuse the lexical response and the vector ranking (either may be None
+    after a timeout). Return the size best ids and the results of the ids
+    found in the lexical response, the others must be fetched.
+    """
+    lexical_hits = lexical_response["hits"]["hits"] if lexical_response else []
+    ids = fuse([[(hit["_id"], hit["_score"]) for hit in lexical_hits], vector_ranking or []],
+        fusion, [1 - vector_weight, vector_weight])[:size]
+    known = dict((hit["_id"], format_result(hit["_source"], hit.get("highlight", None)))
+        for hit in lexical_hits)
+    return ids, known
+
+def hybrid_results(ids, known, response=None) :
+    """
+    Results of the fused ids, the ones missing from known taken from the
+    mget response of these ids.
+    """
+    if response :
+        known = dict(known, **dict((doc["_id"], format_result(doc["_source"], None))
+            for doc in response["docs"] if doc.get("found")))
+    return [known[doc_id] for doc_id in ids if doc_id in known]
+
+def hybrid_search(search, mget, expression, vector_type, size, fusion=HYBRID_FUSION,
+        vector_weight=HYBRID_VECTOR_WEIGHT, timeouts=None) :
+    """
+    Hybrid search with blocking functions search (body -> response) and
+    mget (ids -> response) : the lexical and vector legs run concurrently
+    and their rankings are fused. Return (results, legs latency and status).
+    """
+    timeouts = timeouts or {"lexical":LEXICAL_TIMEOUT, "vector":VECTOR_TIMEOUT}
+    depth = max(size, HYBRID_DEPTH)
+    legs = run_legs({
+        "lexical":lambda : search(query.lexical_query(expression, depth)),
+        "vector":lambda : vector_hits(expression, vector_type, depth)}, timeouts)
+    ids, known = hybrid_merge(legs["lexical"][0], legs["vector"][0], fusion, vector_weight, size)
+    missing = [doc_id for doc_id in ids if doc_id not in known]
+    results = hybrid_results(ids, known, mget(missing) if missing else None)
+    return results, dict((name, status) for name, (_, status) in legs.items())
+
+def found_results(response) :
+    """
+    Results of a mget response, in the order of the requested ids.
+    """
+    return [format_result(doc["_source"], None) for doc in response["docs"] if doc.get("found")]
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Result cache of the /search endpoint.
+The full sorted result list of a query is stored once, so every page of
+the same query is served from it. Entries live in an in-process LRU
+dictionary and, optionally, in Redis to be shared between server
+processes. Each index has a generation number, incremented in Redis by
+the crawler whenever it writes documents : it is part of every cache key,
+so older entries are never read again and simply expire.
+"""
+
+import re
+import json
+import time
+import hashlib
+import logging
+import threading
+import metrics
+from collections import OrderedDict
+from redis.exceptions import RedisError
+
+LOOKUPS = metrics.counter("search_cache_lookups_total", "Lookups of the search result cache.", ["result"])
+
+def generation_key(index) :
+    return "search:generation:%s"%index
+
+def bump_generation(redis, index) :
+    """
+    Invalidate the cached results of an index (called after writes).
+    """
+    try :
+        redis.incr(generation_key(index))
+    except RedisError as e :
+        logging.warning("search cache invalidation failed : %s"%e)
+
+def normalize(expression) :
+    """
+    Normalized form of a user query : lower case, single spaces.
+    """
+    return re.sub(r"\s+", " ", (expression or "").strip().lower())
+
+class SearchCache(object):
+    """
+    Two tier (local LRU, then Redis) cache of search results.
+    redis          : Redis connection, or None for a local only cache
+    size           : max number of entries of the local tier
+    ttl            : seconds an entry is kept in the local tier
+    redis_ttl      : seconds an entry is kept in Redis
+    generation_ttl : seconds the generation number read from Redis is reused
+    """
+
+    def __init__(self, redis=None, index="web-en", size=1000, ttl=60, redis_ttl=3600,
+            generation_ttl=1.0) :
+        self.redis = redis
+        self.index = index
+        self.size = size
+        self.ttl = ttl
+        self.redis_ttl = redis_ttl
+        self.generation_ttl = generation_ttl
+        # the local tier is shared by the threads serving the requests
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # key -> (expiration time, value)
+        self.current = (0, b"0")     # (expiration time, generation)
+
+    def generation(self) :
+        now = time.time()
+        if self.redis is None or now < self.current[0] :
+            return self.current[1]
+        try :
+            generation = self.redis.get(generation_key(self.index)) or b"0"
+        except RedisError as e :
+            logging.warning("search cache generation unavailable : %s"%e)
+            generation = self.current[1]
+        self.current = (now + self.generation_ttl, generation)
+        return generation
+
+    def key(self, expression, **options) :
+        """
+        Cache key of a query, independent of the requested page.
+        """
+        data = json.dumps([normalize(expression), options], sort_keys=True)
+        digest = hashlib.sha1(data.encode("utf8")).hexdigest()
+        return "search:result:%s:%s:%s"%(self.index, self.generation().decode("utf8"), digest)
+
+    def get_local(self, key) :
+        """
+        Value of a key in the local tier, or None (Redis is not read).
+        """
+        now = time.time()
+        with self.lock :
+            entry = self.entries.get(key)
+            if entry is not None :
+                if entry[0] > now :
+                    self.entries.move_to_end(key)
+                    LOOKUPS.inc(result="local")
+                    return entry[1]
+                del self.entries[key]
+        return None
+
+    def get_shared(self, key) :
+        """
+        Value of a key in Redis, copied into the local tier, or None.
+        """
+        if self.redis is None :
+            LOOKUPS.inc(result="miss")
+            return None
+        try :
+            data = self.redis.get(key)
+        except RedisError as e :
+            logging.warning("search cache read failed : %s"%e)
+            LOOKUPS.inc(result="error")
+            return None
+        if data is None :
+            LOOKUPS.inc(result="miss")
+            return None
+        LOOKUPS.inc(result="redis")
+        value = json.loads(data)
+        self._store(key, value, time.time())
+        return value
+
+    def get(self, key) :
+        value = self.get_local(key)
+        return self.get_shared(key) if value is None else value
+
+    def set_local(self, key, value) :
+        self._store(key, value, time.time())
+
+    def set_shared(self, key, value) :
+        if self.redis is not None :
+            try :
+                self.redis.set(key, json.dumps(value), ex=self.redis_ttl)
+            except RedisError as e :
+                logging.warning("search cache write failed : %s"%e)
+
+    def set(self, key, value) :
+        self.set_local(key, value)
+        self.set_shared(key, value)
+
+    def _store(self, key, value, now) :
+        with self.lock :
+            self.entries[key] = (now + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size :
+                self.entries.popitem(last=False)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Minimal in-memory Elasticsearch HTTP server, for benchmarks only.
+It answers the few endpoints used by the crawler with a configurable
+latency per request, so that round-trip costs can be measured without
+a real cluster.
+"""
+
+import sys
+import json
+import time
+import threading
+from urllib.parse import urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+INFO = {
+    "name":"stub",
+    "cluster_name":"stub",
+    "version":{"number":"7.17.0", "build_flavor":"default"},
+    "tagline":"You Know, for Search"
+}
+
+class StubElasticsearch(object):
+    """
+    Stub server running in a background thread.
+    latency    : seconds slept by each request
+    doc_cost   : seconds slept per document of a bulk request
+    reject     : ratio of bulk items answered with a 429 status
+    hits       : number of synthetic hits returned by searches
+    body_size  : size in bytes of the body of synthetic hits
+    """
+
+    def __init__(self, latency=0.005, doc_cost=0.0, reject=0.0, hits=30, body_size=2000, port=0) :
+        self.latency = latency
+        self.doc_cost = doc_cost
+        self.reject = reject
+        self.hits = hits
+        self.body_size = body_size
+        self.docs = {}
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) :
+        return "http://127.0.0.1:%d/"%self.server.server_address[1]
+
+    def start(self) :
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) :
+        self.server.shutdown()
+        self.server.server_close()
+
+    def store(self, index, doc_id, source) :
+        with self.lock :
+            self.docs[(index, doc_id)] = source
+
+    def bulk(self, body) :
+        """
+        Apply a ndjson bulk body, return the items of the response.
+        """
+        lines = [line for line in body.split("\n") if line]
+        items = []
+        rejected = 0
+        for i in range(0, len(lines), 2) :
+            op_type, meta = next(iter(json.loads(lines[i]).items()))
+            # reject the first items of each request to simulate a full write queue
+            if rejected < int(self.reject * len(lines) / 2) :
+                rejected += 1
+                items.append({op_type:{"_index":meta["_index"], "_id":meta["_id"], "status":429,
+                    "error":{"type":"es_rejected_execution_exception"}}})
+                continue
+            source = json.loads(lines[i+1])
+            if op_type == "update" :
+                previous = dict(self.docs.get((meta["_index"], meta["_id"]), {}))
+                previous.update(source.get("doc", {}))
+                source = previous
+            self.store(meta["_index"], meta["_id"], source)
+            items.append({op_type:{"_index":meta["_index"], "_id":meta["_id"], "status":200,
+                "result":"updated"}})
+        time.sleep(self.doc_cost * len(items))
+        return {"took":1, "errors":rejected > 0, "items":items}
+
+    def synthetic_hit(self, i) :
+        domain = "site%d.com"%(i % 10)
+        source = {
+            "url":"http://%s/page/%d"%(domain, i),
+            "domain":domain,
+            "title":"Synthetic page %d"%i,
+            "description":"",
+            "body":("Some sentence about page %d. "%i * self.body_size)[:self.body_size],
+            "weight":3
+        }
+        return {"_index":"web-en", "_id":source["url"], "_score":10.0 - i * 0.1,
+            "_source":source, "highlight":{"body":["Some <b>sentence</b> about page %d"%i]}}
+
+    def search(self, body) :
+        """
+        Synthetic response to a search : per domain buckets for aggregation
+        queries, a flat hit list otherwise.
+        """
+        hits = [self.synthetic_hit(i) for i in range(self.hits)]
+        response = {"took":1, "timed_out":False, "hits":{"total":{"value":len(hits), "relation":"eq"},
+            "max_score":10.0, "hits":[]}}
+        if "per_domain" in body.get("aggs", {}) :
+            buckets = {}
+            for hit in hits :
+                buckets.setdefault(hit["_source"]["domain"], []).append(hit)
+            response["aggregations"] = {"per_domain":{"buckets":[{"key":domain, "doc_count":len(group),
+                "top_hit":{"value":group[0]["_score"]},
+                "top_results":{"hits":{"total":{"value":len(group)}, "hits":group[:3]}}}
+                for domain, group in buckets.items()]}}
+        else :
+            for hit in hits[:body.get("size", 10)] :
+                hit["sort"] = [hit["_score"], hit["_id"]]
+                response["hits"]["hits"].append(hit)
+            response["aggregations"] = {"total_domains":{"value":10}}
+        return response
+
+    def stored_search(self, body) :
+        """
+        Stored documents matching a term query, all in the first page of a
+        scroll (used by elasticsearch.helpers.scan).
+        """
+        field, value = next(iter(body["query"]["term"].items()))
+        fields = body.get("_source")
+        hits = []
+        with self.lock :
+            for (index, doc_id), source in self.docs.items() :
+                if source.get(field) == value :
+                    if fields :
+                        source = dict((key, source[key]) for key in fields if key in source)
+                    hits.append({"_index":index, "_id":doc_id, "_score":1.0, "_source":source})
+        return {"took":1, "timed_out":False, "_scroll_id":"stub",
+            "_shards":{"total":1, "successful":1, "skipped":0, "failed":0},
+            "hits":{"total":{"value":len(hits), "relation":"eq"}, "hits":hits}}
+
+    def mget(self, index, body) :
+        """
+        Stored documents, or the synthetic hits, of a list of ids.
+        """
+        docs = []
+        for doc_id in body["ids"] :
+            with self.lock :
+                source = self.docs.get((index, doc_id))
+            if source is None and "/page/" in doc_id :
+                source = self.synthetic_hit(int(doc_id.rsplit("/", 1)[1]))["_source"]
+            docs.append({"_index":index, "_id":doc_id, "found":source is not None, "_source":source}
+                if source is not None else {"_index":index, "_id":doc_id, "found":False})
+        return {"docs":docs}
+
+    def _handler(self) :
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args) :
+                pass
+
+            def reply(self, payload, status=200) :
+                data = json.dumps(payload).encode("utf8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("X-Elastic-Product", "Elasticsearch")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def body(self) :
+                length = int(self.headers.get("Content-Length") or 0)
+                return self.rfile.read(length).decode("utf8") if length else ""
+
+            def handle_any(self) :
+                with stub.lock :
+                    stub.requests += 1
+                time.sleep(stub.latency)
+                path = [p for p in urlparse(self.path).path.split("/") if p]
+                body = self.body()
+                if not path :
+                    return self.reply(INFO)
+                if path[-1] == "_bulk" :
+                    return self.reply(stub.bulk(body))
+                if path[-1] == "scroll" :
+                    if self.command == "DELETE" :
+                        return self.reply({"succeeded":True, "num_freed":1})
+                    return self.reply({"_scroll_id":"stub", "hits":{"hits":[]},
+                        "_shards":{"total":1, "successful":1, "skipped":0, "failed":0}})
+                if path[-1] == "_msearch" :
+                    lines = [json.loads(line) for line in body.split("\n") if line]
+                    return self.reply({"took":1, "responses":[dict(stub.search(search), status=200)
+                        for search in lines[1::2]]})
+                if path[-1] == "_mget" :
+                    return self.reply(stub.mget(path[0], json.loads(body)))
+                if path[-1] == "_search" :
+                    body = json.loads(body) if body else {}
+                    if "term" in body.get("query", {}) :
+                        return self.reply(stub.stored_search(body))
+                    return self.reply(stub.search(body))
+                if len(path) == 3 and path[1] in ("_doc", "_create") :
+                    stub.store(path[0], path[2], json.loads(body))
+                    return self.reply({"_index":path[0], "_id":path[2], "result":"created"}, 201)
+                if len(path) == 1 and self.command == "PUT" :
+                    return self.reply({"acknowledged":True, "index":path[0]})
+                return self.reply({"error":"unsupported stub endpoint %s"%self.path}, 400)
+
+            do_GET = do_POST = do_PUT = do_HEAD = do_DELETE = handle_any
+
+        return Handler
+
+if __name__ == "__main__" :
+    # standalone stub : python stub_es.py <port> [latency_ms]
+    stub = StubElasticsearch(latency=float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.005,
+        port=int(sys.argv[1]))
+    print("stub Elasticsearch listening on %s"%stub.url)
+    sys.stdout.flush()
+    stub.server.serve_forever()
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Type-ahead suggestions of the /suggest endpoint : completions of a prefix
+among the titles of the indexed pages (weighted by the weight and the
+PageRank of the pages) and the popular past queries (weighted by their
+number of searches).
+Suggestions are held in memory in two levels of sorted keys : a large one,
+rebuilt in the background, and a small one holding the recent updates,
+merged into the large one when it grows. A prefix is a range of the
+sorted keys (a node of the implicit trie) : the best completions of the
+prefixes of many keys are precomputed, the others are found by scanning
+their range. The number of suggestions kept is bounded (SUGGEST_MAX_ENTRIES).
+The crawler publishes the titles of the pages it writes in a Redis stream
+read by the servers, the numbers of searches of the queries are shared by
+the servers in a Redis sorted set.
+"""
+
+import os
+import re
+import json
+import math
+import time
+import bisect
+import logging
+import threading
+import numpy as np
+from collections import Counter
+from redis.exceptions import RedisError
+from elasticsearch.helpers import scan
+import search_cache
+from search import InvalidQuery
+
+# max number of suggestions of a request, and kept in memory
+SUGGESTIONS = 10
+MAX_ENTRIES = int(os.getenv("SUGGEST_MAX_ENTRIES", "500000"))
+# prefixes of more keys have their best completions precomputed
+SCAN_LIMIT = 256
+# number of recent updates merged into the large level
+DELTA_MAX = 5000
+# max length of a suggestion made from a title
+MAX_LENGTH = 60
+# queries are suggested once searched MIN_QUERY_COUNT times, each search
+# counts as much as a page of weight QUERY_WEIGHT
+MIN_QUERY_COUNT = 2
+QUERY_WEIGHT = 1.0
+# seconds between two reads of the updates, and of the popular queries
+POLL_INTERVAL = 1.0
+QUERY_SYNC_INTERVAL = 60.0
+
+def titles_stream(index) :
+    return "suggest:titles:%s"%index
+
+STREAM_MAXLEN = 100000
+QUERIES_KEY = "suggest:queries"
+MAX_QUERY_LOG = 100000
+
+# greater than every character : end of the range of a prefix
+LAST = "\U0010ffff"
+
+def normalize_prefix(prefix) :
+    """
+    Normalized form of a prefix : as search_cache.normalize, a trailing
+    space is kept (the next word is completed).
+    """
+    return re.sub(r"\s+", " ", (prefix or "").lower()).lstrip()
+
+def title_suggestion(title) :
+    """
+    Suggestion made from a page title : its first part ("Name - Site" gives
+    "name"), normalized and cut at a word boundary.
+    """
+    text = re.split(r"\s[-|–—:·]\s", title or "")[0]
+    text = search_cache.normalize(text)
+    if len(text) > MAX_LENGTH :
+        text = text[:MAX_LENGTH].rsplit(" ", 1)[0]
+    return text if len(text) > 1 else None
+
+def title_score(source) :
+    """
+    Score of the title of a page : its weight, raised by its PageRank.
+    """
+    return float(source.get("weight") or 0) * (1 + math.log1p(source.get("pagerank") or 0))
+
+def title_entries(sources) :
+    """
+    (suggestion, score) of the titles of the pages of sources.
+    """
+    entries = []
+    for source in sources :
+        key, score = title_suggestion(source.get("title")), title_score(source)
+        if key and score > 0 :
+            entries.append((key, score))
+    return entries
+
+def publish_titles(redis, index, sources) :
+    """
+    Send the titles of pages just written to an index to the servers
+    (called by the crawler).
+    """
+    entries = title_entries(sources)
+    if not entries :
+        return
+    try :
+        redis.xadd(titles_stream(index), {"titles":json.dumps(entries)}, maxlen=STREAM_MAXLEN, approximate=True)
+    except RedisError as e :
+        logging.warning("suggestions update failed : %s"%e)
+
+def load_titles(es, index) :
+    """
+    (suggestion, score) of the titles of the indexed pages.
+    """
+    return title_entries(hit["_source"] for hit in scan(es, index=index,
+        query={"query":{"match_all":{}}}, _source=["title", "weight", "pagerank"], ignore_unavailable=True))
+
+def parse_request(data) :
+    """
+    Validate the parameters of /suggest.
+    Return (prefix, hits).
+    """
+    if "query" not in data :
+        raise InvalidQuery('No query specified')
+    try :
+        hits = int(data.get("hits") or SUGGESTIONS)
+    except ValueError :
+        raise InvalidQuery('Hits must be a number')
+    if hits < 0 or hits > SUGGESTIONS :
+        raise InvalidQuery('Hits must be between 0 and %d'%SUGGESTIONS)
+    return normalize_prefix(data["query"]), hits
+
+class PrefixIndex(object):
+    """
+    Immutable completions of a dict suggestion -> score : keys sorted, the
+    best ones of the prefixes of more than scan_limit keys precomputed.
+    """
+
+    def __init__(self, entries, top=2*SUGGESTIONS, scan_limit=SCAN_LIMIT) :
+        self.keys = sorted(entries)
+        self.scores = np.asarray([entries[key] for key in self.keys], dtype=np.float32)
+        self.top = top
+        self.tops = {} # prefix -> positions of its best keys
+        stack = [(0, len(self.keys), 0)]
+        while stack :
+            lo, hi, depth = stack.pop()
+            if hi - lo <= scan_limit :
+                continue
+            self.tops[self.keys[lo][:depth]] = self._best(lo, hi)
+            # the key equal to the prefix comes first, then one range per next character
+            start = lo + 1 if len(self.keys[lo]) == depth else lo
+            while start < hi :
+                end = bisect.bisect_left(self.keys, self.keys[start][:depth+1] + LAST, start, hi)
+                stack.append((start, end, depth + 1))
+                start = end
+
+    def __len__(self) :
+        return len(self.keys)
+
+    def _best(self, lo, hi) :
+        scores = self.scores[lo:hi]
+        best = np.argpartition(-scores, self.top - 1)[:self.top] if hi - lo > self.top else np.arange(hi - lo)
+        return (lo + best[np.argsort(-scores[best], kind="stable")]).astype(np.int32)
+
+    def complete(self, prefix) :
+        """
+        Best (suggestion, score) starting with prefix, best first.
+        """
+        best = self.tops.get(prefix)
+        if best is None :
+            lo = bisect.bisect_left(self.keys, prefix)
+            hi = bisect.bisect_left(self.keys, prefix + LAST, lo)
+            if hi == lo :
+                return []
+            best = self._best(lo, hi)
+        return [(self.keys[i], float(self.scores[i])) for i in best.tolist()]
+
+class Suggester(object):
+    """
+    Suggestions of titles and queries, updated while it answers.
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, delta_max=DELTA_MAX) :
+        self.max_entries = max_entries
+        self.delta_max = delta_max
+        self.lock = threading.Lock()
+        self.titles = {}  # suggestion -> score of the best page
+        self.queries = {} # query -> number of searches
+        self.recorded = Counter() # searches not sent yet
+        # large level, small level and the suggestions of the small level
+        # (suggestion -> score, updated since the large one was built),
+        # replaced together
+        self.levels = (PrefixIndex({}), PrefixIndex({}), {})
+        self.merging = threading.Event()
+        self.stream_id = "0-0"
+        self.synced = 0
+
+    def score(self, key) :
+        count = self.queries.get(key, 0)
+        return self.titles.get(key, 0.0) + (QUERY_WEIGHT * count if count >= MIN_QUERY_COUNT else 0.0)
+
+    def complete(self, prefix, size=SUGGESTIONS) :
+        """
+        Best suggestions starting with the normalized prefix.
+        """
+        if not prefix :
+            return []
+        main, delta, changed = self.levels
+        candidates = [entry for entry in main.complete(prefix) if entry[0] not in changed]
+        candidates.extend(delta.complete(prefix))
+        candidates.sort(key=lambda entry : -entry[1])
+        return [key for key, score in candidates if score > 0][:size]
+
+    def record_query(self, expression) :
+        key = search_cache.normalize(expression)
+        if key :
+            with self.lock :
+                self.recorded[key] += 1
+
+    def update(self, titles=(), queries=()) :
+        """
+        Apply (suggestion, score) of pages and (query, number of searches).
+        """
+        with self.lock :
+            keys = set()
+            for key, score in titles :
+                if score > self.titles.get(key, 0.0) :
+                    self.titles[key] = score
+                    keys.add(key)
+            for key, count in queries :
+                if count != self.queries.get(key) :
+                    self.queries[key] = count
+                    keys.add(key)
+            if not keys :
+                return
+            # copy on write : running completions keep the previous levels
+            main, _, changed = self.levels
+            changed = dict(changed)
+            changed.update((key, self.score(key)) for key in keys)
+            self.levels = (main, PrefixIndex(changed), changed)
+            merge = len(changed) > self.delta_max and not self.merging.is_set()
+            if merge :
+                self.merging.set()
+        if merge :
+            threading.Thread(target=self.merge, daemon=True).start()
+
+    def merge(self) :
+        """
+        Rebuild the large level with every suggestion, keeping the
+        max_entries best ones.
+        """
+        try :
+            with self.lock :
+                merged = self.levels[2]
+                scores = dict((key, self.score(key)) for key in set(self.titles) | set(self.queries))
+                if len(scores) > self.max_entries :
+                    kept = sorted(scores, key=scores.get, reverse=True)[:self.max_entries]
+                    scores = dict((key, scores[key]) for key in kept)
+                    self.titles = dict((key, score) for key, score in self.titles.items() if key in scores)
+                    self.queries = dict((key, count) for key, count in self.queries.items() if key in scores)
+            main = PrefixIndex(scores)
+            with self.lock :
+                # updates arrived during the build stay in the small level
+                changed = dict((key, score) for key, score in self.levels[2].items()
+                    if merged.get(key) != score)
+                self.levels = (main, PrefixIndex(changed), changed)
+            logging.info("%d suggestions"%len(main))
+        finally :
+            self.merging.clear()
+
+    def sync_queries(self, redis) :
+        """
+        Send the searches recorded since the last call, return the updated
+        (query, number of searches) : those sent, and every popular query
+        every QUERY_SYNC_INTERVAL seconds.
+        """
+        with self.lock :
+            recorded, self.recorded = self.recorded, Counter()
+        if redis is None :
+            return [(key, self.queries.get(key, 0) + count) for key, count in recorded.items()]
+        try :
+            pipe = redis.pipeline(transaction=False)
+            for key, count in recorded.items() :
+                pipe.zincrby(QUERIES_KEY, count, key)
+            counts = list(zip(recorded, pipe.execute()))
+            if time.time() - self.synced >= QUERY_SYNC_INTERVAL :
+                self.synced = time.time()
+                redis.zremrangebyrank(QUERIES_KEY, 0, -MAX_QUERY_LOG - 1)
+                counts.extend((key.decode("utf8"), count) for key, count in
+                    redis.zrevrangebyscore(QUERIES_KEY, "+inf", MIN_QUERY_COUNT, withscores=True))
+        except RedisError as e :
+            logging.warning("query log unavailable : %s"%e)
+            return []
+        return [(key, int(count)) for key, count in counts]
+
+    def poll(self, redis, index) :
+        """
+        Apply the titles published by the crawler and the searches.
+        """
+        titles = []
+        if redis is not None :
+            try :
+                for _, messages in redis.xread({titles_stream(index):self.stream_id}, count=1000) or [] :
+                    for message_id, fields in messages :
+                        self.stream_id = message_id
+                        titles.extend(json.loads(fields[b"titles"]))
+            except RedisError as e :
+                logging.warning("suggestions updates unavailable : %s"%e)
+        self.update(titles, self.sync_queries(redis))
+
+    def load(self, es, index, redis=None) :
+        """
+        Build the suggestions of the indexed titles, updates published
+        during the load are read next.
+        """
+        if redis is not None :
+            try :
+                last = redis.xrevrange(titles_stream(index), count=1)
+                self.stream_id = last[0][0] if last else "0-0"
+            except RedisError as e :
+                logging.warning("suggestions updates unavailable : %s"%e)
+        titles = load_titles(es, index)
+        with self.lock :
+            for key, score in titles :
+                if score > self.titles.get(key, 0.0) :
+                    self.titles[key] = score
+        self.merging.set()
+        self.merge()
+
+    def run(self, get_es, redis, index) :
+        """
+        Load the suggestions, then apply the updates (background thread).
+        """
+        try :
+            self.load(get_es(), index, redis)
+        except Exception as e :
+            logging.error("cannot load the suggestions : %s"%e)
+        while True :
+            time.sleep(POLL_INTERVAL)
+            try :
+                self.poll(redis, index)
+            except Exception as e :
+                logging.error("suggestions update failed : %s"%e)
+
+    def start(self, get_es, redis=None, index="web-en") :
+        threading.Thread(target=self.run, args=(get_es, redis, index), daemon=True).start()
+        return self
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the quality metrics and run comparison of the benchmark (benchmark.py).
+"""
+
+import math
+import benchmark
+
+GRADES = {"a":3, "b":0, "c":1, "d":2}
+
+def test_load_relevance(tmp_path) :
+    path = tmp_path / "relevance.csv"
+    path.write_text("query,id,grade\nlemon tart,a,3\nlemon tart,b,0\ncake,c,1\n")
+    assert benchmark.loadRelevance(str(path)) == {"lemon tart":{"a":3, "b":0}, "cake":{"c":1}}
+
+def test_recall() :
+    assert benchmark.recallAt(["a", "b", "x", "c"], GRADES, 3) == 1 / 3
+    assert benchmark.recallAt(["d", "c", "a"], GRADES, 3) == 1.0
+    assert benchmark.recallAt(["a"], {"a":0}, 3) is None
+
+def test_ndcg() :
+    assert benchmark.ndcgAt(["a", "d", "c", "b"], GRADES, 4) == 1.0
+    # gains 2^grade - 1 discounted by log2(rank + 1)
+    dcg = 1 / math.log2(2) + 7 / math.log2(3)
+    ideal = 7 + 3 / math.log2(3)
+    assert abs(benchmark.ndcgAt(["c", "a"], GRADES, 2) - dcg / ideal) < 1e-12
+    assert benchmark.ndcgAt(["x"], {"b":0}, 10) is None
+
+def test_percentiles() :
+    summary = benchmark.percentiles([0.001 * i for i in range(1, 101)])
+    assert summary["p50"] == 50.5 and summary["max"] == 100.0
+    assert abs(summary["mean"] - 50.5) < 1e-9
+
+def timings(p50, recall) :
+    measures = dict((timing, {"p50":p50, "p90":p50 * 2, "p99":p50 * 3})
+        for timing in ("embed_ms", "search_ms", "total_ms"))
+    return dict(measures, **{"recall@10":recall})
+
+def test_compare_runs(capsys) :
+    old = {"types":{"term":timings(10.0, 0.80), "bert":timings(50.0, 0.70)}}
+    new = {"types":{"term":timings(10.5, 0.80), "bert":timings(60.0, 0.60)}}
+    regressions = benchmark.compareRuns(old, new, tolerance=0.1)
+    # term : 5% slower, within the tolerance ; bert : 20% slower and recall lower by 0.1
+    assert ("bert", "recall@10") in regressions
+    assert ("bert", "search_ms p50") in regressions and ("bert", "search_ms p99") not in regressions
+    assert not [name for search_type, name in regressions if search_type == "term"]
+    assert "<- regression" in capsys.readouterr().out
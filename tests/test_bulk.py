@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the retries of the buffered bulk writer (bulk.BulkIndexer).
+"""
+
+import json
+import pytest
+from elasticsearch import TransportError, ConnectionError
+import bulk
+
+class FakeES(object):
+    """
+    Bulk API answering with the statuses (or exceptions) of a script, one
+    entry per request.
+    """
+
+    def __init__(self, script) :
+        self.script = list(script)
+        self.requests = []
+
+    def bulk(self, body) :
+        ids = [json.loads(line)["index"]["_id"] for line in body.strip().split("\n")[::2]]
+        self.requests.append(ids)
+        answer = self.script.pop(0)
+        if isinstance(answer, Exception) :
+            raise answer
+        return {"items":[{"index":{"_id":doc_id, "status":answer.get(doc_id, 201),
+            "error":None if answer.get(doc_id, 201) < 300 else "error %d"%answer[doc_id]}} for doc_id in ids]}
+
+@pytest.fixture
+def sleeps(monkeypatch) :
+    delays = []
+    monkeypatch.setattr(bulk.time, "sleep", delays.append)
+    return delays
+
+def indexer(es, **options) :
+    writer = bulk.BulkIndexer(es, retry_backoff=0.5, **options)
+    for doc_id in "abc" :
+        writer.add("web", doc_id, {"url":doc_id})
+    return writer
+
+def test_rejected_items_retried_with_backoff(sleeps) :
+    es = FakeES([{"a":429, "b":400}, {"a":503}, {}])
+    writer = indexer(es)
+    failed = writer.flush("web")
+    assert es.requests == [["a", "b", "c"], ["a"], ["a"]]
+    assert [json.loads(pair[0])["index"]["_id"] for pair, _ in failed] == ["b"]
+    assert sleeps == [0.5, 1.0]
+    assert writer.stats == {"docs":2, "requests":3, "retries":2, "failed":1}
+    assert writer.buffers == {}
+
+def test_retries_exhausted(sleeps) :
+    es = FakeES([{"c":429}] * 3)
+    writer = indexer(es, max_retries=2)
+    failed = writer.flush_all()
+    assert len(es.requests) == 3
+    assert [error for _, error in failed] == ["error 429"]
+    assert sleeps == [0.5, 1.0]
+
+def test_transport_errors(sleeps) :
+    es = FakeES([ConnectionError("N/A", "refused", None), TransportError(503, "unavailable", None), {}])
+    writer = indexer(es)
+    assert writer.flush("web") == []
+    assert es.requests == [["a", "b", "c"]] * 3
+    assert writer.stats["docs"] == 3
+
+    es = FakeES([TransportError(400, "parse error", None)])
+    writer = indexer(es)
+    failed = writer.flush("web")
+    assert len(failed) == 3 and len(es.requests) == 1
+    assert sleeps == [0.5, 1.0]
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the analysis of the pages in a process pool
+(pipelines.ContentExtractionPipeline, document.analyze).
+"""
+
+import time
+import pytest
+from scrapy.settings import Settings
+from scrapy.exceptions import DropItem
+import pipelines
+
+PAGE = """<html><head><title>Lemon tart</title>
+<meta name="description" content="A lemon tart with a crisp pastry."></head>
+<body><div>Home | Recipes | Contact</div>
+<p>%s</p></body></html>"""
+
+TEXT = ("This lemon tart is made with a buttery shortcrust pastry, a smooth filling of fresh lemons, "
+    "eggs and sugar, and it is baked slowly until the centre is just set. ") * 4
+
+class Stats(object):
+
+    def __init__(self) :
+        self.values = {}
+
+    def inc_value(self, key, count=1) :
+        self.values[key] = self.values.get(key, 0) + count
+
+class Spider(object):
+    languages = ["en"]
+
+class Reactor(object):
+    """
+    Run the callbacks sent to the reactor at once, in the thread of the pool.
+    """
+
+    def callFromThread(self, function, *args) :
+        function(*args)
+
+@pytest.fixture
+def pipeline(monkeypatch) :
+    monkeypatch.setattr(pipelines, "executors", {})
+    monkeypatch.setattr(pipelines, "reactor", Reactor())
+    pipeline = pipelines.ContentExtractionPipeline(Settings({"CONTENT_WORKERS":1, "CONTENT_MAX_PENDING":1}),
+        Stats())
+    yield pipeline
+    pipeline.executor.shutdown()
+
+def page(link, text=TEXT) :
+    return {"url":link, "html":(PAGE%text).encode("utf8"), "encoding":"utf8", "content_language":None,
+        "etag":'"v1"'}
+
+def result(d, timeout=60) :
+    outcome = []
+    d.addBoth(outcome.append)
+    deadline = time.time() + timeout
+    while not outcome and time.time() < deadline :
+        time.sleep(0.01)
+    assert outcome, "page not analyzed"
+    return outcome[0]
+
+def test_pages_analyzed_in_the_pool(pipeline) :
+    first = pipeline.process_item(page("http://a.org/1"), Spider())
+    second = pipeline.process_item(page("http://a.org/2"), Spider())
+    # a single page in the pool at a time, the second one waits for the slot
+    assert pipeline.semaphore.tokens == 0 and len(pipeline.semaphore.waiting) == 1
+    item = result(first)
+    assert item["id"] == "http://a.org/1" and item["index"] == "web-en"
+    assert item["source"]["title"] == "Lemon tart"
+    assert "shortcrust pastry" in item["source"]["body"]
+    assert "Contact" not in item["source"]["body"]
+    assert item["source"]["etag"] == '"v1"'
+    assert result(second)["id"] == "http://a.org/2"
+    assert pipeline.stats.values["content/analyzed"] == 2
+    assert pipeline.semaphore.tokens == 1
+
+def test_unsupported_language_dropped(pipeline) :
+    text = ("Cette tarte au citron est faite avec une pâte sablée au beurre, une crème de citrons frais, "
+        "des oeufs et du sucre, et elle cuit doucement jusqu'à ce que le centre soit pris. ") * 4
+    failure = result(pipeline.process_item(page("http://a.org/fr", text), Spider()))
+    assert failure.check(DropItem)
+    assert pipeline.stats.values["content/unsupported_language"] == 1
+
+def test_items_without_html_pass_through(pipeline) :
+    item = {"index":"web-en", "id":"x", "source":{}}
+    assert pipeline.process_item(item, Spider()) is item
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the near-duplicate detection (dedup.py, pipelines.NearDuplicatePipeline).
+"""
+
+import random
+import pytest
+from scrapy.settings import Settings
+from scrapy.exceptions import DropItem
+import dedup
+import pipelines
+
+def text(seed, words=200) :
+    rand = random.Random(seed)
+    return " ".join("w%d"%rand.randrange(5000) for _ in range(words))
+
+def near_copy(body) :
+    words = body.split()
+    words[-1] = "changed"
+    return " ".join(words)
+
+class Stats(object):
+
+    def __init__(self) :
+        self.values = {}
+
+    def inc_value(self, key, count=1) :
+        self.values[key] = self.values.get(key, 0) + count
+
+    def set_value(self, key, value) :
+        self.values[key] = value
+
+class Spider(object):
+    pass
+
+def item(page_url, body) :
+    return {"id":page_url, "simhash":dedup.simhash(body), "source":{"url":page_url, "body":body, "weight":3}}
+
+def crawl(pages, indexed, action="drop") :
+    """
+    Items of pages (url -> body, None when not modified) through the
+    pipeline, the kept ones stored in indexed (url -> source).
+    """
+    pipeline = pipelines.NearDuplicatePipeline(Settings({"NEAR_DUPLICATE_ACTION":action}), Stats())
+    spider = Spider()
+    spider.indexed_pages = dict(indexed)
+    kept = []
+    for page_url, body in pages :
+        if body is None :
+            continue
+        try :
+            result = pipeline.process_item(item(page_url, body), spider)
+        except DropItem :
+            continue
+        indexed[page_url] = result["source"]
+        kept.append(page_url)
+    return kept
+
+def test_simhash_distance() :
+    body = text(1)
+    assert dedup.distance(dedup.simhash(body), dedup.simhash(near_copy(body))) <= dedup.DISTANCE
+    assert dedup.distance(dedup.simhash(body), dedup.simhash(text(2))) > dedup.DISTANCE
+    assert dedup.simhash("too short") is None
+
+def test_encode_decode() :
+    for signature in (0, 1, 2**63, 2**64 - 1) :
+        assert dedup.decode(dedup.encode(signature)) == signature
+
+def test_index_find() :
+    index = dedup.SimHashIndex()
+    signature = dedup.simhash(text(1))
+    index.add(signature, "a")
+    assert index.find(signature ^ 0b101) == "a"
+    assert index.find(signature ^ 0b1111) is None
+    assert index.find(signature, ignore="a") is None
+
+def test_near_duplicate_dropped() :
+    body = text(1)
+    indexed = {}
+    assert crawl([("http://a.com/a", body), ("http://a.com/b", near_copy(body)),
+        ("http://a.com/c", text(3))], indexed) == ["http://a.com/a", "http://a.com/c"]
+    assert dedup.decode(indexed["http://a.com/a"]["simhash"]) == dedup.simhash(body)
+
+def test_recrawl_keeps_duplicate_out() :
+    body = text(1)
+    indexed = {}
+    crawl([("http://a.com/a", body), ("http://a.com/b", near_copy(body))], indexed)
+    # the kept page is not modified : only the duplicate is analyzed again
+    assert crawl([("http://a.com/a", None), ("http://a.com/b", near_copy(body))], indexed) == []
+    assert list(indexed) == ["http://a.com/a"]
+
+def test_recrawl_modified_page_not_duplicate_of_itself() :
+    body = text(1)
+    indexed = {}
+    crawl([("http://a.com/a", body)], indexed)
+    assert crawl([("http://a.com/a", near_copy(body))], indexed) == ["http://a.com/a"]
+
+def test_recrawl_canonicalized_page() :
+    body = text(1)
+    indexed = {}
+    crawl([("http://a.com/a", body), ("http://a.com/b", near_copy(body))], indexed, action="canonicalize")
+    assert indexed["http://a.com/b"]["canonical"] == "http://a.com/a"
+    # a page indexed as a duplicate is not a canonical page of the next crawl
+    crawl([("http://a.com/b", near_copy(body)), ("http://a.com/a", body)], indexed, action="canonicalize")
+    assert indexed["http://a.com/b"]["canonical"] == "http://a.com/a"
+    assert "canonical" not in indexed["http://a.com/a"]
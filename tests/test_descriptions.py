@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the fallback descriptions stored at index time (document.py,
+backfill_descriptions.py) and of the results built without the bodies.
+"""
+
+import local_index
+import document
+import search
+import query
+import backfill_descriptions
+
+BODY = "Short one. A much longer sentence about lemon tarts and their pastry. End"
+
+def test_fallback_description_cut_at_a_word() :
+    assert document.fallback_description("  lemon tart  ") == "lemon tart"
+    assert document.fallback_description(None) == ""
+    sentence = document.fallback_description("lemon " * 100)
+    assert len(sentence) <= document.FALLBACK_DESCRIPTION_LENGTH
+    assert sentence.endswith("lemon") and set(sentence.split()) == {"lemon"}
+
+def test_backfill(tmp_path) :
+    es = local_index.LocalClient(str(tmp_path))
+    es.bulk([
+        {"index":{"_index":"web-en", "_id":"old"}}, {"url":"http://a.org/", "domain":"a.org", "body":BODY},
+        {"index":{"_index":"web-en", "_id":"new"}}, {"url":"http://b.org/", "domain":"b.org", "body":BODY,
+            "fallback_description":"kept"},
+    ])
+    assert backfill_descriptions.backfill(es, "web-*") == 1
+    docs = es.mget(index="web-en", body={"ids":["old", "new"]})["docs"]
+    assert docs[0]["_source"]["fallback_description"] == "A much longer sentence about lemon tarts and their pastry"
+    assert docs[1]["_source"]["fallback_description"] == "kept"
+    assert backfill_descriptions.backfill(es, "web-*") == 0
+
+def test_results_without_bodies(tmp_path) :
+    es = local_index.LocalClient(str(tmp_path))
+    es.bulk([{"index":{"_index":"web-en", "_id":"a"}}, {"url":"http://a.org/", "domain":"a.org",
+        "title":"", "description":"", "body":BODY, "fallback_description":"Stored description"}])
+    hit = es.search("web-en", {"query":{"match_all":{}}, "_source":query.RESULT_FIELDS})["hits"]["hits"][0]
+    assert "body" not in hit["_source"]
+    result = search.format_result(hit["_source"], None)
+    assert (result["title"], result["description"]) == ("a.org", "Stored description...")
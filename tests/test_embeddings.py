@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the persistent embedding cache (embeddings.EmbeddingCache).
+"""
+
+import threading
+import numpy as np
+from embeddings import EmbeddingCache
+
+class Encoder(object):
+    """
+    Deterministic vectors of texts, counting the encoded texts.
+    """
+
+    def __init__(self, dim=8) :
+        self.dim = dim
+        self.encoded = []
+
+    def __call__(self, texts) :
+        self.encoded.extend(texts)
+        return [np.random.default_rng(abs(hash(text)) % 2**32).random(self.dim) for text in texts]
+
+def test_only_missing_texts_encoded(tmp_path) :
+    cache = EmbeddingCache("model", "vector", 8, directory=str(tmp_path))
+    encode = Encoder()
+    first = cache.embed(["a", "b", "a"], encode)
+    assert encode.encoded == ["a", "b"]
+    assert np.array_equal(first[0], first[2])
+    second = cache.embed(["b", "c"], encode)
+    assert encode.encoded == ["a", "b", "c"]
+    assert np.array_equal(second[0], first[1])
+    assert (cache.hits, cache.misses) == (1, 4)
+
+def test_persistent_and_shared(tmp_path) :
+    encode = Encoder()
+    vectors = EmbeddingCache("model", "vector", 8, directory=str(tmp_path)).embed(["a", "b"], encode)
+    # a new process, and a cache written by another one after it opened
+    reader = EmbeddingCache("model", "vector", 8, directory=str(tmp_path), lru_size=1)
+    writer = EmbeddingCache("model", "vector", 8, directory=str(tmp_path))
+    writer.embed(["c"], encode)
+    assert np.array_equal(reader.embed(["a", "b", "c"], encode), np.vstack([vectors, encode(["c"])]).astype(np.float32))
+    assert encode.encoded == ["a", "b", "c", "c"]
+    assert len(reader.lru) == 1
+
+def test_concurrent_threads(tmp_path) :
+    cache = EmbeddingCache("model", "vector", 8, directory=str(tmp_path), lru_size=50)
+    encode = Encoder()
+    texts = ["text %d"%i for i in range(400)]
+    errors = []
+    def work(seed) :
+        rand = np.random.default_rng(seed)
+        try :
+            for _ in range(50) :
+                batch = [texts[i] for i in rand.integers(0, len(texts), 8)]
+                vectors = cache.embed(batch, encode)
+                expected = np.asarray(Encoder()(batch), dtype=np.float32)
+                assert np.array_equal(vectors, expected)
+        except Exception as e :
+            errors.append(e)
+    threads = [threading.Thread(target=work, args=(seed,)) for seed in range(8)]
+    for thread in threads :
+        thread.start()
+    for thread in threads :
+        thread.join()
+    assert errors == []
+    assert len(cache.lru) <= 50
+    assert len(cache.rows) == len(set(cache.rows))
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the Bloom filters and the Redis frontier (frontier.py), the
+frontier on an in-memory stand-in of the Redis commands it uses.
+"""
+
+import time
+import frontier
+from frontier import BloomFilter, ScalableBloomFilter, MemoryBits, Frontier
+
+class Pipeline(object):
+    """
+    Commands queued and run by execute, as a redis-py pipeline.
+    """
+
+    def __init__(self, redis) :
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name) :
+        def queue(*args, **kwargs) :
+            self.commands.append((getattr(self.redis, name), args, kwargs))
+            return self
+        return queue
+
+    def execute(self) :
+        self.redis.round_trips += 1
+        commands, self.commands = self.commands, []
+        return [command(*args, **kwargs) for command, args, kwargs in commands]
+
+class MemoryRedis(object):
+    """
+    The Redis commands of frontier.py on dicts, counting the round trips.
+    """
+
+    def __init__(self) :
+        self.data = {}
+        self.round_trips = 0
+
+    def pipeline(self, transaction=True) :
+        return Pipeline(self)
+
+    def getbit(self, key, position) :
+        bits = self.data.get(key, bytearray())
+        return (bits[position >> 3] >> (position & 7)) & 1 if position >> 3 < len(bits) else 0
+
+    def setbit(self, key, position, value) :
+        bits = self.data.setdefault(key, bytearray())
+        if position >> 3 >= len(bits) :
+            bits.extend(bytearray((position >> 3) + 1 - len(bits)))
+        bits[position >> 3] |= 1 << (position & 7)
+
+    def expire(self, key, ttl) :
+        return key in self.data
+
+    def hlen(self, key) :
+        return len(self.data.get(key, {}))
+
+    def hget(self, key, field) :
+        value = self.data.get(key, {}).get(str(field))
+        return None if value is None else str(value).encode()
+
+    def hincrby(self, key, field, amount) :
+        fields = self.data.setdefault(key, {})
+        fields[str(field)] = fields.get(str(field), 0) + amount
+        return fields[str(field)]
+
+    def incrby(self, key, amount) :
+        self.data[key] = self.data.get(key, 0) + amount
+        return self.data[key]
+
+    def zadd(self, key, mapping) :
+        members = self.data.setdefault(key, {})
+        added = len(set(mapping) - set(members))
+        members.update(mapping)
+        return added
+
+    def zscore(self, key, member) :
+        return self.data.get(key, {}).get(member)
+
+    def zremrangebyscore(self, key, low, high) :
+        members = self.data.get(key, {})
+        removed = [member for member, score in members.items() if score <= high]
+        for member in removed :
+            del members[member]
+        return len(removed)
+
+    def zcard(self, key) :
+        self.round_trips += 1
+        return len(self.data.get(key, {}))
+
+    def zpopmin(self, key) :
+        self.round_trips += 1
+        members = self.data.get(key, {})
+        if not members :
+            return []
+        member = min(members, key=members.get)
+        return [(member, members.pop(member))]
+
+def test_bloom_filter_no_false_negatives() :
+    bloom = BloomFilter(1000, 0.01, MemoryBits)
+    keys = [ScalableBloomFilter.digest("http://a.com/%d"%i) for i in range(1000)]
+    for key in keys :
+        bloom.add(key)
+    assert all(bloom.contains(key) for key in keys)
+    others = [ScalableBloomFilter.digest("http://b.com/%d"%i) for i in range(10000)]
+    assert sum(bloom.contains(key) for key in others) < 10000 * 0.02
+
+def test_scalable_bloom_filter_grows() :
+    bloom = ScalableBloomFilter(lambda layer, size : MemoryBits(size), capacity=100, error_rate=0.01)
+    added = [bloom.add("http://a.com/%d"%i) for i in range(1000)]
+    assert sum(added) >= 980
+    assert len(bloom.layers) == 4 # 100 + 200 + 400 + 800
+    assert all("http://a.com/%d"%i in bloom for i in range(1000))
+    assert not bloom.add("http://a.com/1")
+    assert sum("http://b.com/%d"%i in bloom for i in range(10000)) < 10000 * 0.01
+
+def test_frontier_push_many() :
+    redis = MemoryRedis()
+    queue = Frontier(redis, "a.com", capacity=10)
+    queued = queue.push_many([(b"1", "http://a.com/1", 0, False), (b"2", "http://a.com/2", 5, False),
+        (b"3", "http://a.com/1?", 0, False), (b"4", "http://a.com/3", 0, False)])
+    assert queued == [True, True, False, True]
+    assert queue.push_many([(b"5", "http://a.com/2", 0, False), (b"6", "http://a.com/2", 0, True)]) == [False, True]
+    # higher priority first, then in order
+    assert [queue.pop() for _ in range(5)] == [b"2", b"1", b"4", b"6", None]
+
+def test_frontier_round_trips() :
+    redis = MemoryRedis()
+    queue = Frontier(redis, "a.com", capacity=50)
+    before = redis.round_trips
+    queue.push_many([(str(i).encode(), "http://a.com/%d"%i, 0, False) for i in range(200)])
+    # the layer counts, the checks and the writes, whatever the number of requests
+    assert redis.round_trips - before <= 3
+    assert len(queue.seen.layers) == 3 # 50 + 100 + 200
+    assert not any(queue.push_many([(b"x", "http://a.com/%d"%i, 0, False) for i in range(200)]))
+
+def test_frontier_recently_crawled_expires() :
+    redis = MemoryRedis()
+    queue = Frontier(redis, "a.com", recrawl_after=100)
+    queue.mark_crawled("http://a.com/old")
+    redis.data[queue.crawled_key]["http://a.com/old"] -= 150
+    queue.mark_crawled("http://a.com/new")
+    assert queue.recently_crawled("http://a.com/new")
+    # the URLs crawled before recrawl_after are removed
+    assert list(redis.data[queue.crawled_key]) == ["http://a.com/new"]
+    assert queue.push_many([(b"1", "http://a.com/new", 0, False), (b"2", "http://a.com/old", 0, False)]) == [False, True]
+
+class Stats(object):
+
+    def __init__(self) :
+        self.values = {}
+
+    def inc_value(self, key, count=1, spider=None) :
+        self.values[key] = self.values.get(key, 0) + count
+
+class Crawler(object):
+
+    def __init__(self) :
+        self.settings = {}
+        self.stats = Stats()
+
+def test_scheduler_buffers_requests() :
+    from scrapy import Request
+    redis = MemoryRedis()
+    scheduler = frontier.FrontierScheduler(Crawler())
+    scheduler.frontier = Frontier(redis, "a.com")
+    for path in ("1", "2", "1") :
+        assert scheduler.enqueue_request(Request("http://a.com/" + path))
+    assert redis.round_trips == 0
+    assert scheduler.has_pending_requests()
+    assert scheduler.stats.values == {"frontier/enqueued":2, "frontier/filtered":1}
+    urls = [scheduler.next_request().url for _ in range(2)]
+    assert urls == ["http://a.com/1", "http://a.com/2"]
+    assert scheduler.next_request() is None
+    assert not scheduler.has_pending_requests()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the local search backend (local_index.py).
+"""
+
+import numpy as np
+import local_index
+
+def page(url, domain, body, **fields) :
+    return dict({"url":url, "domain":domain, "title":"", "description":"", "body":body}, **fields)
+
+def weighted_query(text) :
+    return {"function_score":{"query":{"multi_match":{"query":text, "fields":["body"]}},
+        "field_value_factor":{"field":"weight", "missing":1}}}
+
+def test_zero_weight_is_kept(tmp_path) :
+    client = local_index.LocalClient(str(tmp_path))
+    client.bulk([
+        {"index":{"_index":"web", "_id":"zero"}}, page("http://a.org/", "a.org", "lemon", weight=0),
+        {"index":{"_index":"web", "_id":"missing"}}, page("http://b.org/", "b.org", "lemon"),
+        {"index":{"_index":"web", "_id":"null"}}, page("http://c.org/", "c.org", "lemon", weight=None),
+    ])
+    hits = client.search("web", {"query":weighted_query("lemon")})["hits"]["hits"]
+    scores = dict((hit["_id"], hit["_score"]) for hit in hits)
+    assert scores["missing"] > 0
+    assert scores["null"] == scores["missing"]
+    assert scores.get("zero", 0) == 0
+
+def test_per_domain_buckets_merged_across_indices(tmp_path) :
+    client = local_index.LocalClient(str(tmp_path))
+    client.bulk([
+        {"index":{"_index":"web-1", "_id":"a1"}}, page("http://a.org/1", "a.org", "lemon"),
+        {"index":{"_index":"web-1", "_id":"b1"}}, page("http://b.org/1", "b.org", "lemon lemon lemon"),
+        {"index":{"_index":"web-1", "_id":"c1"}}, page("http://c.org/1", "c.org", "lemon lemon other"),
+        {"index":{"_index":"web-2", "_id":"a2"}}, page("http://a.org/2", "a.org", "lemon lemon lemon lemon"),
+        {"index":{"_index":"web-2", "_id":"a3"}}, page("http://a.org/3", "a.org", "lemon other words here"),
+    ])
+    body = {"query":{"multi_match":{"query":"lemon", "fields":["body"]}}, "size":0,
+        "aggs":{"per_domain":{"terms":{"field":"domain", "size":2},
+            "aggs":{"top_results":{"top_hits":{"size":2}}, "top_hit":{"max":{"script":"_score"}}}}}}
+    buckets = client.search("web-*", body)["aggregations"]["per_domain"]["buckets"]
+    assert [bucket["key"] for bucket in buckets] == ["a.org", "b.org"]
+    first = buckets[0]
+    assert first["doc_count"] == 3
+    hits = first["top_results"]["hits"]["hits"]
+    # a2 (web-2) outscores the b.org page, a3 (web-2) the a1 page of web-1
+    assert [hit["_id"] for hit in hits] == ["a2", "a3"]
+    tops = [bucket["top_hit"]["value"] for bucket in buckets]
+    assert tops == sorted(tops, reverse=True)
+
+def test_varints_round_trip() :
+    values = [0, 1, 127, 128, 300, 16383, 16384, 2**35 + 7]
+    data, lengths = local_index.encode_varints(values)
+    assert lengths.tolist() == [1, 1, 1, 2, 2, 2, 3, 6]
+    assert len(data) == lengths.sum()
+    assert local_index.decode_varints(data.tobytes()).tolist() == values
+
+def test_merge_keeps_live_postings(tmp_path) :
+    directory = str(tmp_path)
+    first = local_index.write_segment(directory, "one", [
+        ("a", page("http://a.org/", "a.org", "lemon tree")),
+        ("b", page("http://b.org/", "b.org", "lemon lemon", weight=2)),
+    ])
+    second = local_index.write_segment(directory, "two", [
+        ("c", page("http://c.org/", "c.org", "tree", title="Lemon")),
+    ])
+    segments = [local_index.Segment(directory, first), local_index.Segment(directory, second)]
+    masks = [np.asarray([False, True]), np.asarray([True])]
+    merged = local_index.Segment(directory, local_index.merge_segments(directory, "merged", segments, masks))
+    assert merged.ids == ["b", "c"]
+    assert np.asarray(merged.weights).tolist() == [2.0, 1.0]
+    assert [merged.domains[i] for i in merged.domain_ids] == ["b.org", "c.org"]
+    assert merged.source(1)["url"] == "http://c.org/"
+    numbers, frequencies = merged.postings_of("lemon")
+    # (title, description, body) frequencies, the deleted document a dropped
+    assert numbers.tolist() == [0, 1]
+    assert frequencies.tolist() == [[0, 0, 2], [1, 0, 0]]
+    numbers, frequencies = merged.postings_of("tree")
+    assert numbers.tolist() == [1]
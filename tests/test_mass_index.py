@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the mass-index ingestion client (mass_index.py).
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import mass_index
+
+def test_normalize() :
+    assert mass_index.normalize("  example.com/b?z=1&a=2 \n") == "http://example.com/b?a=2&z=1"
+    assert mass_index.normalize("# comment") is None
+    assert mass_index.normalize("   ") is None
+
+def test_by_domain_rounds() :
+    links = ["http://a.com/1", "http://a.com/2", "http://www.a.com/3", "http://b.org/1", "http://c.net/1"]
+    assert mass_index.by_domain(links) == ["http://a.com/1", "http://b.org/1", "http://c.net/1",
+        "http://a.com/2", "http://www.a.com/3"]
+    assert mass_index.by_domain(links, max_per_domain=1) == ["http://a.com/1", "http://b.org/1", "http://c.net/1"]
+
+class FailingSubmitter(mass_index.Submitter):
+
+    def __init__(self, failures) :
+        mass_index.Submitter.__init__(self, "http://localhost", retries=2, backoff=0)
+        self.failures = failures
+        self.calls = 0
+
+    def submit_once(self, link) :
+        self.calls += 1
+        if self.calls <= self.failures :
+            raise IOError("HTTP 503")
+
+def test_submit_retries() :
+    assert FailingSubmitter(2).submit("http://a.com/") is None
+    submitter = FailingSubmitter(5)
+    assert str(submitter.submit("http://a.com/")) == "HTTP 503"
+    assert submitter.calls == 3
+
+def test_session_per_thread() :
+    submitter = mass_index.Submitter("http://localhost")
+    sessions = []
+    thread = threading.Thread(target=lambda : sessions.append(submitter.session))
+    thread.start()
+    thread.join()
+    assert submitter.session is submitter.session
+    assert sessions[0] is not submitter.session
+
+class BrokenProgress(object):
+
+    def done(self, link, error) :
+        raise IOError("disk full")
+
+def test_slot_released_when_recording_fails() :
+    pending = threading.BoundedSemaphore(2)
+    with ThreadPoolExecutor(2) as executor :
+        for i in range(10) :
+            # would block on the third link if the slots were not released
+            assert pending.acquire(timeout=5)
+            future = executor.submit(lambda : None)
+            future.add_done_callback(mass_index.on_done(BrokenProgress(), pending, "http://a.com/%d"%i))
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the metrics and of their Prometheus text exposition (metrics.py).
+"""
+
+import metrics
+
+def test_render_counter_and_histogram() :
+    registry = metrics.Registry()
+    pages = registry.get(metrics.Counter, "pages_total", "Crawled pages.", ["result"])
+    pages.inc(result="ok")
+    pages.inc(2, result="ok")
+    pages.inc(result='say "no"')
+    latency = registry.get(metrics.Histogram, "latency_seconds", "Latency.", ["stage"], buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 3.0) :
+        latency.observe(value, stage="parse")
+    assert registry.get(metrics.Counter, "pages_total", "Crawled pages.", ["result"]) is pages
+
+    lines = metrics.render([({}, registry.snapshot()), ({"worker":"1"}, registry.snapshot())]).splitlines()
+    assert lines[:4] == [
+        "# HELP latency_seconds Latency.",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{stage="parse",le="0.1"} 1',
+        'latency_seconds_bucket{stage="parse",le="1.0"} 3',
+    ]
+    assert 'latency_seconds_bucket{stage="parse",le="+Inf"} 4' in lines
+    assert 'latency_seconds_sum{stage="parse"} 4.05' in lines
+    assert 'latency_seconds_count{stage="parse",worker="1"} 4' in lines
+    assert 'pages_total{result="ok"} 3' in lines
+    assert 'pages_total{result="say \\"no\\""} 1' in lines
+    assert 'pages_total{result="ok",worker="1"} 3' in lines
+    # one HELP and TYPE per metric, whatever the number of snapshots
+    assert sum(line.startswith("# TYPE") for line in lines) == 2
+
+def test_render_without_labels() :
+    registry = metrics.Registry()
+    registry.get(metrics.Counter, "jobs_total", "Jobs.").inc()
+    assert metrics.render([({}, registry.snapshot())]) == "# HELP jobs_total Jobs.\n# TYPE jobs_total counter\njobs_total 1\n"
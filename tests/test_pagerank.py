@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the PageRank computation (pagerank.pagerank).
+"""
+
+import numpy as np
+import pagerank
+
+def test_empty_graph() :
+    ranks, iterations = pagerank.pagerank(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), 0)
+    assert len(ranks) == 0 and iterations == 0
+
+def test_cycle_is_uniform() :
+    ranks, _ = pagerank.pagerank(np.asarray([0, 1, 2]), np.asarray([1, 2, 0]), 3)
+    assert np.allclose(ranks, 1 / 3)
+
+def test_star_and_dangling_page() :
+    # 1, 2 and 3 link to 0, which has no link : its rank is spread over all pages
+    sources, targets = np.asarray([1, 2, 3, 3]), np.asarray([0, 0, 0, 0])
+    ranks, iterations = pagerank.pagerank(sources, targets, 4, tolerance=1e-12, max_iterations=1000)
+    assert abs(ranks.sum() - 1) < 1e-9
+    assert ranks.argmax() == 0
+    assert np.allclose(ranks[1:], ranks[1])
+    # fixed point : r0 = d * (3 r1 + r0 / 4) + (1 - d) / 4, r1 = d * r0 / 4 + (1 - d) / 4
+    d = pagerank.DAMPING
+    r1 = (1 - d) / 4 + d * ranks[0] / 4
+    assert abs(ranks[1] - r1) < 1e-9
+    assert abs(ranks[0] - (d * (3 * ranks[1] + ranks[0] / 4) + (1 - d) / 4)) < 1e-9
+    assert iterations < 1000
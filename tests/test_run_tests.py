@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the batched evaluation of run_tests.py (_msearch batches, CSV output).
+"""
+
+import threading
+import numpy as np
+import pandas as pd
+import pytest
+import run_tests
+
+class Client(object):
+    """
+    _msearch answering each search with the query in the titles of its hits.
+    """
+
+    def __init__(self, hits=3) :
+        self.hits = hits
+        self.batches = []
+        self.lock = threading.Lock()
+
+    def msearch(self, body) :
+        searches = body[1::2]
+        with self.lock :
+            self.batches.append(len(searches))
+        return {"responses":[{"hits":{"hits":[{"_id":"%d"%j,
+            "_source":{"title":"%s %d"%(search["query"]["simple_query_string"]["query"], j)}}
+            for j in range(self.hits)]}} for search in searches]}
+
+@pytest.fixture
+def client(monkeypatch) :
+    client = Client()
+    monkeypatch.setattr(run_tests, "client", client)
+    return client
+
+def test_msearch_batches_keep_the_query_order(client) :
+    queries = ["q%d"%i for i in range(7)]
+    results = run_tests.searchQueries(queries, run_tests.embedQueries(queries, "term"), "term",
+        batch_size=3, parallelism=2)
+    assert sorted(client.batches) == [1, 3, 3]
+    assert [hits[0]["_source"]["title"] for hits in results] == ["q%d 0"%i for i in range(7)]
+
+def test_queries_embedded_in_batches(monkeypatch) :
+    calls = []
+    monkeypatch.setattr(run_tests, "EMBED_BATCH_SIZE", 4)
+    monkeypatch.setattr(run_tests, "embed", lambda texts, vector_type : calls.append(len(texts)) or
+        np.ones((len(texts), 2)))
+    assert run_tests.embedQueries(["q"] * 10, "bert-hybrid").shape == (10, 2)
+    assert calls == [4, 4, 2]
+    assert run_tests.embedQueries(["q"] * 10, "term") == [None] * 10
+
+def test_csv_output_by_chunks(client, tmp_path, monkeypatch) :
+    monkeypatch.chdir(tmp_path)
+    pd.DataFrame({"Recipe":["lemon tart", "apple pie", "fig jam", "plum cake", "pear tart"]}).to_csv(
+        "queries.csv", index=False)
+    run_tests.doRunTest("term", "queries.csv", batch_size=2, parallelism=2, chunk_size=2)
+    results = pd.read_csv("results_term.csv", keep_default_na=False)
+    assert list(results["Recipe"]) == ["lemon tart", "apple pie", "fig jam", "plum cake", "pear tart"]
+    assert list(results.columns[-10:]) == ["Result%d"%i for i in range(1, 11)]
+    assert list(results["Result2"]) == ["lemon tart 1", "apple pie 1", "fig jam 1", "plum cake 1", "pear tart 1"]
+    # 3 hits per query, the other results are N/A
+    assert (results["Result4"] == "N/A").all()
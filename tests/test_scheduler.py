@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the assignment of the websites to the crawl workers (scheduler.py).
+"""
+
+import json
+import queue
+from collections import Counter
+import scheduler
+from scheduler import HashRing, job_domain
+
+def test_job_domain_is_the_host() :
+    assert job_domain("https://WWW.Example.com:8080/a?b=c") == "www.example.com"
+    assert job_domain("http://blog.example.com/") == "blog.example.com"
+
+def test_hash_ring_is_stable_and_balanced() :
+    ring = HashRing(range(4))
+    hosts = ["site%d.com"%i for i in range(4000)]
+    workers = [ring.get(host) for host in hosts]
+    assert workers == [HashRing(range(4)).get(host) for host in hosts]
+    assert all(600 < count < 1400 for count in Counter(workers).values())
+
+def test_hash_ring_moves_few_keys() :
+    hosts = ["site%d.com"%i for i in range(4000)]
+    before, after = HashRing(range(4)), HashRing(range(5))
+    moved = [host for host in hosts if before.get(host) != after.get(host)]
+    # about a fifth of the keys go to the new worker, the others stay
+    assert all(after.get(host) == 4 for host in moved)
+    assert len(moved) < 4000 * 0.35
+
+class SharedRedis(object):
+    """
+    The Redis commands of the crawl scheduler on dicts.
+    """
+
+    def __init__(self) :
+        self.data = {}
+
+    def set(self, key, value, ex=None, nx=False) :
+        if nx and key in self.data :
+            return None
+        self.data[key] = value.encode("utf8") if isinstance(value, str) else value
+        return True
+
+    def get(self, key) :
+        return self.data.get(key)
+
+    def delete(self, key) :
+        self.data.pop(key, None)
+
+    def lpush(self, key, value) :
+        self.data.setdefault(key, []).insert(0, value)
+
+    def brpop(self, key, timeout=0) :
+        items = self.data.get(key)
+        return (key, items.pop()) if items else None
+
+    def pipeline(self) :
+        return self
+
+    def execute(self) :
+        pass
+
+def server_process(redis, monkeypatch) :
+    crawl = scheduler.CrawlScheduler(redis, workers=4)
+    monkeypatch.setattr(crawl, "start", lambda : setattr(crawl, "running", True))
+    crawl.queues = [queue.Queue() for _ in range(4)]
+    redirections = {"http://example.com/":"https://www.example.com/"}
+    monkeypatch.setattr(crawl, "resolve", lambda link : redirections.get(link, link) if "down" not in link else None)
+    return crawl
+
+def test_jobs_shared_by_server_processes(monkeypatch) :
+    redis = SharedRedis()
+    first, second = server_process(redis, monkeypatch), server_process(redis, monkeypatch)
+    # a single process runs the worker pool
+    assert first.claim().running and not second.claim().running
+
+    job_id = second.submit("https://www.example.com/a")
+    assert first.status(job_id)["status"] == "queued"
+    first.dispatch(json.loads(redis.brpop(scheduler.JOBS_QUEUE)[1]))
+    worker = first.ring.get("www.example.com")
+    assert first.queues[worker].get_nowait() == (job_id, "https://www.example.com/a", False)
+    first.update(job_id, "finished", {"pages":12})
+    job = second.status(job_id)
+    assert (job["status"], job["worker"], job["pages"]) == ("finished", worker, 12)
+    assert second.status("unknown") is None
+
+def test_jobs_keyed_on_the_redirected_host(monkeypatch) :
+    redis = SharedRedis()
+    crawl = server_process(redis, monkeypatch).claim()
+    job_id = crawl.submit("http://example.com/")
+    crawl.dispatch(json.loads(redis.brpop(scheduler.JOBS_QUEUE)[1]))
+    worker = crawl.ring.get("www.example.com")
+    assert crawl.queues[worker].get_nowait() == (job_id, "https://www.example.com/", False)
+    assert crawl.status(job_id)["domain"] == "www.example.com"
+
+    job_id = crawl.submit("http://down.example.com/")
+    crawl.dispatch(json.loads(redis.brpop(scheduler.JOBS_QUEUE)[1]))
+    assert crawl.status(job_id)["status"] == "failed"
+    assert all(jobs.empty() for jobs in crawl.queues)
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the search logic shared by the servers (search.py) : cursor
+pagination against a stand-in of Elasticsearch, rank fusion, request
+validation and per domain results.
+"""
+
+import random
+import pytest
+import search
+
+def pages(domains=30, per_domain=5, seed=0) :
+    rand = random.Random(seed)
+    return [{"url":"http://d%d.com/%d"%(d, p), "domain":"d%d.com"%d, "title":"t", "description":"d",
+        "score":round(rand.random(), 6)} for d in range(domains) for p in range(per_domain)]
+
+def fake_search(docs) :
+    """
+    cursor_expression_query bodies run on docs : sort, search_after,
+    must_not of domains and size.
+    """
+    ordered = sorted(docs, key=lambda doc : (-doc["score"], doc["url"]))
+    bodies = []
+    def run(body) :
+        bodies.append(body)
+        excluded = set(body["query"]["function_score"]["query"]["bool"].get("must_not", {})
+            .get("terms", {}).get("domain", []))
+        hits = [doc for doc in ordered if doc["domain"] not in excluded]
+        if "search_after" in body :
+            after = tuple(body["search_after"])
+            hits = [doc for doc in hits if (-doc["score"], doc["url"]) > (-after[0], after[1])]
+        response = {"hits":{"hits":[{"_source":doc, "sort":[doc["score"], doc["url"]]}
+            for doc in hits[:body["size"]]]}}
+        if "aggs" in body :
+            response["aggregations"] = {"total_domains":{"value":len(set(doc["domain"] for doc in docs))}}
+        return response
+    return run, bodies
+
+def all_pages(docs, hits) :
+    run, bodies = fake_search(docs)
+    cursor, results = "", []
+    while cursor is not None :
+        total, page, cursor = search.cursor_search(run, "query", cursor, hits)
+        results.append(page)
+    return total, results, bodies
+
+def test_cursor_one_result_per_domain() :
+    docs = pages()
+    total, results, _ = all_pages(docs, 7)
+    urls = [result["url"] for page in results for result in page]
+    assert total == 30
+    assert len(urls) == 30
+    best = {}
+    for doc in sorted(docs, key=lambda doc : (-doc["score"], doc["url"])) :
+        best.setdefault(doc["domain"], doc["url"])
+    # the best page of each domain, in order
+    assert urls == list(best.values())
+    assert [len(page) for page in results] == [7, 7, 7, 7, 2]
+
+def test_cursor_size_does_not_grow() :
+    search.CURSOR_DOMAINS, default = 10, search.CURSOR_DOMAINS
+    try :
+        run, bodies = fake_search(pages(domains=200, per_domain=2))
+        cursor, sizes = "", []
+        while cursor is not None :
+            total, page, cursor = search.cursor_search(run, "query", cursor, 10)
+            sizes.append(len(cursor or ""))
+            assert len(set(result["url"].split("/")[2] for result in page)) == len(page)
+        excluded = [len(body["query"]["function_score"]["query"]["bool"].get("must_not", {})
+            .get("terms", {}).get("domain", [])) for body in bodies]
+        assert max(excluded) <= 10
+        assert max(sizes[1:-1]) - min(sizes[1:-1]) < 20
+    finally :
+        search.CURSOR_DOMAINS = default
+
+def test_cursor_domain_reappears_beyond_window(monkeypatch) :
+    # uniqueness only holds over the last CURSOR_DOMAINS results
+    monkeypatch.setattr(search, "CURSOR_DOMAINS", 3)
+    total, results, _ = all_pages(pages(domains=6, per_domain=2), 2)
+    domains = [result["url"].split("/")[2] for page in results for result in page]
+    assert total == 6
+    assert all(domain not in domains[max(0, i-3):i] for i, domain in enumerate(domains))
+    # a domain that left the window comes back on a later page
+    repeated = [domain for domain in set(domains) if domains.count(domain) > 1]
+    assert repeated
+    for domain in repeated :
+        numbers = [n for n, page in enumerate(results) if any(domain in result["url"] for result in page)]
+        assert len(numbers) == 2
+
+def test_cursor_end_without_total() :
+    # an approximate total smaller than the real number of domains does not end the pages
+    docs = pages(domains=12, per_domain=1)
+    run, _ = fake_search(docs)
+    def underestimated(body) :
+        response = run(body)
+        if "aggregations" in response :
+            response["aggregations"]["total_domains"]["value"] = 10
+        return response
+    total, first, cursor = search.cursor_search(underestimated, "query", "", 10)
+    assert cursor is not None
+    total, second, cursor = search.cursor_search(underestimated, "query", cursor, 10)
+    assert (len(first), len(second), cursor) == (10, 2, None)
+
+def test_invalid_cursor() :
+    with pytest.raises(search.InvalidQuery) :
+        search.decode_cursor("not a cursor")
+
+def test_parse_request() :
+    assert search.parse_request({"query":"site:a.com some words", "hits":"5"}) == ("some words", 0, 5)
+    with pytest.raises(search.InvalidQuery) :
+        search.parse_request({"query":"a", "start":"-1"})
+    with pytest.raises(search.InvalidQuery) :
+        search.parse_request({})
+
+def test_fuse_rrf() :
+    lexical = [("a", 10.0), ("b", 5.0), ("c", 1.0)]
+    vector = [("c", 0.9), ("a", 0.8), ("d", 0.1)]
+    assert search.fuse([lexical, vector]) == ["a", "c", "b", "d"]
+    # scores are ignored by rrf
+    assert search.fuse([[("a", 1.0), ("b", 100.0)]]) == ["a", "b"]
+
+def test_fuse_weighted() :
+    lexical = [("a", 10.0), ("b", 0.0)]
+    vector = [("b", 1.0), ("a", 0.0)]
+    assert search.fuse([lexical, vector], "weighted", [0.7, 0.3]) == ["a", "b"]
+    assert search.fuse([lexical, vector], "weighted", [0.3, 0.7]) == ["b", "a"]
+    assert search.fuse([[], vector], "weighted") == ["b", "a"]
+
+def test_sort_results() :
+    def bucket(*hits) :
+        return {"top_results":{"hits":{"hits":[{"_source":{"url":u, "domain":"x", "title":"t",
+            "description":"d"}, "_score":s} for u, s in hits]}}}
+    response = {"aggregations":{"per_domain":{"buckets":[bucket(("a", 1.0)), bucket(("b", 3.0), ("c", 2.0))]}}}
+    assert [result["url"] for result in search.sort_results(response)] == ["b", "c", "a"]
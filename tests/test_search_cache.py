@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the search result cache (search_cache.py).
+"""
+
+import time
+import threading
+from collections import OrderedDict
+import search_cache
+
+class YieldingDict(OrderedDict):
+    """
+    LRU dictionary letting the other threads run between a lookup and
+    the update that follows it.
+    """
+
+    def get(self, key, default=None) :
+        value = OrderedDict.get(self, key, default)
+        time.sleep(0)
+        return value
+
+def test_local_lru() :
+    cache = search_cache.SearchCache(size=2)
+    for name in ("a", "b") :
+        cache.set(name, [name])
+    assert cache.get("a") == ["a"]
+    cache.set("c", ["c"])
+    # b, least recently used, evicted
+    assert cache.get("b") is None
+    assert cache.get("a") == ["a"] and cache.get("c") == ["c"]
+
+def test_expired_entry() :
+    cache = search_cache.SearchCache(ttl=-1)
+    cache.set("a", ["a"])
+    assert cache.get("a") is None
+    assert len(cache.entries) == 0
+
+def test_concurrent_get_set() :
+    cache = search_cache.SearchCache(size=8, ttl=0.001)
+    cache.entries = YieldingDict()
+    errors = []
+
+    def work(offset) :
+        try :
+            for i in range(2000) :
+                key = "k%d"%((i + offset) % 16)
+                if cache.get(key) is None :
+                    cache.set(key, [key])
+        except Exception as e :
+            errors.append(e)
+
+    threads = [threading.Thread(target=work, args=(n,)) for n in range(8)]
+    for thread in threads :
+        thread.start()
+    for thread in threads :
+        thread.join()
+    assert errors == []
+    assert len(cache.entries) <= 8
+
+class DictRedis(object):
+
+    def __init__(self) :
+        self.data = {}
+        self.reads = 0
+
+    def get(self, key) :
+        self.reads += 1
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None) :
+        self.data[key] = value.encode("utf8")
+
+def test_tiers() :
+    redis = DictRedis()
+    writer, reader = search_cache.SearchCache(redis), search_cache.SearchCache(redis)
+    writer.set_local("a", ["a"])
+    writer.set_shared("a", ["a"])
+    assert reader.get_local("a") is None
+    assert redis.reads == 0
+    # a value read from Redis is served by the local tier afterwards
+    assert reader.get_shared("a") == ["a"]
+    assert reader.get_local("a") == ["a"]
+    assert reader.get("a") == ["a"] and redis.reads == 1
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the lazy loading of the language models (embeddings.py).
+"""
+
+import os
+import sys
+import types
+import subprocess
+import numpy as np
+import embeddings
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_imports_load_no_model() :
+    statement = ("import sys, embeddings, run_tests, vectorize; "
+        "assert not [m for m in sys.modules if m.startswith(('laserembeddings', 'bert_serving'))]; "
+        "assert embeddings.models == {} and embeddings.caches == {}")
+    process = subprocess.run([sys.executable, "-c", statement], cwd=ROOT, capture_output=True, text=True)
+    assert process.returncode == 0, process.stderr
+
+class Laser(object):
+    instances = 0
+
+    def __init__(self) :
+        Laser.instances += 1
+        self.encoded = []
+
+    def embed_sentences(self, texts, lang) :
+        self.encoded.extend(texts)
+        return np.ones((len(texts), embeddings.DIMS[embeddings.LASER]))
+
+def test_model_loaded_on_first_miss(tmp_path, monkeypatch) :
+    monkeypatch.setitem(sys.modules, "laserembeddings", types.SimpleNamespace(Laser=Laser))
+    monkeypatch.setattr(embeddings, "models", {})
+    monkeypatch.setattr(embeddings, "caches", {embeddings.LASER:embeddings.EmbeddingCache("laser",
+        embeddings.LASER, embeddings.DIMS[embeddings.LASER], directory=str(tmp_path))})
+    assert embeddings.models == {}
+    embeddings.embed(["lemon tart", "fig jam"], embeddings.LASER)
+    embeddings.embed(["lemon tart", "plum cake"], embeddings.LASER)
+    assert Laser.instances == 1
+    assert embeddings.models[embeddings.LASER].encoded == ["lemon tart", "fig jam", "plum cake"]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the completions of the suggestions (suggest.PrefixIndex).
+"""
+
+import random
+import suggest
+
+def brute_force(entries, prefix, top) :
+    matching = [(key, score) for key, score in entries.items() if key.startswith(prefix)]
+    return sorted(matching, key=lambda entry : (-entry[1], entry[0]))[:top]
+
+def test_complete_small() :
+    index = suggest.PrefixIndex({"lemon":3.0, "lemon tree":5.0, "lime":4.0, "apple":1.0}, top=2)
+    assert len(index) == 4
+    assert index.complete("le") == [("lemon tree", 5.0), ("lemon", 3.0)]
+    assert [key for key, _ in index.complete("l")] == ["lemon tree", "lime"]
+    assert index.complete("pear") == []
+
+def test_precomputed_prefixes_match_scan() :
+    rand = random.Random(3)
+    keys = set()
+    while len(keys) < 2000 :
+        keys.add("".join(rand.choice("abc") for _ in range(rand.randint(1, 8))))
+    # distinct scores, exact in float32 : a single expected order
+    entries = dict(zip(sorted(keys), map(float, rand.sample(range(1000000), len(keys)))))
+    index = suggest.PrefixIndex(entries, top=5, scan_limit=16)
+    assert "" in index.tops and "a" in index.tops
+    for prefix in ["", "a", "ab", "abc", "cab", "bbbb", "ccccccc"] :
+        assert index.complete(prefix) == brute_force(entries, prefix, 5)
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the local vector indices (vector_index.py).
+"""
+
+import numpy as np
+import pytest
+import vector_index
+from vector_index import IVFIndex, ExactIndex, VectorStore
+
+DIM = 768 # bert_vector
+
+def vectors(count, seed=0) :
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(20, DIM))
+    return centers[rng.integers(0, 20, count)] + 0.5 * rng.normal(size=(count, DIM))
+
+def ids(count) :
+    return ["doc-%d"%i for i in range(count)]
+
+def test_top_k() :
+    scores = np.array([0.1, 0.9, 0.5, 0.9, -1.0])
+    assert vector_index.top_k(scores, 3).tolist() == [1, 3, 2]
+    assert vector_index.top_k(scores, 10).tolist() == [1, 3, 2, 0, 4]
+
+def test_index_built_after_start(tmp_path) :
+    server = IVFIndex("bert_vector", str(tmp_path))
+    assert not server.exists()
+    # built by vector_index.py in another process
+    builder = IVFIndex("bert_vector", str(tmp_path))
+    matrix = vectors(500)
+    builder.add(ids(500), matrix)
+    builder.train(nlist=10)
+    assert server.exists()
+    assert server.search(matrix[:3], k=1, nprobe=10) == [[("doc-%d"%i, pytest.approx(1.0, abs=1e-5))]
+        for i in range(3)]
+
+def test_updated_vector_replaces_previous(tmp_path) :
+    index = IVFIndex("bert_vector", str(tmp_path))
+    matrix = vectors(300)
+    index.add(ids(300), matrix)
+    index.train(nlist=5)
+    reader = IVFIndex("bert_vector", str(tmp_path))
+    exact = ExactIndex(reader.store)
+    assert reader.search(matrix[:1], k=1)[0][0][0] == "doc-0"
+    # doc-0 re-vectorized with the vector of doc-1
+    assert index.add(["doc-0"], matrix[1:2]) == 1
+    for results in (reader.search(matrix[:2], k=5, nprobe=5), exact.search(matrix[:2], k=5)) :
+        found = [[doc_id for doc_id, _ in result] for result in results]
+        assert all(len(result) == len(set(result)) for result in found)
+        assert "doc-0" not in found[0][:1]
+        assert set(found[1][:2]) == set(["doc-0", "doc-1"])
+    assert len(reader.store) == 301
+    assert reader.store.live.sum() == 300
+
+@pytest.mark.parametrize("dtype,rerank,recall", [("float32", 0, 1.0), ("float16", 0, 0.95),
+    ("int8", 0, 0.8), ("int8", 50, 0.95)])
+def test_exact_index_quantized(tmp_path, dtype, rerank, recall) :
+    store = VectorStore(str(tmp_path), DIM)
+    matrix = vectors(2000)
+    appended = store.append(ids(2000), matrix)
+    store.commit(appended[1])
+    queries = matrix[:50] + 0.1 * np.random.default_rng(1).normal(size=(50, DIM))
+    truth = [set(np.argsort(-scores)[:10]) for scores in vector_index.normalize(queries) @ store.matrix.T]
+    index = ExactIndex(store, dtype, rerank=rerank, chunk=512)
+    found = [set(store.rows[doc_id] for doc_id, _ in result) for result in index.search(queries, 10)]
+    assert np.mean([len(a & b) / 10 for a, b in zip(found, truth)]) >= recall
+    assert index.nbytes == 2000 * DIM * {"float32":4, "float16":2, "int8":1}[dtype]
+
+def test_shared_indices_built_once(tmp_path, monkeypatch) :
+    import threading
+    monkeypatch.setattr(vector_index, "INDEX_DIR", str(tmp_path))
+    monkeypatch.setattr(vector_index, "indices", {})
+    monkeypatch.setattr(vector_index, "exact_indices", {})
+    monkeypatch.setattr(IVFIndex.__init__, "__defaults__", (str(tmp_path),))
+    writer = IVFIndex("bert_vector", str(tmp_path))
+    writer.add(ids(1000), vectors(1000))
+    copies = []
+    load = ExactIndex.load
+    def counted(self) :
+        result = load(self)
+        copies.append(id(result[0]))
+        return result
+    monkeypatch.setattr(ExactIndex, "load", counted)
+    found = []
+    def search() :
+        index = vector_index.get_exact_index("bert_vector", "int8")
+        found.append((id(index), index.search(vectors(2, seed=3), 5)))
+    threads = [threading.Thread(target=search) for _ in range(8)]
+    for thread in threads :
+        thread.start()
+    for thread in threads :
+        thread.join()
+    assert len(set(index for index, _ in found)) == 1
+    assert len(set(copies)) == 1
+    assert all(results == found[0][1] for _, results in found)
+
+def test_exact_search_while_rows_are_added(tmp_path) :
+    import threading
+    writer = IVFIndex("bert_vector", str(tmp_path))
+    matrix = vectors(400)
+    writer.add(ids(100), matrix[:100])
+    exact = ExactIndex(IVFIndex("bert_vector", str(tmp_path)).store)
+    errors = []
+    def add() :
+        for start in range(100, 400, 10) :
+            # half new documents, half re-vectorized ones
+            writer.add(ids(start + 5)[-5:] + ids(5), matrix[start:start+10])
+    def search() :
+        try :
+            for _ in range(50) :
+                matrix_, scale, (stored, live, ids_, _) = exact.load()
+                assert len(matrix_) == len(stored) == len(live) <= len(ids_)
+                exact.search(matrix[:2], k=3)
+        except Exception as e :
+            errors.append(e)
+    threads = [threading.Thread(target=add)] + [threading.Thread(target=search) for _ in range(3)]
+    for thread in threads :
+        thread.start()
+    for thread in threads :
+        thread.join()
+    assert errors == []
+    # 100 documents, 5 new ones per batch, doc-0 to doc-4 replaced
+    assert exact.load()[2][1].sum() == 250
+
+def store_size(store) :
+    import os
+    # files of the current generation (the previous one is kept for the searches reading it)
+    return [os.path.getsize(path) for path in (store.ids_path, store.path("vectors.f32"),
+        store.path("assign.i32"), store.path("centroids.npy"))]
+
+def test_rebuilds_compact_the_store(tmp_path) :
+    import os
+    import local_index
+    es = local_index.LocalClient(str(tmp_path / "es"))
+    matrix = vectors(300)
+    es.bulk([line for i in range(300) for line in ({"index":{"_index":"web-en", "_id":"doc-%d"%i}},
+        {"url":"doc-%d"%i, "bert_vector":matrix[i].tolist()})])
+    directory = str(tmp_path / "index")
+    server = IVFIndex("bert_vector", directory)
+    builder = IVFIndex("bert_vector", directory)
+    builder.build(es, nlist=5, batch_size=100)
+    first = store_size(builder.store)
+    assert server.search(matrix[:1], k=1, nprobe=5)[0][0][0] == "doc-0"
+    builder.build(es, nlist=5, batch_size=100)
+    # same rows and file sizes (of another generation), no dead row
+    assert len(builder.store) == len(server.store) == 300
+    assert store_size(builder.store) == first
+    # ids.txt, lock and the files of the last two generations
+    assert len(os.listdir(os.path.join(directory, "bert_vector"))) == 8
+    assert server.store.dead == 0
+    found = server.search(matrix[:3], k=1, nprobe=5) + ExactIndex(server.store).search(matrix[:3], k=1)
+    assert [result[0][0] for result in found] == ["doc-0", "doc-1", "doc-2"] * 2
+
+def test_compacted_when_most_rows_are_dead(tmp_path) :
+    index = IVFIndex("bert_vector", str(tmp_path))
+    matrix = vectors(100)
+    index.add(ids(100), matrix)
+    index.train(nlist=4)
+    reader = IVFIndex("bert_vector", str(tmp_path))
+    assert len(reader.store) == 100
+    index.add(ids(100), matrix[::-1])
+    reader.store.refresh()
+    assert len(reader.store) == 200 and reader.store.dead == 100
+    # one more replaced vector : more than half the rows are dead
+    index.add(["doc-0"], matrix[:1])
+    reader.store.refresh()
+    assert len(index.store) == len(reader.store) == 100 and reader.store.dead == 0
+    assert [result[0][0] for result in reader.search(matrix[:2], k=1, nprobe=4)] == ["doc-0", "doc-98"]
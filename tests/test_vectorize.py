@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the streaming re-vectorization (vectorize.py), on the local backend.
+"""
+
+import numpy as np
+import pytest
+import local_index
+import vectorize
+
+class Index(object):
+    """
+    Local ANN index not built yet.
+    """
+
+    def exists(self) :
+        return False
+
+@pytest.fixture
+def es(tmp_path, monkeypatch) :
+    client = local_index.LocalClient(str(tmp_path))
+    client.bulk([line for number in range(25) for line in ({"index":{"_index":"web-en", "_id":"d%d"%number}},
+        {"url":"http://a.org/%d"%number, "title":"title %d"%(number % 5) if number != 3 else ""})])
+    monkeypatch.setattr(vectorize, "es", client)
+    monkeypatch.setattr(vectorize.vector_index, "get_index", lambda vector_type : Index())
+    return client
+
+def encoder(calls, fail_after=None) :
+    def embed(texts, vector_type) :
+        if fail_after is not None and len(calls) >= fail_after :
+            raise RuntimeError("encoder down")
+        calls.append(list(texts))
+        return np.asarray([[float(len(text)), 1.0] for text in texts])
+    return embed
+
+def test_batches_and_bulk_updates(es, monkeypatch) :
+    calls = []
+    monkeypatch.setattr(vectorize, "embed", encoder(calls))
+    vectorize.doVectorize("laser_vector", batch_size=10)
+    assert [len(texts) for texts in calls] == [10, 10, 5]
+    # empty titles embedded as N/A
+    assert sum(texts.count("N/A") for texts in calls) == 1
+    docs = es.mget(index="web-en", body={"ids":["d0", "d3"]})["docs"]
+    assert docs[0]["_source"]["laser_vector"] == [7.0, 1.0]
+    assert docs[1]["_source"]["laser_vector"] == [3.0, 1.0]
+
+def test_resumed_after_a_crash(es, monkeypatch) :
+    calls = []
+    monkeypatch.setattr(vectorize, "embed", encoder(calls, fail_after=2))
+    with pytest.raises(RuntimeError) :
+        vectorize.doVectorize("laser_vector", batch_size=10)
+    # the 20 documents written before the crash are not embedded again
+    calls = []
+    monkeypatch.setattr(vectorize, "embed", encoder(calls))
+    vectorize.doVectorize("laser_vector", batch_size=10)
+    assert [len(texts) for texts in calls] == [5]
@@ -12,7 +12,7 @@ __license__ = "MIT"
 __version__ = "1.0"
 
 import re
-import langdetect
+import language_id
 import html2text
 import requests
 import justext
@@ -25,13 +25,13 @@ def domain(url) :
     """
     return tldextract.extract(url).registered_domain
 
-def crawl(url) :
+def crawl(url, timeout=None) :
     """
-    Crawl an URL.
+    Crawl an URL (timeout in seconds, None to wait indefinitely).
     Return URL data.
     """
     try :
-        r = requests.get(url)
+        r = requests.get(url, timeout=timeout)
     except :
         return None
     return r
@@ -49,7 +49,7 @@ def detect_language(html) :
         except :
             pass
     h = html2text.HTML2Text()
-    return langdetect.detect(h.handle(html))
+    return language_id.detect(h.handle(html))[0]
 
 def extract_content(html, lang) :
     """
@@ -0,0 +1,540 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Local nearest neighbour search over the bert_vector and laser_vector
+fields of the web-en index.
+Vectors are normalized and stored in a memory-mapped float32 matrix. An IVF
+index (spherical k-means centroids plus one inverted list per centroid)
+restricts each query to the nprobe closest lists, scored with exact dot
+products. New vectors are appended and assigned to their closest centroid,
+so vectorize.py can keep the index up to date while it runs, and an index
+built or re-trained by another process is picked up by the next search.
+Replaced vectors leave dead rows : training (build) rewrites the store with
+the live rows only, as does add once most rows are dead.
+For smaller corpora, ExactIndex scores every stored vector with one matrix
+multiply per batch of queries, optionally on float16 or int8 copies of the
+matrix to divide its memory footprint by 2 or 4.
+
+Usage : python vector_index.py build <vector_type> [nlist]
+Vector type : 'LASER' or 'BERT'
+"""
+
+import os
+import re
+import sys
+import uuid
+import fcntl
+import threading
+import contextlib
+import numpy as np
+from elasticsearch import helpers
+
+DIMS = {'laser_vector' : 1024, 'bert_vector' : 768}
+
+#Root directory of the local vector indices
+INDEX_DIR = os.getenv("VECTOR_INDEX_DIR", ".vector_index")
+
+#Number of inverted lists visited per query
+NPROBE = 8
+
+#Ratio of dead rows (replaced vectors) above which IVFIndex.add compacts the store
+MAX_DEAD_RATIO = 0.5
+
+#First line of the ids file of a compacted store, and files of a generation
+GENERATION = b"#generation "
+GENERATION_FILE = re.compile(r"^(?:vectors|assign|centroids)(?:-([0-9a-f]{12}))?\.(?:f32|i32|npy)$")
+
+def normalize(matrix) :
+    """
+    Scale the rows of a matrix to unit length (cosine similarity = dot product).
+    """
+    matrix = np.atleast_2d(np.asarray(matrix, dtype=np.float32))
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+def top_k(scores, k) :
+    """
+    Indices of the k best scores, best first.
+    """
+    if len(scores) > k :
+        best = np.argpartition(-scores, k-1)[:k]
+    else :
+        best = np.arange(len(scores))
+    return best[np.argsort(-scores[best], kind="stable")]
+
+def nearest(matrix, centroids, chunk=65536) :
+    """
+    Index of the closest centroid of each row, computed by chunks to bound memory.
+    """
+    assign = np.empty(len(matrix), dtype=np.int32)
+    for start in range(0, len(matrix), chunk) :
+        block = np.asarray(matrix[start:start+chunk], dtype=np.float32)
+        assign[start:start+chunk] = np.argmax(block @ centroids.T, axis=1)
+    return assign
+
+def kmeans(matrix, nlist, iterations=10, sample=100000, seed=0) :
+    """
+    Spherical k-means on (a sample of) normalized rows, return the centroids.
+    """
+    rng = np.random.default_rng(seed)
+    if len(matrix) > sample :
+        matrix = matrix[np.sort(rng.choice(len(matrix), sample, replace=False))]
+    matrix = np.asarray(matrix, dtype=np.float32)
+    centroids = matrix[rng.choice(len(matrix), nlist, replace=False)].copy()
+    for _ in range(iterations) :
+        assign = nearest(matrix, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, matrix)
+        empty = ~sums.any(axis=1)
+        # re-seed empty clusters with random rows
+        sums[empty] = matrix[rng.choice(len(matrix), int(empty.sum()))]
+        centroids = normalize(sums)
+    return centroids
+
+class VectorStore(object):
+    """
+    Append-only store of normalized vectors and their document ids.
+    The ids file is written last and gives the number of valid rows, so
+    readers never see a row whose vector is not written yet. A document
+    stored again gets a new row : its previous row is dead (live is False)
+    and skipped by the searches. Writers append under an exclusive file
+    lock (locked).
+    compact rewrites the live rows in a new generation of the files : its
+    ids file, which names the generation in its first line, replaces the
+    previous one, and readers load the new generation from the start.
+    """
+
+    def __init__(self, directory, dim) :
+        self.directory = directory
+        self.dim = dim
+        os.makedirs(directory, exist_ok=True)
+        self.ids_path = os.path.join(directory, "ids.txt")
+        self.lock_path = os.path.join(directory, "lock")
+        self.refresh_lock = threading.Lock()
+        self._reset(None, "", 0)
+        self.refresh()
+
+    def __len__(self) :
+        return len(self.ids)
+
+    def _reset(self, inode, generation, offset) :
+        self.inode = inode           # of the loaded ids file
+        self.generation = generation # "" : files written before the compactions
+        self.ids = []
+        self.rows = {} # document id -> its last row
+        self.live = np.zeros(0, dtype=bool)
+        self.matrix = np.zeros((0, self.dim), dtype=np.float32)
+        self.loaded = offset
+
+    def path(self, name, generation=None) :
+        """
+        Path of a file of a generation (the loaded one by default) :
+        vectors.f32 here, the assignments and centroids of IVFIndex.
+        """
+        generation = self.generation if generation is None else generation
+        if not generation :
+            return os.path.join(self.directory, name)
+        base, extension = os.path.splitext(name)
+        return os.path.join(self.directory, "%s-%s%s"%(base, generation, extension))
+
+    @property
+    def dead(self) :
+        return len(self.live) - int(self.live.sum())
+
+    def refresh(self) :
+        """
+        Load the rows appended since the last call, return True if any.
+        """
+        try :
+            stat = os.stat(self.ids_path)
+        except FileNotFoundError :
+            return False
+        if stat.st_ino == self.inode and stat.st_size == self.loaded :
+            return False
+        with self.refresh_lock :
+            return self._refresh()
+
+    def _refresh(self) :
+        reset = False
+        with open(self.ids_path, "rb") as f :
+            inode = os.fstat(f.fileno()).st_ino
+            header = f.readline()
+            generation = header[len(GENERATION):].strip().decode("ascii") if header.startswith(GENERATION) else ""
+            if inode != self.inode or generation != self.generation :
+                # first load, or a new generation written by compact
+                self._reset(inode, generation, f.tell() if generation else 0)
+                reset = True
+            f.seek(self.loaded)
+            data = f.read()
+        # ignore a partially written last line
+        data = data[:data.rfind(b"\n")+1]
+        new = data.decode("utf8").splitlines()
+        if not new :
+            return reset
+        count = len(self.ids) + len(new)
+        # the matrix first : readers never see a row it does not hold
+        self.matrix = np.memmap(self.path("vectors.f32"), dtype=np.float32, mode="r", shape=(count, self.dim))
+        live = np.ones(count, dtype=bool)
+        live[:len(self.live)] = self.live
+        for doc_id in new :
+            previous = self.rows.get(doc_id)
+            if previous is not None :
+                live[previous] = False
+            self.rows[doc_id] = len(self.ids)
+            self.ids.append(doc_id)
+        self.live = live
+        self.loaded += len(data)
+        return True
+
+    def snapshot(self) :
+        """
+        Matrix, live mask, ids and generation of the loaded rows, taken
+        together : a concurrent refresh cannot give a mask and a matrix of
+        different lengths. The ids list only grows, the rows of the matrix
+        are the valid ones.
+        """
+        self.refresh()
+        with self.refresh_lock :
+            return self.matrix, self.live, self.ids, self.generation
+
+    @contextlib.contextmanager
+    def locked(self) :
+        """
+        Exclusive lock of the writers of the store, shared by the processes.
+        """
+        with open(self.lock_path, "w") as lock :
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def append(self, ids, vectors) :
+        """
+        Write the vectors of documents (made visible by commit), those
+        already stored replace their previous vector.
+        Return (normalized vectors, their ids, first row), or None if there is none.
+        """
+        self.refresh()
+        # the last vector of a document given twice
+        new = list(dict(zip(ids, vectors)).items())
+        if not new :
+            return None
+        first = len(self.ids)
+        matrix = normalize([vector for _, vector in new])
+        path = self.path("vectors.f32")
+        with open(path, "r+b" if os.path.exists(path) else "wb") as f :
+            f.seek(first * self.dim * 4)
+            f.write(matrix.tobytes())
+        return matrix, [doc_id for doc_id, _ in new], first
+
+    def commit(self, ids) :
+        with open(self.ids_path, "ab") as f :
+            f.write("".join(doc_id.replace("\n", " ")+"\n" for doc_id in ids).encode("utf8"))
+        self.refresh()
+
+    def compact(self, write=None, chunk=65536) :
+        """
+        Rewrite the live rows in a new generation (writers lock held).
+        write(generation, matrix) writes the other files of the generation
+        before it replaces the current one. The files of the generation
+        before the current one are removed : a search still reading them
+        keeps its mapping.
+        """
+        self.refresh()
+        rows = np.flatnonzero(self.live)
+        previous, generation = self.generation, uuid.uuid4().hex[:12]
+        path = self.path("vectors.f32", generation)
+        with open(path, "wb") as f :
+            for start in range(0, len(rows), chunk) :
+                f.write(np.ascontiguousarray(self.matrix[rows[start:start+chunk]]).tobytes())
+        if write is not None :
+            matrix = np.memmap(path, dtype=np.float32, mode="r", shape=(len(rows), self.dim)) if len(rows) \
+                else np.zeros((0, self.dim), dtype=np.float32)
+            write(generation, matrix)
+        with open(self.ids_path + ".tmp", "wb") as f :
+            f.write(GENERATION + generation.encode("ascii") + b"\n")
+            f.write("".join(self.ids[row]+"\n" for row in rows).encode("utf8"))
+        os.replace(self.ids_path + ".tmp", self.ids_path)
+        self.refresh()
+        for name in os.listdir(self.directory) :
+            match = GENERATION_FILE.match(name)
+            if match and (match.group(1) or "") not in (generation, previous) :
+                os.remove(os.path.join(self.directory, name))
+
+class IVFIndex(object):
+    """
+    Inverted file index over a VectorStore, shared by the threads of a server.
+    The assignments and centroids belong to a generation of the store : a
+    search always uses those of the rows it reads.
+    """
+
+    def __init__(self, vector_type, directory=INDEX_DIR) :
+        self.vector_type = vector_type
+        self.directory = os.path.join(directory, vector_type)
+        self.store = VectorStore(self.directory, DIMS[vector_type])
+        self.centroids = None
+        self.trained = None # generation of the loaded centroids
+        self.lists = None
+        self.listed = None
+        self.lock = threading.RLock()
+        self._load_centroids()
+
+    def _load_centroids(self) :
+        """
+        (Re)load the centroids when the index was built or re-trained,
+        possibly by another process.
+        """
+        with self.lock :
+            self.store.refresh()
+            if self.store.generation != self.trained :
+                path = self.store.path("centroids.npy")
+                self.centroids = np.load(path) if os.path.exists(path) else None
+                self.trained = self.store.generation
+                self.lists = None
+
+    def exists(self) :
+        self._load_centroids()
+        return self.centroids is not None
+
+    def train(self, nlist=None, sample=100000, seed=0) :
+        """
+        Compute the centroids from the live vectors, then compact the store
+        with the assignment of every row.
+        """
+        self.store.refresh()
+        rows = np.flatnonzero(self.store.live)
+        if len(rows) == 0 :
+            raise ValueError("no vector to index")
+        nlist = min(nlist or max(1, int(4 * np.sqrt(len(rows)))), len(rows))
+        if len(rows) > sample :
+            rows = np.sort(np.random.default_rng(seed).choice(rows, sample, replace=False))
+        centroids = kmeans(self.store.matrix[rows], nlist, seed=seed)
+        with self.store.locked() :
+            self.compact(centroids)
+
+    def compact(self, centroids) :
+        """
+        Rewrite the live rows of the store, assigned to centroids (writers
+        lock held).
+        """
+        def write(generation, matrix) :
+            nearest(matrix, centroids).tofile(self.store.path("assign.i32", generation))
+            with open(self.store.path("centroids.npy", generation), "wb") as f :
+                np.save(f, centroids)
+        self.store.compact(write)
+        self._load_centroids()
+
+    def add(self, ids, vectors) :
+        """
+        Add document vectors (incremental update, no re-training). The store
+        is compacted once most of its rows are dead (re-vectorized documents).
+        """
+        with self.store.locked() :
+            appended = self.store.append(ids, vectors)
+            if appended is None :
+                return 0
+            matrix, new_ids, first = appended
+            if self.exists() :
+                path = self.store.path("assign.i32")
+                with open(path, "r+b" if os.path.exists(path) else "wb") as f :
+                    f.seek(first * 4)
+                    f.write(nearest(matrix, self.centroids).tobytes())
+            self.store.commit(new_ids)
+            if self.centroids is not None and self.store.dead > MAX_DEAD_RATIO * len(self.store) :
+                self.compact(self.centroids)
+        return len(new_ids)
+
+    def _load_lists(self) :
+        """
+        (Re)build the inverted lists of the live rows when rows were added
+        (once, by the first search), return the centroids, their lists and
+        the snapshot of the store they index.
+        """
+        with self.lock :
+            self._load_centroids()
+            matrix, live, ids, generation = self.store.snapshot()
+            if generation != self.trained :
+                # compacted since the centroids were loaded
+                self._load_centroids()
+                matrix, live, ids, generation = self.store.snapshot()
+            count = len(matrix)
+            if self.lists is None or self.listed != (generation, count) :
+                assign = np.fromfile(self.store.path("assign.i32", generation), dtype=np.int32, count=count)
+                order = np.argsort(assign, kind="stable")
+                order = order[live[order]]
+                bounds = np.searchsorted(assign[order], np.arange(len(self.centroids) + 1))
+                self.lists = [order[bounds[i]:bounds[i+1]] for i in range(len(self.centroids))]
+                self.listed = (generation, count)
+            return self.centroids, self.lists, matrix, ids
+
+    def search(self, queries, k=10, nprobe=NPROBE) :
+        """
+        For each query vector, list of (document id, cosine similarity) of the
+        k most similar documents.
+        """
+        centroids, inverted_lists, matrix, ids = self._load_lists()
+        queries = normalize(queries)
+        probes = np.argsort(-(queries @ centroids.T), axis=1)[:, :nprobe]
+        results = []
+        for query, lists in zip(queries, probes) :
+            rows = np.sort(np.concatenate([inverted_lists[l] for l in lists]))
+            scores = np.asarray(matrix[rows]) @ query
+            best = top_k(scores, k)
+            results.append([(ids[rows[i]], float(scores[i])) for i in best])
+        return results
+
+    def build(self, es, index="web-en", nlist=None, batch_size=1000) :
+        """
+        Load every vector of an Elasticsearch index and train the IVF index.
+        """
+        ids, vectors = [], []
+        for hit in helpers.scan(es, index=index, size=batch_size, _source=[self.vector_type],
+                query={"query":{"exists":{"field":self.vector_type}}}) :
+            ids.append(hit["_id"])
+            vectors.append(hit["_source"][self.vector_type])
+            if len(ids) >= batch_size :
+                self.add(ids, vectors)
+                ids, vectors = [], []
+        if ids :
+            self.add(ids, vectors)
+        self.train(nlist)
+
+class ExactIndex(object):
+    """
+    Exact top-k cosine search over a contiguous in-memory copy of a VectorStore,
+    shared by the threads of a server (the copy is made by the first search
+    after rows were added, the others wait for it).
+    dtype      : float32, float16 or int8 (scalar quantization, one scale per dimension)
+    rerank     : with int8, number of candidates per query re-scored with the
+                 float32 vectors of the store (0 to disable)
+    """
+
+    DTYPES = ("float32", "float16", "int8")
+
+    def __init__(self, store, dtype="float32", rerank=0, chunk=65536) :
+        if dtype not in self.DTYPES :
+            raise ValueError("unsupported dtype %s"%dtype)
+        self.store = store
+        self.dtype = dtype
+        self.rerank = rerank
+        self.chunk = chunk
+        self.matrix = None
+        self.scale = None
+        self.stored = None # snapshot of the store the copy was made from
+        self.loaded = None
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self) :
+        """
+        Copy (and quantize) the stored vectors in memory if rows were added.
+        Return the copy, its scales (int8) and the snapshot of the store
+        (matrix, live rows, ids, generation) it was made from.
+        """
+        with self.lock :
+            stored = self.store.snapshot()
+            if self.loaded != (stored[3], len(stored[0])) :
+                matrix = stored[0]
+                if self.dtype == "float32" :
+                    self.matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+                elif self.dtype == "float16" :
+                    self.matrix = np.ascontiguousarray(matrix, dtype=np.float16)
+                else :
+                    scale = np.abs(matrix).max(axis=0).astype(np.float32) / 127 if len(matrix) else \
+                        np.ones(self.store.dim, dtype=np.float32)
+                    scale[scale == 0] = 1
+                    codes = np.empty(matrix.shape, dtype=np.int8)
+                    for start in range(0, len(matrix), self.chunk) :
+                        block = np.asarray(matrix[start:start+self.chunk]) / scale
+                        codes[start:start+self.chunk] = np.clip(np.rint(block), -127, 127)
+                    self.matrix, self.scale = codes, scale
+                self.stored = stored
+                self.loaded = (stored[3], len(matrix))
+            return self.matrix, self.scale, self.stored
+
+    @property
+    def nbytes(self) :
+        return self.matrix.nbytes
+
+    def scores(self, queries, block, scale=None) :
+        """
+        Cosine similarities of normalized queries with a block of rows of the copy.
+        """
+        if self.dtype == "int8" :
+            # (q * scale) . codes == q . dequantized row
+            return (queries * scale) @ block.astype(np.float32).T
+        return queries @ block.astype(np.float32, copy=False).T
+
+    def search(self, queries, k=10) :
+        """
+        For each query vector, list of (document id, cosine similarity) of the
+        k most similar documents.
+        """
+        matrix, scale, (vectors, live, ids, _) = self.load()
+        queries = normalize(queries)
+        depth = max(k, self.rerank) if self.dtype == "int8" else k
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+        for start in range(0, len(matrix), self.chunk) :
+            chunk_rows = np.arange(start, min(start+self.chunk, len(matrix)))
+            chunk_scores = self.scores(queries, matrix[start:start+self.chunk], scale)
+            chunk_scores[:, ~live[start:start+self.chunk]] = -np.inf
+            scores = np.concatenate([best_scores, chunk_scores], axis=1)
+            rows = np.concatenate([best_rows, np.broadcast_to(chunk_rows, (len(queries), len(chunk_rows)))], axis=1)
+            if scores.shape[1] > depth :
+                keep = np.argpartition(-scores, depth-1, axis=1)[:, :depth]
+                scores = np.take_along_axis(scores, keep, axis=1)
+                rows = np.take_along_axis(rows, keep, axis=1)
+            best_scores, best_rows = scores, rows
+        results = []
+        for query, rows, scores in zip(queries, best_rows, best_scores) :
+            # rows replaced by a newer vector of their document
+            keep = live[rows]
+            rows, scores = rows[keep], scores[keep]
+            if depth > k :
+                rows = np.sort(rows)
+                scores = np.asarray(vectors[rows]) @ query
+            best = top_k(scores, k)
+            results.append([(ids[rows[i]], float(scores[i])) for i in best])
+        return results
+
+indices = {}
+exact_indices = {}
+# concurrent first uses wait for a single copy of the vectors
+indices_lock = threading.Lock()
+
+def get_exact_index(vector_type, dtype=os.getenv("VECTOR_INDEX_DTYPE", "float32")) :
+    """
+    Shared exact index of a vector type, loaded on first use.
+    """
+    store = get_index(vector_type).store
+    with indices_lock :
+        if (vector_type, dtype) not in exact_indices :
+            exact_indices[(vector_type, dtype)] = ExactIndex(store, dtype, rerank=100 if dtype == "int8" else 0)
+        return exact_indices[(vector_type, dtype)]
+
+def get_index(vector_type) :
+    """
+    Shared IVF index of a vector type, opened on first use.
+    """
+    with indices_lock :
+        if vector_type not in indices :
+            indices[vector_type] = IVFIndex(vector_type)
+        return indices[vector_type]
+
+def main() :
+    error_msg = "**********************************\nInvalid script usage!\n \
+    Usage : python vector_index.py build <vector_type> [nlist]\nVector type : 'LASER' or 'BERT'\n \
+    **********************************"
+    if len(sys.argv) < 3 or sys.argv[1] != "build" :
+        sys.exit(error_msg)
+    vector_type = sys.argv[2].lower() + "_vector"
+    if vector_type not in DIMS :
+        sys.exit(error_msg)
+    from vectorize import es
+    index = get_index(vector_type)
+    index.build(es, nlist=int(sys.argv[3]) if len(sys.argv) > 3 else None)
+    print("%d vectors in %d lists"%(len(index.store), len(index.centroids)))
+
+if __name__ == "__main__" :
+    main()